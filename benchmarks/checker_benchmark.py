@@ -0,0 +1,221 @@
+"""Micro-benchmarks for symbolic answer checking.
+
+Times each stage of checking (parsing assumptions/problem/answer, doit, numeric pre-check,
+simplify passes) for correct, incorrect and adversarial answers to every problem, flags
+checks that go over a time budget, and compares verdicts of the current checker against the
+original parse/doit/simplify-until-fixpoint algorithm so optimizations can't silently change results.
+
+    python -m benchmarks.checker_benchmark --problems 60
+    python -m benchmarks.checker_benchmark --database-url postgresql://localhost/math_helper --budget 0.5
+    python -m benchmarks.checker_benchmark --compare-verdicts benchmarks/results/checker-baseline.json
+
+Each check runs in its own forked process so adversarial answers can be cut off at --timeout.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import statistics
+import multiprocessing
+from datetime import datetime
+from collections import defaultdict
+from sympy import parse_expr
+import psycopg2
+from math_api.checker import check_answer, CORRECT, INCORRECT, MATCHES_PROBLEM, UNPARSEABLE
+from math_api.equivalence import numerically_equivalent
+from .corpus import generate_problems, ADVERSARIAL_ANSWERS
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+# problems and their sample solutions as stored in the db, using sample solutions as known correct answers
+def load_problems(database_url):
+    connection = psycopg2.connect(database_url)
+    cursor = connection.cursor()
+    cursor.execute('SELECT problem_info.id, problem_info.expression_type, problem_info_sympy.info_type, problem_info_sympy.representation, problem_info_sympy.sympy_assumption '
+    'FROM problem_info INNER JOIN problem_info_sympy ON problem_info_sympy.problem_id = problem_info.id ORDER BY problem_info.id;')
+    problems = {}
+    for problem_id, expression_type, info_type, representation, sympy_assumption in cursor.fetchall():
+        problem = problems.setdefault(problem_id, {'id': problem_id, 'expression_type': expression_type, 'solutions': [], 'assumptions': []})
+        if sympy_assumption is not None:
+            problem['assumptions'].append((representation, sympy_assumption))
+        if info_type == 'problem':
+            problem['representation'] = representation
+        elif info_type == 'sample_solution':
+            problem['solutions'].append(representation)
+    connection.close()
+    for problem in problems.values():
+        problem['correct_answers'] = list(problem['solutions'])
+        problem['incorrect_answers'] = [f'({solution}) + 1' for solution in problem['solutions']]
+    return list(problems.values())
+
+# simplify repeatedly like the original checker did, counting passes
+def simplify_until_fixpoint(expression, stage_times):
+    passes = 1
+    start = time.perf_counter()
+    expression = expression.simplify()
+    while True:
+        simplified = expression.simplify()
+        passes += 1
+        if simplified == expression:
+            break
+        expression = simplified
+    stage_times['simplify'] += time.perf_counter() - start
+    return expression, passes
+
+# original checking algorithm, timed stage by stage; its verdict is the reference for the current checker
+def reference_check(problem, answer, stage_times):
+    start = time.perf_counter()
+    assumptions = {name: parse_expr(assumption) for name, assumption in problem['assumptions']}
+    stage_times['parse_assumptions'] += time.perf_counter() - start
+    start = time.perf_counter()
+    try:
+        answer_expression = parse_expr(answer, assumptions)
+    except Exception:
+        stage_times['parse_answer'] += time.perf_counter() - start
+        return UNPARSEABLE, 0
+    stage_times['parse_answer'] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    problem_expression = parse_expr(problem['representation'], assumptions, evaluate=False)
+    stage_times['parse_problem'] += time.perf_counter() - start
+    if problem_expression == answer_expression:
+        return MATCHES_PROBLEM, 0
+    if problem['expression_type'] in ('derivative', 'integral'):
+        start = time.perf_counter()
+        problem_expression = problem_expression.doit()
+        stage_times['doit'] += time.perf_counter() - start
+
+    # cost of numeric pre-check current checker runs at this point, see equivalence.py
+    start = time.perf_counter()
+    numerically_equivalent(problem_expression, answer_expression, 6)
+    stage_times['numeric_check'] += time.perf_counter() - start
+
+    difference, simplify_passes = simplify_until_fixpoint(problem_expression - answer_expression, stage_times)
+    if difference == 0:
+        return CORRECT, simplify_passes
+    for solution in problem['solutions']:
+        start = time.perf_counter()
+        solution_expression = parse_expr(solution, assumptions)
+        stage_times['parse_solutions'] += time.perf_counter() - start
+        difference, passes = simplify_until_fixpoint(solution_expression - answer_expression, stage_times)
+        simplify_passes += passes
+        if difference == 0:
+            return CORRECT, simplify_passes
+    return INCORRECT, simplify_passes
+
+# measure one answer in a child process and send results back through connection
+def measure(connection, problem, answer, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    stage_times = defaultdict(float)
+    start = time.perf_counter()
+    reference_verdict, simplify_passes = reference_check(problem, answer, stage_times)
+    # numeric check is only timed to show its cost, original algorithm didn't have it
+    reference_seconds = time.perf_counter() - start - stage_times['numeric_check']
+
+    start = time.perf_counter()
+    problem_id = problem.get('id', 0)
+    verdict = check_answer(problem_id, problem['expression_type'], answer, problem['assumptions'], (problem['representation'], None),
+        [(solution, None) for solution in problem['solutions']], 6)
+    checker_seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    connection.send({
+        'reference_verdict': reference_verdict,
+        'verdict': verdict,
+        'reference_seconds': reference_seconds,
+        'checker_seconds': checker_seconds,
+        'simplify_passes': simplify_passes,
+        'stage_seconds': dict(stage_times),
+        'peak_memory_bytes': peak_memory,
+    })
+
+def run_case(context, problem, answer, timeout, trace_memory):
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(sender, problem, answer, trace_memory))
+    process.start()
+    sender.close()
+    result = receiver.recv() if receiver.poll(timeout) else None
+    if process.is_alive():
+        process.terminate()
+    process.join()
+    return result
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Benchmark symbolic answer checking')
+    parser.add_argument('--database-url', help='read real problems from problem_info/problem_info_sympy instead of generating them')
+    parser.add_argument('--problems', type=int, default=30, help='number of generated problems')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--budget', type=float, default=1.0, help='seconds a single check may take before it is flagged')
+    parser.add_argument('--timeout', type=float, default=20.0, help='seconds before a check is killed')
+    parser.add_argument('--no-adversarial', action='store_true', help='skip adversarial answers')
+    parser.add_argument('--memory', action='store_true', help='track peak python memory per check (slows checks down)')
+    parser.add_argument('--output', help='where to write results (default: benchmarks/results/checker-<timestamp>.json)')
+    parser.add_argument('--compare-verdicts', help='previous results file whose verdicts must match')
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    problems = load_problems(options.database_url) if options.database_url else generate_problems(options.problems, options.seed)
+    context = multiprocessing.get_context('fork')
+
+    cases = []
+    for index, problem in enumerate(problems):
+        answers = [('correct', answer) for answer in problem['correct_answers']] + [('incorrect', answer) for answer in problem['incorrect_answers']]
+        if not options.no_adversarial:
+            answers += [('adversarial', answer) for answer in ADVERSARIAL_ANSWERS]
+        for kind, answer in answers:
+            result = run_case(context, problem, answer, options.timeout, options.memory)
+            cases.append({'problem': problem.get('id', index + 1), 'expression_type': problem['expression_type'], 'kind': kind, 'answer': answer, 'result': result})
+
+    # per problem type and answer kind: median/p95 time of current checker and original algorithm, mean simplify passes
+    groups = defaultdict(list)
+    for case in cases:
+        groups[(case['expression_type'], case['kind'])].append(case)
+    print(f'{"type":16} {"answers":12} {"checks":>6} {"timeouts":>8} {"checker p50":>12} {"checker p95":>12} {"original p50":>13} {"simplify passes":>16}')
+    for (expression_type, kind), group in sorted(groups.items()):
+        finished = [case['result'] for case in group if case['result'] is not None]
+        checker_times = sorted(result['checker_seconds'] for result in finished) or [float('nan')]
+        reference_times = sorted(result['reference_seconds'] for result in finished) or [float('nan')]
+        passes = statistics.mean(result['simplify_passes'] for result in finished) if finished else float('nan')
+        print(f'{expression_type:16} {kind:12} {len(group):6} {len(group) - len(finished):8} {statistics.median(checker_times) * 1000:10.1f}ms '
+            f'{checker_times[int(0.95 * (len(checker_times) - 1))] * 1000:10.1f}ms {statistics.median(reference_times) * 1000:11.1f}ms {passes:16.2f}')
+
+    stage_totals = defaultdict(float)
+    for case in cases:
+        if case['result'] is not None:
+            for stage, seconds in case['result']['stage_seconds'].items():
+                stage_totals[stage] += seconds
+    print('time per stage of original algorithm: ' + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in sorted(stage_totals.items(), key=lambda item: -item[1])))
+
+    over_budget = [case for case in cases if case['result'] is None or max(case['result']['checker_seconds'], case['result']['reference_seconds']) > options.budget]
+    for case in over_budget:
+        duration = 'timed out' if case['result'] is None else f'checker {case["result"]["checker_seconds"]:.2f}s, original {case["result"]["reference_seconds"]:.2f}s'
+        print(f'over budget: problem {case["problem"]} ({case["expression_type"]}) {case["kind"]} answer {case["answer"][:40]!r}: {duration}')
+
+    # adversarial answers only need to stay bounded, for the rest current checker must agree with the original algorithm
+    mismatches = [case for case in cases if case['result'] is not None and case['kind'] != 'adversarial'
+        and case['result']['verdict'] != case['result']['reference_verdict']]
+    for case in mismatches:
+        print(f'verdict changed: problem {case["problem"]} answer {case["answer"]!r}: original {case["result"]["reference_verdict"]}, checker {case["result"]["verdict"]}')
+
+    if options.compare_verdicts:
+        with open(options.compare_verdicts) as previous_file:
+            previous = {(case['problem'], case['answer']): case['result'] for case in json.load(previous_file)['cases']}
+        for case in cases:
+            previous_result = previous.get((case['problem'], case['answer']))
+            if previous_result is not None and case['result'] is not None and previous_result['verdict'] != case['result']['verdict']:
+                mismatches.append(case)
+                print(f'verdict differs from previous run: problem {case["problem"]} answer {case["answer"]!r}: {previous_result["verdict"]} -> {case["result"]["verdict"]}')
+
+    output = options.output or os.path.join(RESULTS_DIRECTORY, 'checker-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'budget_seconds': options.budget, 'cases': cases}, output_file, indent=2)
+    print(f'results written to {output}')
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import random
+from sympy import Symbol, Integer, Derivative, Integral, sin, cos, exp, log, latex, expand, factor
+
+# answers that are expensive or impossible to check, used to make sure the checker stays bounded
+ADVERSARIAL_ANSWERS = [
+    '9**9**9**9',
+    'x**(10**8) - x**(10**8)',
+    'sin(' * 40 + 'x' + ')' * 40,
+    '(' * 200 + 'x' + ')' * 200,
+    '((x+1)**60).expand()',
+    '2*x +',
+]
+
+# generate reproducible problems in the same shape as problem_info/problem_info_sympy rows
+# each problem also carries answers known to be correct and incorrect for driving the checker
+def generate_problems(count, seed=0):
+    generator = random.Random(seed)
+    x = Symbol('x', real=True)
+    problems = []
+    for index in range(count):
+        a, b, c = (Integer(generator.randint(1, 9)) for _ in range(3))
+        n = Integer(generator.randint(2, 6))
+        expression_type = ('derivative', 'integral', 'simplification')[index % 3]
+        if expression_type == 'derivative':
+            inner = a * x**n + b * sin(c * x) + exp(c * x)
+            problem = Derivative(inner, x)
+            solution = inner.diff(x)
+        elif expression_type == 'integral':
+            inner = a * x**n + b * cos(c * x) + c / x
+            problem = Integral(inner, x)
+            solution = problem.doit()
+        else:
+            problem = (x**2 - a**2) / (x - a) + b * log(exp(c * x))
+            solution = x + a + b * c * x
+        problems.append({
+            'problem_latex': latex(problem),
+            'sample_solution_latex': latex(solution),
+            'assumptions_latex': 'x \\in \\mathbb{R}',
+            'expression_type': expression_type,
+            'representation': str(problem),
+            'solutions': [str(solution)],
+            'assumptions': [('x', "Symbol('x', real=True)")],
+            'correct_answers': list(dict.fromkeys([str(solution), str(expand(solution)), str(factor(solution))])),
+            'incorrect_answers': [str(solution + 1), str(2 * solution), str(solution.subs(x, 2 * x))],
+        })
+    return problems
@@ -0,0 +1,100 @@
+"""Time bulk problem ingestion (`flask ingest-problems`) against a large user base.
+
+Loads a generated corpus (by default 50 problems and 20000 users) into a throwaway Postgres,
+writes --problems new generated problems (plus a few invalid ones) to a jsonl file, and runs
+`flask ingest-problems` on it in a separate process. Checks every valid problem was loaded,
+every invalid one rejected, and every existing user scheduled for each new problem.
+
+    python -m benchmarks.ingest_benchmark
+    python -m benchmarks.ingest_benchmark --database-url postgresql://localhost/empty_db --problems 5000 --users 50000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import psycopg2
+from .corpus import generate_problems
+from .load_test import REPO_ROOT, start_postgres, stop_postgres, load_corpus
+
+# lines that must be rejected by validation
+INVALID_PROBLEMS = [
+    {'problem_latex': 'x', 'sample_solution_latex': 'x', 'expression_type': 'simplification', 'representation': '2*x +', 'solutions': ['2*x']},
+    {'problem_latex': 'x', 'sample_solution_latex': 'x', 'expression_type': 'simplification', 'representation': 'x', 'solutions': ['x'], 'assumptions': [['x', "Symbol('y')"]]},
+    {'problem_latex': 'x', 'expression_type': 'simplification', 'representation': 'x', 'solutions': []},
+]
+
+def write_problems(path, problems):
+    columns = ('problem_latex', 'sample_solution_latex', 'assumptions_latex', 'expression_type', 'representation', 'solutions', 'assumptions')
+    with open(path, 'w') as problems_file:
+        for problem in problems:
+            problems_file.write(json.dumps({column: problem[column] for column in columns if column in problem}) + '\n')
+        problems_file.write('not json\n')
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Time bulk problem ingestion')
+    parser.add_argument('--database-url', help='existing empty database to load corpus into (default: temporary cluster)')
+    parser.add_argument('--problems', type=int, default=2000, help='problems to ingest')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--existing-problems', type=int, default=50)
+    parser.add_argument('--processes', type=int, help='validation processes (default: one per cpu)')
+    parser.add_argument('--offline', action='store_true', help='ingest with --offline (foreign keys dropped during the backfill)')
+    parser.add_argument('--postgres-port', type=int, default=54330)
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    temporary_directory = tempfile.mkdtemp(prefix='math-helper-ingest-')
+    postgres_started = False
+    try:
+        database_url = options.database_url
+        if database_url is None:
+            database_url = start_postgres(temporary_directory, options.postgres_port)
+            postgres_started = True
+        load_corpus(database_url, generate_problems(options.existing_problems), options.users, 0)
+
+        problems_path = os.path.join(temporary_directory, 'problems.jsonl')
+        write_problems(problems_path, generate_problems(options.problems, options.seed) + INVALID_PROBLEMS)
+        command = [sys.executable, '-m', 'flask', 'ingest-problems', problems_path]
+        if options.processes:
+            command += ['--processes', str(options.processes)]
+        if options.offline:
+            command.append('--offline')
+        environment = dict(os.environ, FLASK_APP='wsgi.py', DATABASE_URL=database_url, SECRET='benchmark-secret', FLASK_ENV='development')
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=REPO_ROOT, env=environment, capture_output=True, text=True)
+        seconds = time.perf_counter() - start
+        print(result.stdout + result.stderr, end='')
+        print(f'ingested {options.problems} problems for {options.users} users in {seconds:.1f}s')
+
+        connection = psycopg2.connect(database_url)
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM problem_info;')
+        problem_count = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM interval_calculation_info;')
+        interval_count = cursor.fetchone()[0]
+        connection.close()
+        expected_problems = options.existing_problems + options.problems
+        failures = []
+        if result.returncode != 0:
+            failures.append(f'ingest-problems exited with {result.returncode}')
+        if problem_count != expected_problems:
+            failures.append(f'{problem_count} problems in db, expected {expected_problems}')
+        if interval_count != expected_problems * options.users:
+            failures.append(f'{interval_count} interval rows in db, expected {expected_problems * options.users}')
+        if sum(line.startswith('line ') for line in result.stderr.splitlines()) != len(INVALID_PROBLEMS) + 1:
+            failures.append('not every invalid problem was reported')
+        for failure in failures:
+            print(failure)
+        return 1 if failures else 0
+    finally:
+        if postgres_started:
+            stop_postgres(temporary_directory)
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""HTTP load test for the api.
+
+Boots the app under gunicorn (using gunicorn.conf.py) against a throwaway postgres
+loaded with benchmarks/schema.sql, math_api/util.sql and a generated corpus, drives a
+mix of realistic requests and reports latency percentiles and throughput per endpoint.
+
+    python -m benchmarks.load_test --users 200 --problems 60 --duration 60
+    python -m benchmarks.load_test --database-url postgresql://localhost/bench --compare benchmarks/results/baseline.json
+
+Without --database-url a temporary cluster is created with initdb/pg_ctl (must be on PATH,
+and can't run as root). Results are written to benchmarks/results/ for later comparison.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from werkzeug.security import generate_password_hash
+from math_api.schema import apply_migrations
+from .corpus import generate_problems, ADVERSARIAL_ANSWERS
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+PASSWORD = 'benchmark-password'
+
+# relative weights of each kind of request made by a logged in user after the login storm
+DEFAULT_MIX = {
+    'daily': 20,
+    'solve_correct': 25,
+    'solve_incorrect': 25,
+    'solve_adversarial': 2,
+    'problem_list': 10,
+    'problem_list_anonymous': 8,
+    'problem': 5,
+    'user_statistics': 5,
+}
+
+# start temporary postgres cluster in directory, returns its connection url
+def start_postgres(directory, port):
+    data_directory = os.path.join(directory, 'data')
+    subprocess.run(['initdb', '-D', data_directory, '-U', 'postgres', '--auth=trust'], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(['pg_ctl', '-D', data_directory, '-o', f'-p {port} -k {directory}', '-l', os.path.join(directory, 'postgres.log'), '-w', 'start'],
+        check=True, stdout=subprocess.DEVNULL)
+    return f'postgresql://postgres@localhost:{port}/postgres'
+
+def stop_postgres(directory):
+    subprocess.run(['pg_ctl', '-D', os.path.join(directory, 'data'), '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+
+# create schema (with migrations unless migrate is False) and fill db with problems, users sharing one password, and attempt history
+def load_corpus(database_url, problems, user_count, attempts_per_user, migrate=True):
+    connection = psycopg2.connect(database_url)
+    connection.set_session(autocommit=True)
+    cursor = connection.cursor()
+    for path in (os.path.join(REPO_ROOT, 'benchmarks', 'schema.sql'), os.path.join(REPO_ROOT, 'math_api', 'util.sql')):
+        with open(path) as sql_file:
+            cursor.execute(sql_file.read())
+    if migrate:
+        apply_migrations(cursor)
+
+    # problems have to exist before users, initialize_problem_assignments trigger schedules every problem for new users
+    problem_ids = []
+    for problem in problems:
+        cursor.execute('INSERT INTO problem_info(problem_latex, sample_solution_latex, assumptions_latex, expression_type) VALUES (%s, %s, %s, %s) RETURNING id;',
+            (problem['problem_latex'], problem['sample_solution_latex'], problem['assumptions_latex'], problem['expression_type']))
+        problem_id = cursor.fetchone()[0]
+        problem_ids.append(problem_id)
+        cursor.execute("INSERT INTO problem_info_sympy(problem_id, info_type, representation) VALUES (%s, 'problem', %s);", (problem_id, problem['representation']))
+        for solution in problem['solutions']:
+            cursor.execute("INSERT INTO problem_info_sympy(problem_id, info_type, representation) VALUES (%s, 'sample_solution', %s);", (problem_id, solution))
+        for name, assumption in problem['assumptions']:
+            cursor.execute("INSERT INTO problem_info_sympy(problem_id, info_type, representation, sympy_assumption) VALUES (%s, 'assumption', %s, %s);", (problem_id, name, assumption))
+
+    cursor.execute("INSERT INTO user_info(username, password_hash) SELECT 'bench_user_' || user_number, %s FROM generate_series(1, %s) AS user_number;",
+        (generate_password_hash(PASSWORD), user_count))
+    cursor.execute("INSERT INTO user_attempt_log(user_id, problem_id, response, correct, attempt_date) "
+        "SELECT user_info.id, (%s::int[])[1 + floor(random() * %s)::int], 'x', random() < 0.7, CURRENT_DATE - floor(random() * 365)::int "
+        "FROM user_info, generate_series(1, %s);", (problem_ids, len(problem_ids), attempts_per_user))
+    # once migrated, history older than the partitions created by the migration is moved out of the default partition
+    cursor.execute('call create_attempt_log_partitions(CURRENT_DATE - 365, 2);')
+    cursor.execute('call assign_all_daily_questions();')
+    cursor.close()
+    connection.close()
+    return problem_ids
+
+# run app with the repo's gunicorn config in a separate process group
+def start_app(database_url, port, environment):
+    app_environment = dict(os.environ, DATABASE_URL=database_url, SECRET='benchmark-secret', FLASK_ENV='development', PORT=str(port), **environment)
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'], cwd=REPO_ROOT, env=app_environment, start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('localhost', port, timeout=1)
+            connection.request('GET', '/api/problems/')
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('App did not start within 30 seconds')
+
+# thread-local keep-alive connection to app, one request at a time
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.connection = None
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+        for _ in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection('localhost', self.port, timeout=60)
+            try:
+                start = time.perf_counter()
+                self.connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                return response.status, time.perf_counter() - start, data
+            except (OSError, http.client.HTTPException):
+                self.connection.close()
+                self.connection = None
+        return None, 0.0, b''
+
+# latencies and statuses per endpoint, shared by all load threads
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, status, elapsed):
+        with self._lock:
+            if status is None or status >= 500:
+                self.errors[endpoint] += 1
+            else:
+                self.latencies[endpoint].append(elapsed)
+
+# value at given fraction of sorted latencies, in milliseconds
+def percentile_ms(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))] * 1000
+
+# p50/p95/p99 latency in milliseconds and requests per second for each endpoint
+def summarize(recorder, duration):
+    summary = {}
+    for endpoint in sorted(set(recorder.latencies) | set(recorder.errors)):
+        latencies = sorted(recorder.latencies[endpoint])
+        summary[endpoint] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[endpoint],
+            'requests_per_second': len(latencies) / duration,
+            'p50_ms': percentile_ms(latencies, 0.50),
+            'p95_ms': percentile_ms(latencies, 0.95),
+            'p99_ms': percentile_ms(latencies, 0.99),
+        }
+    return summary
+
+def login(client, recorder, user_number):
+    status, elapsed, data = client.request('POST', '/api/auth/login', {'username': f'bench_user_{user_number}', 'password': PASSWORD})
+    recorder.record('login', status, elapsed)
+    if status != 200:
+        return None
+    body = json.loads(data)
+    return body['id'], body['access_token']
+
+# one simulated user: log in, then keep sending requests picked from mix until deadline
+def simulate_user(port, recorder, user_number, problems, problem_ids, mix, deadline, seed):
+    generator = random.Random(seed)
+    client = Client(port)
+    session = login(client, recorder, user_number)
+    if session is None:
+        return
+    user_id, token = session
+    kinds, weights = zip(*mix.items())
+    while time.monotonic() < deadline:
+        kind = generator.choices(kinds, weights)[0]
+        index = generator.randrange(len(problem_ids))
+        problem, problem_id = problems[index], problem_ids[index]
+        if kind == 'daily':
+            result = client.request('GET', '/api/problems/daily', token=token)
+        elif kind.startswith('solve_'):
+            answers = {'solve_correct': problem['correct_answers'], 'solve_incorrect': problem['incorrect_answers'], 'solve_adversarial': ADVERSARIAL_ANSWERS}[kind]
+            result = client.request('POST', f'/api/problems/solve/{problem_id}', {'answer': generator.choice(answers)}, token=token)
+        elif kind == 'problem_list':
+            result = client.request('GET', '/api/problems/', token=token)
+        elif kind == 'problem_list_anonymous':
+            result = client.request('GET', '/api/problems/')
+        elif kind == 'problem':
+            result = client.request('GET', f'/api/problems/{problem_id}', token=token)
+        else:
+            result = client.request('GET', f'/api/users/{user_id}', token=token)
+        recorder.record(kind, result[0], result[1])
+
+# flag endpoints whose p95 grew more than tolerance relative to previous results
+def compare(summary, baseline_path, tolerance):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['endpoints']
+    regressions = []
+    for endpoint, current in summary.items():
+        previous = baseline.get(endpoint)
+        if previous is None or not previous['p95_ms'] or current['p95_ms'] is None:
+            continue
+        ratio = current['p95_ms'] / previous['p95_ms']
+        print(f'{endpoint:24} p95 {previous["p95_ms"]:9.1f}ms -> {current["p95_ms"]:9.1f}ms ({ratio:5.2f}x)')
+        if ratio > 1 + tolerance:
+            regressions.append(endpoint)
+    return regressions
+
+def print_summary(summary):
+    print(f'{"endpoint":24} {"requests":>9} {"errors":>7} {"req/s":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for endpoint, row in summary.items():
+        latencies = ' '.join(f'{row[key]:9.1f}' if row[key] is not None else f'{"-":>9}' for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+        print(f'{endpoint:24} {row["requests"]:9} {row["errors"]:7} {row["requests_per_second"]:8.1f} {latencies}')
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Load test the math helper api')
+    parser.add_argument('--database-url', help='existing empty database to load corpus into (default: temporary cluster)')
+    parser.add_argument('--skip-load', action='store_true', help='database already holds a corpus generated with the same --problems/--seed')
+    parser.add_argument('--problems', type=int, default=60)
+    parser.add_argument('--users', type=int, default=100, help='simulated users, all of which log in at once at the start')
+    parser.add_argument('--attempts-per-user', type=int, default=200, help='historical attempts generated per user')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run request mix after login storm')
+    parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX, help='json object of request kind -> weight')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--postgres-port', type=int, default=55432)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for the app, e.g. ANSWER_CHECK_PROCESSES=4')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='where to write results (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='previous results file to compare p95 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 growth before --compare reports a regression')
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    temporary_directory = None
+    server = None
+    try:
+        database_url = options.database_url
+        if database_url is None:
+            temporary_directory = tempfile.mkdtemp(prefix='math-helper-bench-')
+            database_url = start_postgres(temporary_directory, options.postgres_port)
+
+        problems = generate_problems(options.problems, options.seed)
+        if options.skip_load:
+            connection = psycopg2.connect(database_url)
+            cursor = connection.cursor()
+            cursor.execute('SELECT id FROM problem_info ORDER BY id;')
+            problem_ids = [row[0] for row in cursor.fetchall()][:len(problems)]
+            connection.close()
+        else:
+            problem_ids = load_corpus(database_url, problems, options.users, options.attempts_per_user)
+
+        environment = dict(setting.split('=', 1) for setting in options.env)
+        server = start_app(database_url, options.port, environment)
+
+        recorder = Recorder()
+        start = time.monotonic()
+        deadline = start + options.duration
+        with ThreadPoolExecutor(max_workers=options.users) as executor:
+            for user_number in range(1, options.users + 1):
+                executor.submit(simulate_user, options.port, recorder, user_number, problems, problem_ids, options.mix, deadline, options.seed + user_number)
+        duration = time.monotonic() - start
+
+        summary = summarize(recorder, duration)
+        print_summary(summary)
+        results = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'options': {key: value for key, value in vars(options).items() if key not in ('database_url', 'output', 'compare')},
+            'duration_seconds': duration,
+            'endpoints': summary,
+        }
+        output = options.output or os.path.join(RESULTS_DIRECTORY, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f'results written to {output}')
+
+        if options.compare:
+            regressions = compare(summary, options.compare, options.tolerance)
+            if regressions:
+                print(f'p95 regressions: {", ".join(regressions)}')
+                return 1
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+        if temporary_directory is not None:
+            stop_postgres(temporary_directory)
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
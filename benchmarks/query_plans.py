@@ -0,0 +1,65 @@
+"""Check that hot queries use the indexes from math_api/migrations at realistic data volumes.
+
+Loads a generated corpus (by default 600 problems and 300 users, so 180k scheduling rows) into a
+throwaway Postgres without migrations, EXPLAINs the hot queries listed in math_api/schema.py,
+applies the migrations and EXPLAINs them again. Exits with an error if, after migrating, any hot
+query still reads one of its tables without an index.
+
+    python -m benchmarks.query_plans
+    python -m benchmarks.query_plans --database-url postgresql://localhost/empty_db --users 1000
+"""
+import sys
+import shutil
+import argparse
+import tempfile
+import psycopg2
+from math_api.schema import apply_migrations, check_query_plans
+from .corpus import generate_problems
+from .load_test import start_postgres, stop_postgres, load_corpus
+
+ANALYZED_TABLES = 'daily_assignment, interval_calculation_info, user_attempt_log, problem_info, problem_info_sympy'
+
+def print_plans(title, results):
+    print(title)
+    for name, scans, unindexed in results:
+        reads = ', '.join(f'{relation} ({index or node_type})' for relation, node_type, index in scans)
+        print(f'  {"FAIL" if unindexed else "ok  "} {name}: {reads}')
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Check hot query plans before and after migrations')
+    parser.add_argument('--database-url', help='existing empty database to load corpus into (default: temporary cluster)')
+    parser.add_argument('--problems', type=int, default=600)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--attempts-per-user', type=int, default=100)
+    parser.add_argument('--postgres-port', type=int, default=54329)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    temporary_directory = None
+    try:
+        database_url = options.database_url
+        if database_url is None:
+            temporary_directory = tempfile.mkdtemp(prefix='math-helper-plans-')
+            database_url = start_postgres(temporary_directory, options.postgres_port)
+        load_corpus(database_url, generate_problems(options.problems, options.seed), options.users, options.attempts_per_user, migrate=False)
+
+        connection = psycopg2.connect(database_url)
+        connection.set_session(autocommit=True)
+        cursor = connection.cursor()
+        cursor.execute(f'ANALYZE {ANALYZED_TABLES};')
+        print_plans('before migrations:', check_query_plans(cursor))
+        apply_migrations(cursor)
+        cursor.execute(f'ANALYZE {ANALYZED_TABLES};')
+        results = check_query_plans(cursor)
+        print_plans('after migrations:', results)
+        connection.close()
+        return 1 if any(unindexed for _, _, unindexed in results) else 0
+    finally:
+        if temporary_directory is not None:
+            stop_postgres(temporary_directory)
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Check the NumPy scheduling rules in math_api/forecast.py against the SQL ones, and time a forecast.
+
+Loads a generated corpus (by default 40 problems and 200 users) into a throwaway Postgres and
+replays --days days on both sides: each day the SQL procedures/triggers of math_api/util.sql
+(assign_all_daily_questions, schedule_next_assignment) and SchedulingState get the same
+random attempts, including wrong answers, retries and attempts at unassigned problems.
+After every day interval_calculation_info and daily_assignment must match the arrays exactly.
+Time moves forward in the db by shifting every stored date back a day, since the SQL rules
+use CURRENT_DATE.
+
+Then forecasts --forecast-days days for a synthetic schedule of --speed-users users x
+--speed-problems problems, to check it stays within seconds for millions of rows.
+
+    python -m benchmarks.scheduling_check
+    python -m benchmarks.scheduling_check --database-url postgresql://localhost/empty_db --days 120
+"""
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy
+import psycopg2
+from psycopg2.extras import execute_values
+from math_api.forecast import SchedulingState, UserBehaviour, load_scheduling_state, estimate_behaviour, forecast_load
+from .corpus import generate_problems
+from .load_test import start_postgres, stop_postgres, load_corpus
+
+# move every date in the db one day into the past, so CURRENT_DATE is the next day for the schedule, and roll over assignments
+# separate statements, the procedure commits and so can't run inside the implicit transaction of a multi-statement query
+# attempts moving to the previous month's partition are reinserted there, so triggers are off while they move
+ADVANCE_DAY = [
+    'UPDATE interval_calculation_info SET earliest_calculated_due_date = earliest_calculated_due_date - 1;',
+    'UPDATE daily_assignment SET date = date - 1;',
+    'SET session_replication_role = replica;',
+    'UPDATE user_attempt_log SET attempt_date = attempt_date - 1;',
+    'SET session_replication_role = DEFAULT;',
+    'call assign_all_daily_questions();',
+]
+
+# names of arrays that differ between two states, comparing day of expected with day 0 of actual
+def differences(expected, actual, day):
+    compared = {
+        'user_ids': (expected.user_ids, actual.user_ids),
+        'problem_ids': (expected.problem_ids, actual.problem_ids),
+        'correct_streaks': (expected.correct_streaks, actual.correct_streaks),
+        'last_graduated_intervals': (expected.last_graduated_intervals, actual.last_graduated_intervals),
+        'due_days': (expected.due_days - day, actual.due_days),
+        'assigned': (expected.assigned_day == day, actual.assigned_day == 0),
+        'solved': (expected.solved & (expected.assigned_day == day), actual.solved & (actual.assigned_day == 0)),
+    }
+    return [name for name, (expected_values, actual_values) in compared.items() if expected_values.shape != actual_values.shape or (expected_values != actual_values).any()]
+
+def check_against_sql(database_url, options):
+    load_corpus(database_url, generate_problems(options.problems), options.users, 0)
+    connection = psycopg2.connect(database_url)
+    connection.set_session(autocommit=True)
+    cursor = connection.cursor()
+    generator = numpy.random.default_rng(options.seed)
+    state = load_scheduling_state(cursor)
+    attempt_count = 0
+    for day in range(options.days):
+        if day > 0:
+            for statement in ADVANCE_DAY:
+                cursor.execute(statement)
+            state.assign(day)
+        # most assigned problems are attempted (solved ones too, which must not change anything),
+        # some again after the first attempt, plus a few problems that aren't assigned today
+        assigned_rows = numpy.flatnonzero(state.assigned_day == day)
+        attempted_rows = assigned_rows[generator.random(len(assigned_rows)) < 0.7]
+        rows = numpy.concatenate([attempted_rows, attempted_rows[generator.random(len(attempted_rows)) < 0.3],
+            generator.integers(0, len(state.user_ids), len(attempted_rows) // 10 + 1)])
+        generator.shuffle(rows)
+        correct = generator.random(len(rows)) < 0.6
+        execute_values(cursor, 'INSERT INTO user_attempt_log(user_id, problem_id, response, correct, attempt_date) VALUES %s;',
+            [(int(state.user_ids[row]), int(state.problem_ids[row]), 'x', bool(is_correct)) for row, is_correct in zip(rows, correct)],
+            template='(%s, %s, %s, %s, CURRENT_DATE)', page_size=len(rows))
+        state.apply_attempts(day, rows, correct)
+        attempt_count += len(rows)
+
+        different = differences(state, load_scheduling_state(cursor), day)
+        if different:
+            print(f'day {day}: numpy and sql schedules differ in {", ".join(different)}')
+            return False
+    print(f'numpy and sql schedules matched for {options.days} days, {len(state.user_ids)} rows, {attempt_count} attempts')
+
+    behaviour = estimate_behaviour(cursor, state, options.days)
+    print(f'estimated from replayed attempts: {behaviour.active_probabilities.mean():.0%} of users active a day, '
+        f'{behaviour.first_correct:.0%} of first attempts correct, {behaviour.retry:.0%} of wrong answers retried')
+    connection.close()
+    return True
+
+def time_forecast(options):
+    generator = numpy.random.default_rng(options.seed)
+    users = numpy.repeat(numpy.arange(1, options.speed_users + 1), options.speed_problems)
+    problems = numpy.tile(numpy.arange(1, options.speed_problems + 1), options.speed_users)
+    streaks = generator.integers(0, 7, len(users))
+    state = SchedulingState(users, problems, streaks, numpy.where(streaks > 2, 2 ** numpy.minimum(streaks, 8), 0), generator.integers(-5, 30, len(users)))
+    behaviour = UserBehaviour(numpy.full(options.speed_users, 0.6), 0.7, 0.5, 0.8, 3)
+    start = time.perf_counter()
+    forecast = forecast_load(state, behaviour, options.forecast_days)
+    seconds = time.perf_counter() - start
+    print(f'forecast {options.forecast_days} days for {len(users)} rows in {seconds:.1f}s '
+        f'(day 1: {forecast[0]["assigned"]:.0f} assigned, {forecast[0]["attempts"]:.0f} answer checks)')
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Check numpy scheduling rules against sql and time a forecast')
+    parser.add_argument('--database-url', help='existing empty database to load corpus into (default: temporary cluster)')
+    parser.add_argument('--problems', type=int, default=40)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--days', type=int, default=60, help='days replayed on both sides')
+    parser.add_argument('--speed-users', type=int, default=50000)
+    parser.add_argument('--speed-problems', type=int, default=40)
+    parser.add_argument('--forecast-days', type=int, default=30)
+    parser.add_argument('--postgres-port', type=int, default=54331)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    temporary_directory = None
+    try:
+        database_url = options.database_url
+        if database_url is None:
+            temporary_directory = tempfile.mkdtemp(prefix='math-helper-scheduling-')
+            database_url = start_postgres(temporary_directory, options.postgres_port)
+        matched = check_against_sql(database_url, options)
+        time_forecast(options)
+        return 0 if matched else 1
+    finally:
+        if temporary_directory is not None:
+            stop_postgres(temporary_directory)
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
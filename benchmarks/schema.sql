@@ -0,0 +1,49 @@
+-- base tables used by the api, for throwaway benchmark databases
+-- math_api/util.sql is loaded after this for procedures, triggers and derived tables
+
+CREATE TABLE IF NOT EXISTS user_info (
+  id serial PRIMARY KEY,
+  username text NOT NULL UNIQUE,
+  password_hash text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS problem_info (
+  id serial PRIMARY KEY,
+  problem_latex text NOT NULL,
+  sample_solution_latex text NOT NULL,
+  assumptions_latex text,
+  expression_type text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS problem_info_sympy (
+  id serial PRIMARY KEY,
+  problem_id int NOT NULL REFERENCES problem_info(id),
+  info_type text NOT NULL,
+  representation text NOT NULL,
+  sympy_assumption text
+);
+
+CREATE TABLE IF NOT EXISTS interval_calculation_info (
+  problem_id int NOT NULL REFERENCES problem_info(id),
+  user_id int NOT NULL REFERENCES user_info(id),
+  correct_streak int NOT NULL DEFAULT 0,
+  last_graduated_interval int,
+  earliest_calculated_due_date date NOT NULL,
+  PRIMARY KEY (user_id, problem_id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_assignment (
+  problem_id int NOT NULL REFERENCES problem_info(id),
+  user_id int NOT NULL REFERENCES user_info(id),
+  date date NOT NULL,
+  solved boolean NOT NULL DEFAULT false
+);
+
+CREATE TABLE IF NOT EXISTS user_attempt_log (
+  id serial PRIMARY KEY,
+  user_id int NOT NULL REFERENCES user_info(id),
+  problem_id int NOT NULL REFERENCES problem_info(id),
+  response text NOT NULL,
+  correct boolean NOT NULL,
+  attempt_date date NOT NULL
+);
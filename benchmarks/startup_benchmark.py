@@ -0,0 +1,132 @@
+"""Cold start budget for the app.
+
+Measures, each in fresh processes and repeated --runs times:
+- import: importing wsgi.py (create_app) in a new interpreter, and whether that imported sympy/mpmath
+- cli: `flask --help`, which loads the app like any `flask init-db`/`flask precompute-problems` call
+- boot: starting gunicorn with gunicorn.conf.py (one worker) until it answers a request
+
+and fails (exit code 1) if the median of any of them is over its budget, or if creating the app
+imports sympy when answers are checked in separate processes (it should only be loaded on first use).
+
+    python -m benchmarks.startup_benchmark
+    python -m benchmarks.startup_benchmark --import-budget 0.3 --env GUNICORN_PRELOAD=false
+
+No database is needed: nothing connects to it during startup unless EXPRESSION_CACHE_WARM is set
+with ANSWER_CHECK_PROCESSES=0.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import http.client
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+# run in a fresh interpreter: time create_app and report which heavy modules it loaded
+IMPORT_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import wsgi
+seconds = time.perf_counter() - start
+# lazily imported modules are put in sys.modules right away, their submodules only once they are really loaded
+print(json.dumps({'seconds': seconds, 'sympy_loaded': 'sympy.core' in sys.modules, 'mpmath_loaded': 'mpmath.ctx_base' in sys.modules}))
+'''
+
+def app_environment(extra_environment):
+    environment = dict(os.environ, **extra_environment)
+    environment.setdefault('SECRET', 'benchmark-secret')
+    environment.setdefault('DATABASE_URL', 'postgresql://localhost/unused')
+    environment.setdefault('FLASK_ENV', 'development')
+    return environment
+
+def measure_import(environment):
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=REPO_ROOT, env=environment, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def measure_cli(environment):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'flask', '--help'], cwd=REPO_ROOT, env=dict(environment, FLASK_APP='wsgi.py'), check=True, capture_output=True)
+    return time.perf_counter() - start
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+# seconds from starting gunicorn until its worker answers /metrics (served without touching the db)
+def measure_boot(environment, timeout):
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'], cwd=REPO_ROOT,
+        env=dict(environment, PORT=str(port), WEB_CONCURRENCY='1'), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                connection = http.client.HTTPConnection('localhost', port, timeout=1)
+                connection.request('GET', '/metrics')
+                connection.getresponse().read()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Measure app cold start against a time budget')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes started per measurement')
+    parser.add_argument('--import-budget', type=float, default=0.5, help='seconds create_app may take')
+    parser.add_argument('--cli-budget', type=float, default=1.5, help='seconds `flask --help` may take')
+    parser.add_argument('--boot-budget', type=float, default=3.0, help='seconds gunicorn may take to answer its first request')
+    parser.add_argument('--no-boot', action='store_true', help='skip gunicorn boot measurement')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for the app, e.g. ANSWER_CHECK_PROCESSES=0')
+    parser.add_argument('--output', help='where to write results (default: benchmarks/results/startup-<timestamp>.json)')
+    return parser.parse_args(arguments)
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+    environment = app_environment(dict(variable.split('=', 1) for variable in options.env))
+
+    imports = [measure_import(environment) for _ in range(options.runs)]
+    results = {
+        'import': statistics.median(result['seconds'] for result in imports),
+        'cli': statistics.median(measure_cli(environment) for _ in range(options.runs)),
+    }
+    budgets = {'import': options.import_budget, 'cli': options.cli_budget}
+    if not options.no_boot:
+        boots = [measure_boot(environment, options.boot_budget * 5) for _ in range(options.runs)]
+        results['boot'] = None if None in boots else statistics.median(boots)
+        budgets['boot'] = options.boot_budget
+
+    failures = []
+    for name, seconds in results.items():
+        over_budget = seconds is None or seconds > budgets[name]
+        print(f'{name:8} {"did not start" if seconds is None else f"{seconds * 1000:8.1f}ms"}   budget {budgets[name] * 1000:8.1f}ms{"   OVER BUDGET" if over_budget else ""}')
+        if over_budget:
+            failures.append(name)
+
+    # sympy is only needed in the app itself when answers are checked inline, see lazy_imports.py
+    heavy_modules = [name for name in ('sympy', 'mpmath') if imports[0][f'{name}_loaded']]
+    inline_checks = int(environment.get('ANSWER_CHECK_PROCESSES', 2)) <= 0
+    print(f'modules loaded by create_app: {", ".join(heavy_modules) or "no sympy/mpmath"}')
+    if heavy_modules and not inline_checks:
+        failures.append('lazy imports')
+        print('create_app imported ' + ', '.join(heavy_modules) + ' even though answers are checked in separate processes')
+
+    output = options.output or os.path.join(RESULTS_DIRECTORY, 'startup-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'environment': options.env, 'seconds': results,
+            'budget_seconds': budgets, 'heavy_modules_loaded': heavy_modules}, output_file, indent=2)
+    print(f'results written to {output}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import os
+
+# gunicorn reads this file automatically when started from the repo root (see Procfile)
+
+# number of worker processes, heroku sets WEB_CONCURRENCY based on dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# threaded workers serve many I/O bound requests (catalog, daily, stats) at once per process
+# db access is thread safe since each request borrows its own connection from the worker's pool (see db.py)
+# and cpu heavy answer checking runs in separate processes (see checker.py), so it doesn't hold up other threads
+# set GUNICORN_WORKER_CLASS=sync to go back to one request per worker
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# keep DB_POOL_MAX_SIZE at least as large as threads, otherwise threads wait on each other for connections
+# checked in a server hook since gunicorn's error log is only set up after this file is read
+def on_starting(server):
+    if int(os.environ.get('DB_POOL_MAX_SIZE', 10)) < threads:
+        server.log.warning('DB_POOL_MAX_SIZE is smaller than GUNICORN_THREADS (%s), requests may wait for db connections', threads)
+
+# load app once in the master and fork workers from it, so workers start without importing anything
+# and share the master's memory pages for modules, config and (with EXPRESSION_CACHE_WARM and inline checking,
+# ANSWER_CHECK_PROCESSES=0) parsed problems
+# per process state (db pool, checking processes, background threads) is created lazily in each worker after the fork
+# set GUNICORN_PRELOAD=false to load the app separately in each worker, e.g. for gunicorn --reload
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# bind to port given by heroku
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
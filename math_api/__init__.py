@@ -1,19 +1,31 @@
 import os
 
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 from dotenv import load_dotenv
-from .db import init_app as initialize_db_for_app
+from .instrumentation import init_app as initialize_instrumentation_for_app
+from .db import init_app as initialize_db_for_app, close_pool, PoolTimeout
 from .auth import jwt, auth_blueprint, token_parse_error, generate_error_handler
-from .problems import problems_blueprint
-from .users import user_info_blueprint
+from .expression_cache import init_app as initialize_expression_cache_for_app
+from .checker import init_app as initialize_checker_for_app, CheckerBusy
+from .verdicts import init_app as initialize_verdicts_for_app
+from .catalog import init_app as initialize_catalog_for_app
+from .attempt_log import init_app as initialize_attempt_log_for_app
+from .problems import problems_blueprint, warm_expression_cache, precompute_problems_command, seed_verdicts_command, assign_daily_problems_command
+from .users import user_info_blueprint, rebuild_statistics_command
+from .lazy_imports import load_now
+from .schema import migrate_db_command, migration_status_command, check_query_plans_command
+from .ingest import ingest_problems_command
+from .forecast import forecast_load_command
+from .attempt_archive import archive_attempt_log_command
+from .static_files import init_app as initialize_static_files_for_app, send_frontend_file
 from jwt.exceptions import DecodeError
 from datetime import timedelta
 
 # application factory for app that loads libraries and url handlers
 def create_app():
-    # initialize Flask app and point app to front end build
-    app = Flask(__name__, static_folder='../build', static_url_path='/')
+    # initialize Flask app, front end build is served by static_files.py
+    app = Flask(__name__, static_folder=None)
 
     # load environment variables into os.environ 
     # read from .env in development, heroku config vars in productions
@@ -31,42 +43,161 @@ def create_app():
     app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=1)
     app.config["JWT_REFRESH_TOKEN_EXPIRES"] = timedelta(days=30)
     app.config["TOKEN_EXPIRES_MILLISECONDS"] = 3600000
+    # user is rebuilt from token claims, db is only checked every USER_CHECK_TTL seconds to catch deleted users (0 never checks)
+    app.config["USER_CHECK_TTL"] = int(os.environ.get('USER_CHECK_TTL', 60))
+    # password hashing parameters, hashes made with other parameters are replaced on the user's next login
+    app.config["PASSWORD_HASH_METHOD"] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    app.config["PASSWORD_SALT_LENGTH"] = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+    # number of threads per worker that hash passwords
+    app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+    # size of each worker's db connection pool and how many seconds a request waits for a free connection
+    app.config["DB_POOL_MIN_SIZE"] = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+    app.config["DB_POOL_MAX_SIZE"] = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+    app.config["DB_POOL_CHECKOUT_TIMEOUT"] = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', 5))
+    # max number of parsed sympy objects kept per worker, and whether to parse every problem at startup
+    # (only used when answers are checked inline, ANSWER_CHECK_PROCESSES=0)
+    app.config["EXPRESSION_CACHE_SIZE"] = int(os.environ.get('EXPRESSION_CACHE_SIZE', 4096))
+    app.config["EXPRESSION_CACHE_WARM"] = os.environ.get('EXPRESSION_CACHE_WARM', 'false').lower() == 'true'
+    # number of random points answers are evaluated at before symbolic simplification, 0 disables numeric check
+    app.config["NUMERIC_CHECK_POINTS"] = int(os.environ.get('NUMERIC_CHECK_POINTS', 6))
+    # answers are checked in a pool of separate processes (0 checks inline in the request thread)
+    # a check is killed after ANSWER_CHECK_TIMEOUT seconds, and processes are replaced after a number of checks or memory growth
+    app.config["ANSWER_CHECK_PROCESSES"] = int(os.environ.get('ANSWER_CHECK_PROCESSES', 2))
+    app.config["ANSWER_CHECK_TIMEOUT"] = float(os.environ.get('ANSWER_CHECK_TIMEOUT', 10))
+    app.config["ANSWER_CHECK_WAIT_TIMEOUT"] = float(os.environ.get('ANSWER_CHECK_WAIT_TIMEOUT', 10))
+    app.config["ANSWER_CHECK_MAX_CHECKS"] = int(os.environ.get('ANSWER_CHECK_MAX_CHECKS', 500))
+    app.config["ANSWER_CHECK_MAX_MEMORY_MB"] = int(os.environ.get('ANSWER_CHECK_MAX_MEMORY_MB', 512))
+    # verdicts of answers already checked are remembered per worker for VERDICT_CACHE_TTL seconds
+    # and, if VERDICT_CACHE_SHARED is set, in the answer_verdict table shared by all workers
+    app.config["VERDICT_CACHE_SIZE"] = int(os.environ.get('VERDICT_CACHE_SIZE', 100000))
+    app.config["VERDICT_CACHE_TTL"] = int(os.environ.get('VERDICT_CACHE_TTL', 86400))
+    app.config["VERDICT_CACHE_SHARED"] = os.environ.get('VERDICT_CACHE_SHARED', 'false').lower() == 'true'
+    # anonymous problem listings are served from a snapshot reloaded every CATALOG_CACHE_TTL seconds, or once
+    # problem_info has changed (checked every CATALOG_VERSION_CHECK_INTERVAL seconds)
+    # and may be cached by browsers/proxies for CATALOG_MAX_AGE seconds before revalidating with their etag
+    app.config["CATALOG_CACHE_TTL"] = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+    app.config["CATALOG_VERSION_CHECK_INTERVAL"] = float(os.environ.get('CATALOG_VERSION_CHECK_INTERVAL', 2))
+    app.config["CATALOG_MAX_AGE"] = int(os.environ.get('CATALOG_MAX_AGE', 60))
+    # largest page of problems a client can ask for with ?limit=, and how many problems
+    # are read from the db at a time when streaming an unpaginated listing
+    app.config["PROBLEM_PAGE_MAX_SIZE"] = int(os.environ.get('PROBLEM_PAGE_MAX_SIZE', 500))
+    app.config["PROBLEM_STREAM_BATCH_SIZE"] = int(os.environ.get('PROBLEM_STREAM_BATCH_SIZE', 500))
+    # most answers /api/problems/solve/batch accepts in one request, one day's assignment (at most 10 problems, see util.sql)
+    # so a batch of answers that all hit CHECK_TIMEOUT can't hold the checking processes much longer than a day of single solves
+    app.config["PROBLEM_SOLVE_BATCH_MAX_SIZE"] = int(os.environ.get('PROBLEM_SOLVE_BATCH_MAX_SIZE', 10))
+    # when ATTEMPT_LOG_ASYNC is set, attempts are queued and inserted in batches by a background thread
+    # (falling back to a synchronous insert when the queue is full), so /solve doesn't wait on the insert and its triggers
+    app.config["ATTEMPT_LOG_ASYNC"] = os.environ.get('ATTEMPT_LOG_ASYNC', 'false').lower() == 'true'
+    app.config["ATTEMPT_LOG_QUEUE_SIZE"] = int(os.environ.get('ATTEMPT_LOG_QUEUE_SIZE', 10000))
+    app.config["ATTEMPT_LOG_BATCH_SIZE"] = int(os.environ.get('ATTEMPT_LOG_BATCH_SIZE', 500))
+    app.config["ATTEMPT_LOG_FLUSH_INTERVAL"] = float(os.environ.get('ATTEMPT_LOG_FLUSH_INTERVAL', 0.5))
+    # attempt log is partitioned by month, `flask archive-attempt-log` keeps the current month and ATTEMPT_LOG_RETENTION_MONTHS
+    # before it, and writes older months to compressed files in ATTEMPT_LOG_ARCHIVE_DIRECTORY
+    app.config["ATTEMPT_LOG_RETENTION_MONTHS"] = int(os.environ.get('ATTEMPT_LOG_RETENTION_MONTHS', 12))
+    app.config["ATTEMPT_LOG_ARCHIVE_DIRECTORY"] = os.environ.get('ATTEMPT_LOG_ARCHIVE_DIRECTORY', 'attempt_log_archive')
+    # requests are timed stage by stage (db queries, sympy parsing/simplifying, password hashing, ...)
+    # and the breakdown is sent back in a Server-Timing header and exported from /metrics to local scrapers
+    app.config["INSTRUMENTATION_ENABLED"] = os.environ.get('INSTRUMENTATION_ENABLED', 'true').lower() == 'true'
+    app.config["SERVER_TIMING_ENABLED"] = os.environ.get('SERVER_TIMING_ENABLED', 'true').lower() == 'true'
+    app.config["METRICS_ALLOWED_ADDRESSES"] = os.environ.get('METRICS_ALLOWED_ADDRESSES', '127.0.0.1,::1').split(',')
+    # scrapers elsewhere (e.g. on heroku, where every request comes from the router) send METRICS_TOKEN as a bearer token
+    # behind METRICS_TRUSTED_PROXIES proxies the client address is taken from X-Forwarded-For instead of the connection
+    app.config["METRICS_TOKEN"] = os.environ.get('METRICS_TOKEN') or None
+    app.config["METRICS_TRUSTED_PROXIES"] = int(os.environ.get('METRICS_TRUSTED_PROXIES', 0))
+    # requests taking longer than SLOW_REQUEST_SECONDS are logged with their stage breakdown and SLOW_REQUEST_STACKS most sampled stacks (0 disables)
+    app.config["SLOW_REQUEST_SECONDS"] = float(os.environ.get('SLOW_REQUEST_SECONDS', 0))
+    app.config["SLOW_REQUEST_SAMPLE_INTERVAL"] = float(os.environ.get('SLOW_REQUEST_SAMPLE_INTERVAL', 0.005))
+    app.config["SLOW_REQUEST_STACKS"] = int(os.environ.get('SLOW_REQUEST_STACKS', 5))
 
     # cross-origin requests allowed in development for testing purposes
     if app.config["FLASK_ENV"] == "development":
         CORS(app)
 
+    # load request timing, Server-Timing headers and /metrics endpoint
+    initialize_instrumentation_for_app(app)
+
     # load db connection into global variable to be used throughout app
     initialize_db_for_app(app)
 
+    # load cache of parsed sympy problem representations
+    initialize_expression_cache_for_app(app)
+
+    # load pool of processes that check answers with a time limit
+    initialize_checker_for_app(app)
+
+    # load cache of verdicts for previously checked answers
+    initialize_verdicts_for_app(app)
+
+    # load snapshot of problem catalog served to anonymous users
+    initialize_catalog_for_app(app)
+
+    # load background writer for attempt log
+    initialize_attempt_log_for_app(app)
+
     # load authentication library to only allow requests with valid tokens
     jwt.init_app(app)
 
-    # point base url to point to frontend homepage
-    @app.route('/')
-    def index():
-        return app.send_static_file('index.html')
-    
+    # load routes serving front end build, precompressed and with long lived caching for content hashed files
+    initialize_static_files_for_app(app)
+
     # endpoints that aren't matched to api are sent frontend
     # allows non-homepage links in frontend to be displayed
+    # unknown api urls get a json 404 instead
     @app.errorhandler(404)
     def not_found(e):
-        return app.send_static_file('index.html')
+        if request.path.startswith('/api/'):
+            return generate_error_handler(404)(e)
+        return send_frontend_file('index.html')
     
+    # cli commands for applying versioned schema/index migrations (see math_api/migrations) and checking hot queries use the indexes
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(migration_status_command)
+    app.cli.add_command(check_query_plans_command)
+
     # load authentication routes onto app
     app.register_blueprint(auth_blueprint)
 
     # load problem handling routes onto app
     app.register_blueprint(problems_blueprint)
+    # cli command for validating and bulk loading problems from a jsonl/csv file, scheduling them for every existing user
+    app.cli.add_command(ingest_problems_command)
+    # cli command for evaluating/simplifying problems ahead of time, run after problems are added or changed
+    app.cli.add_command(precompute_problems_command)
+    # cli command for filling shared verdict table from attempt history
+    app.cli.add_command(seed_verdicts_command)
+    # cli command for assigning every user's problems for the day, run daily by a scheduler
+    app.cli.add_command(assign_daily_problems_command)
+    # cli command for forecasting daily assignments and answer checks by replaying the scheduling rules over current schedules
+    app.cli.add_command(forecast_load_command)
     
     # load user handling routes onto app
     app.register_blueprint(user_info_blueprint)
+    # cli command for recomputing statistics rollups from attempt log
+    app.cli.add_command(rebuild_statistics_command)
+    # cli command for archiving attempt log partitions past the retention period, run periodically by a scheduler
+    app.cli.add_command(archive_attempt_log_command)
 
     # catch errors thrown by endpoints and send consistant error message format in json
     app.register_error_handler(400, generate_error_handler(400))
     app.register_error_handler(401, generate_error_handler(401))
     app.register_error_handler(405, generate_error_handler(405))
     app.register_error_handler(409, generate_error_handler(409))
+    app.register_error_handler(PoolTimeout, generate_error_handler(503))
+    app.register_error_handler(CheckerBusy, generate_error_handler(503))
     app.register_error_handler(DecodeError, token_parse_error)
+
+    # sympy is otherwise only imported once something is checked or parsed (see lazy_imports.py)
+    # when answers are checked inline in web workers, import it now so that with gunicorn's preload_app
+    # the import happens once in the master and workers share its memory instead of each paying for it
+    if app.config["ANSWER_CHECK_PROCESSES"] <= 0:
+        load_now('sympy', 'mpmath')
+
+    # optionally parse all problems up front (with gunicorn --preload, workers inherit the warmed cache)
+    # only when answers are checked inline: checking processes keep their own caches, nothing reads this one otherwise
+    # the pool connection used to read the problems is closed again, so forked workers don't inherit it
+    if app.config["EXPRESSION_CACHE_WARM"] and app.config["ANSWER_CHECK_PROCESSES"] <= 0:
+        with app.app_context():
+            warm_expression_cache()
+            close_pool()
     
     return app
@@ -0,0 +1,130 @@
+import os
+import re
+import gzip
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from psycopg2 import sql
+from .db import get_db_connection
+
+# monthly partitions of user_attempt_log are created this many months ahead, see create_attempt_log_partitions in util.sql
+PARTITION_MONTHS_AHEAD = 2
+PARTITION_NAME_PATTERN = re.compile(r'^user_attempt_log_(\d{4})_(\d{2})$')
+PARTITION_BOUND_PATTERN = re.compile(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)")
+
+# thrown when attempt log partitions can't be listed or archived
+class ArchiveError(Exception):
+    pass
+
+# make sure attempts of this month and the next PARTITION_MONTHS_AHEAD months have a partition to go to
+# does nothing until user_attempt_log is partitioned (migration 0002)
+def create_upcoming_partitions(cursor):
+    cursor.execute('call create_attempt_log_partitions(CURRENT_DATE, %s);', (PARTITION_MONTHS_AHEAD,))
+
+# (name, first date, date after last) of every monthly partition attached to user_attempt_log, oldest first
+def list_partitions(cursor):
+    cursor.execute("SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits "
+        "INNER JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass('user_attempt_log');")
+    partitions = []
+    for name, bound in cursor.fetchall():
+        if bound == 'DEFAULT':
+            continue
+        match = PARTITION_BOUND_PATTERN.search(bound)
+        if match is None:
+            raise ArchiveError(f'Unexpected bounds for partition {name}: {bound}')
+        partitions.append((name, match.group(1), match.group(2)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+# names of monthly attempt tables that were detached but not archived yet, by --detach-only or an interrupted archive
+def list_detached_partitions(cursor):
+    cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace AND NOT relispartition AND relname LIKE 'user\\_attempt\\_log\\_%';")
+    return sorted(name for name, in cursor.fetchall() if PARTITION_NAME_PATTERN.match(name))
+
+# partitions whose every attempt is from before the first day of the month keep_months months before the current one
+def partitions_to_archive(cursor, keep_months):
+    cursor.execute("SELECT to_char(date_trunc('month', CURRENT_DATE) - make_interval(months => %s), 'YYYY-MM-DD');", (keep_months,))
+    cutoff = cursor.fetchone()[0]
+    return [name for name, _, end in list_partitions(cursor) if end <= cutoff]
+
+# detach partition from user_attempt_log, keeping its per user, problem and day counts in archived_attempt_statistics
+# so statistics rollups can still be rebuilt and reset (see util.sql), in one transaction so counts are kept exactly once
+# the detached table's foreign keys are dropped, it mustn't stop users or problems from being deleted
+# cursor must belong to a connection in autocommit mode, like the pooled ones (see db.py)
+def detach_partition(cursor, name):
+    partition = sql.Identifier(name)
+    cursor.execute('BEGIN;')
+    try:
+        cursor.execute(sql.SQL('INSERT INTO archived_attempt_statistics(user_id, problem_id, attempt_date, solved, attempts) '
+            'SELECT user_id, problem_id, attempt_date, COUNT(*) filter (where correct), COUNT(*) FROM {} GROUP BY user_id, problem_id, attempt_date '
+            'ON CONFLICT (user_id, problem_id, attempt_date) DO UPDATE SET solved = archived_attempt_statistics.solved + EXCLUDED.solved, '
+            'attempts = archived_attempt_statistics.attempts + EXCLUDED.attempts;').format(partition))
+        cursor.execute(sql.SQL('ALTER TABLE user_attempt_log DETACH PARTITION {};').format(partition))
+        cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f';", (name,))
+        for constraint, in cursor.fetchall():
+            cursor.execute(sql.SQL('ALTER TABLE {} DROP CONSTRAINT {};').format(partition, sql.Identifier(constraint)))
+        cursor.execute('COMMIT;')
+    except Exception:
+        cursor.execute('ROLLBACK;')
+        raise
+
+# write detached table to <directory>/<name>.csv.gz and drop it, returns number of attempts written
+# the file is only put in place once completely written and synced, so a failed run leaves the table to be archived again
+def archive_detached_partition(cursor, name, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.csv.gz')
+    temporary_path = path + '.partial'
+    with open(temporary_path, 'wb') as archive_file:
+        with gzip.GzipFile(fileobj=archive_file, mode='wb') as compressed_file:
+            cursor.copy_expert(sql.SQL('COPY (SELECT * FROM {} ORDER BY attempt_date, id) TO STDOUT WITH (FORMAT csv, HEADER);').format(sql.Identifier(name)), compressed_file)
+            attempt_count = cursor.rowcount
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    os.replace(temporary_path, path)
+    cursor.execute(sql.SQL('DROP TABLE {};').format(sql.Identifier(name)))
+    return attempt_count
+
+# detach partitions past the retention period and, unless detach_only, archive them (and any left detached before) to directory
+# returns (name, attempts archived or None if only detached) for every partition handled
+def archive_attempt_log(cursor, keep_months, directory, detach_only=False):
+    create_upcoming_partitions(cursor)
+    handled = []
+    for name in partitions_to_archive(cursor, keep_months):
+        detach_partition(cursor, name)
+        if detach_only:
+            handled.append((name, None))
+    if not detach_only:
+        for name in list_detached_partitions(cursor):
+            handled.append((name, archive_detached_partition(cursor, name, directory)))
+    return handled
+
+@click.command('archive-attempt-log')
+@click.option('--keep-months', type=int, help='full months of attempts kept besides the current one (default: ATTEMPT_LOG_RETENTION_MONTHS)')
+@click.option('--directory', type=click.Path(file_okay=False), help='where archives are written (default: ATTEMPT_LOG_ARCHIVE_DIRECTORY)')
+@click.option('--detach-only', is_flag=True, help='detach old partitions but keep them as tables instead of archiving them')
+@click.option('--dry-run', is_flag=True, help='only list partitions that would be detached')
+@with_appcontext
+def archive_attempt_log_command(keep_months, directory, detach_only, dry_run):
+    keep_months = current_app.config['ATTEMPT_LOG_RETENTION_MONTHS'] if keep_months is None else keep_months
+    directory = directory or current_app.config['ATTEMPT_LOG_ARCHIVE_DIRECTORY']
+    if keep_months < 0:
+        raise click.BadParameter('must not be negative', param_hint='--keep-months')
+    cursor = get_db_connection().cursor()
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('user_attempt_log');")
+    if cursor.fetchone() is None:
+        raise click.ClickException('user_attempt_log is not partitioned yet, run flask migrate-db first')
+    if dry_run:
+        for name in partitions_to_archive(cursor, keep_months):
+            click.echo(f'Would detach {name}.')
+        return
+    try:
+        handled = archive_attempt_log(cursor, keep_months, directory, detach_only)
+    except ArchiveError as error:
+        raise click.ClickException(str(error))
+    for name, attempt_count in handled:
+        if attempt_count is None:
+            click.echo(f'Detached {name}.')
+        else:
+            click.echo(f'Archived {attempt_count} attempts of {name} to {os.path.join(directory, name)}.csv.gz.')
+    if not handled:
+        click.echo('No partitions to archive.')
@@ -0,0 +1,105 @@
+import os
+import queue
+import atexit
+import threading
+from flask import current_app
+# inserts many rows with a single multi-row INSERT statement
+from psycopg2.extras import execute_values
+from .db import get_db_connection
+
+INSERT_ATTEMPTS = 'INSERT INTO user_attempt_log(user_id, problem_id, response, correct, attempt_date) VALUES %s;'
+ATTEMPT_TEMPLATE = '(%s, %s, %s, %s, CURRENT_DATE)'
+
+# write-behind queue for user_attempt_log: requests enqueue attempts and return immediately,
+# a background thread inserts them in batches of up to batch_size rows
+# the schedule_next_assignment and statistics triggers still run once per inserted row, see util.sql
+class AttemptWriter:
+    def __init__(self, app, max_queue_size, batch_size, flush_interval):
+        self.pid = os.getpid()
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(max_queue_size)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='attempt-writer', daemon=True)
+        self._thread.start()
+        # write out whatever is still queued when the worker shuts down
+        atexit.register(self.close)
+
+    # queue attempt, returns False if queue is full so caller can write it synchronously instead
+    def submit(self, attempt):
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait(attempt)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self._insert(batch)
+        except Exception:
+            # retry row by row (on a freshly checked out connection) so one bad attempt,
+            # e.g. from a user deleted meanwhile, doesn't lose the whole batch
+            self.app.logger.exception('Batched attempt insert failed, retrying %s attempts individually', len(batch))
+            for attempt in batch:
+                try:
+                    self._insert([attempt])
+                except Exception:
+                    self.app.logger.exception('Dropping attempt that could not be logged: %s', attempt)
+
+    # each insert gets its own app context, so its pooled connection is returned right after
+    def _insert(self, attempts):
+        with self.app.app_context():
+            cursor = get_db_connection().cursor()
+            execute_values(cursor, INSERT_ATTEMPTS, attempts, template=ATTEMPT_TEMPLATE, page_size=self.batch_size)
+            cursor.close()
+
+    # stop accepting attempts and wait for queued ones to be written
+    def close(self):
+        self._stopping.set()
+        if self._thread.is_alive() and self.pid == os.getpid():
+            self._thread.join(self.app.config["ATTEMPT_LOG_SHUTDOWN_TIMEOUT"])
+
+_writer_lock = threading.Lock()
+
+# writer is started lazily per process, threads don't survive a gunicorn fork
+def get_attempt_writer():
+    app = current_app._get_current_object()
+    writer = app.extensions.get('attempt_writer')
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+    with _writer_lock:
+        writer = app.extensions.get('attempt_writer')
+        if writer is None or writer.pid != os.getpid():
+            writer = AttemptWriter(app, app.config["ATTEMPT_LOG_QUEUE_SIZE"], app.config["ATTEMPT_LOG_BATCH_SIZE"], app.config["ATTEMPT_LOG_FLUSH_INTERVAL"])
+            app.extensions['attempt_writer'] = writer
+    return writer
+
+# hand attempt to background writer if write-behind is enabled
+# returns False if attempt wasn't queued (disabled or queue full) and must be written synchronously
+def queue_attempt(user_id, problem_id, correct, response):
+    if not current_app.config["ATTEMPT_LOG_ASYNC"]:
+        return False
+    return get_attempt_writer().submit((user_id, problem_id, response, correct))
+
+def init_app(app):
+    app.config.setdefault("ATTEMPT_LOG_ASYNC", False)
+    app.config.setdefault("ATTEMPT_LOG_QUEUE_SIZE", 10000)
+    app.config.setdefault("ATTEMPT_LOG_BATCH_SIZE", 500)
+    app.config.setdefault("ATTEMPT_LOG_FLUSH_INTERVAL", 0.5)
+    app.config.setdefault("ATTEMPT_LOG_SHUTDOWN_TIMEOUT", 10.0)
@@ -1,3 +1,7 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # request allows you to access data sent in request, current_app is allows you to access config used in global app
 from flask import (
     Blueprint, request, abort, current_app
@@ -11,12 +15,41 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, current_user, jwt_required
 from .db import get_db_connection
 from .problems import assign_daily_problems
+from .instrumentation import timed
 
 # initialize authentication library for endpoints
 jwt = JWTManager()
 # initalize blueprint to load authentication route handlers onto
 auth_blueprint = Blueprint('auth', __name__, url_prefix='/api/auth')
 
+_hash_executor_lock = threading.Lock()
+_hash_executor = None
+_hash_executor_pid = None
+
+# bounded pool of threads that hash/verify passwords (pbkdf2 releases the gil, so hashes run on all cores)
+# caps how much cpu a burst of logins can take from other requests
+def get_hash_executor():
+    global _hash_executor, _hash_executor_pid
+    with _hash_executor_lock:
+        if _hash_executor is None or _hash_executor_pid != os.getpid():
+            _hash_executor = ThreadPoolExecutor(max_workers=current_app.config["PASSWORD_HASH_WORKERS"], thread_name_prefix='password-hash')
+            _hash_executor_pid = os.getpid()
+        return _hash_executor
+
+# hash password with currently configured method (e.g. pbkdf2:sha256:260000) and salt length
+def hash_password(password):
+    with timed('password_hash'):
+        return get_hash_executor().submit(generate_password_hash, password, current_app.config["PASSWORD_HASH_METHOD"], current_app.config["PASSWORD_SALT_LENGTH"]).result()
+
+# compare password sent to stored hash, returns boolean
+def verify_password(password_hash, request_password):
+    with timed('password_hash'):
+        return get_hash_executor().submit(check_password_hash, password_hash, request_password).result()
+
+# whether stored hash was made with different parameters than the configured ones
+def password_needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != current_app.config["PASSWORD_HASH_METHOD"]
+
 # add user with given details to database
 # throw error if username is taken
 def create_user(username, password):
@@ -25,7 +58,7 @@ def create_user(username, password):
         db_connection = get_db_connection()
         cursor = db_connection.cursor(cursor_factory=RealDictCursor)
         # try insert, raise error if it doesn't work
-        cursor.execute('INSERT INTO user_info(username, password_hash) VALUES (%s, %s) RETURNING user_info.id, user_info.username;', (username, generate_password_hash(password)))
+        cursor.execute('INSERT INTO user_info(username, password_hash) VALUES (%s, %s) RETURNING user_info.id, user_info.username;', (username, hash_password(password)))
         user = cursor.fetchone()
         return user
     except Error:
@@ -43,27 +76,76 @@ def get_user(username):
     cursor.close()
     return user
 
-# compare password sent to the one stored in the db, called when user confirmed to exist
-# returns boolean
-def check_password_correct(user_id, request_password):
+# retrieve user info along with password hash for given username, returns None if user doesn't exist
+def get_user_credentials(username):
     db_connection = get_db_connection()
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT password_hash FROM user_info WHERE id=%s;', (user_id,))
-    password_hash = cursor.fetchone()['password_hash']
+    cursor.execute('SELECT id, username, password_hash FROM user_info WHERE username=%s;', (username,))
+    user = cursor.fetchone()
+    cursor.close()
+    return user
+
+# replace user's stored hash, used to move old hashes to newly configured parameters
+def update_password_hash(user_id, password_hash):
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    cursor.execute('UPDATE user_info SET password_hash=%s WHERE id=%s;', (password_hash, user_id))
     cursor.close()
-    return check_password_hash(password_hash, request_password)
 
 # part of jwt library, serves to uniquely identify user 
 @jwt.user_identity_loader
 def user_identity_lookup(user):
     return user['username']
 
+# part of jwt library, stores user id in token next to username so user can be rebuilt without a db lookup
+@jwt.additional_claims_loader
+def add_user_claims(user):
+    return {'user_id': user['id']}
+
+# ids of users recently confirmed to still exist in db, user id -> time confirmation expires
+_confirmed_users = {}
+_confirmed_users_lock = threading.Lock()
+
+# whether user still exists, checked against db at most once every USER_CHECK_TTL seconds per worker
+# a USER_CHECK_TTL of 0 trusts the token alone
+def user_still_exists(user_id):
+    ttl = current_app.config["USER_CHECK_TTL"]
+    if ttl <= 0:
+        return True
+    now = time.monotonic()
+    with _confirmed_users_lock:
+        if _confirmed_users.get(user_id, 0) > now:
+            return True
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT 1 FROM user_info WHERE id=%s;', (user_id,))
+    exists = cursor.fetchone() is not None
+    cursor.close()
+    if exists:
+        with _confirmed_users_lock:
+            # drop expired confirmations every so often so the dict doesn't grow forever
+            if len(_confirmed_users) > 10000:
+                for expired_id in [key for key, expires in _confirmed_users.items() if expires <= now]:
+                    del _confirmed_users[expired_id]
+            _confirmed_users[user_id] = now + ttl
+    return exists
+
+# stop trusting cached confirmation for user, called when user is deleted
+def forget_user(user_id):
+    with _confirmed_users_lock:
+        _confirmed_users.pop(user_id, None)
+
 # part of jwt library, loads user retrieved from token into current_user variable used throughout app
+# user is built from token claims, returning None (deleted user) makes the library reject the token
 @jwt.user_lookup_loader
 def user_lookback_callback(_jwt_header, jwt_data):
     identity  = jwt_data['sub']
-    user = get_user(identity)
-    return user
+    # tokens issued before user id was added to claims still need a lookup
+    if 'user_id' not in jwt_data:
+        return get_user(identity)
+    if not user_still_exists(jwt_data['user_id']):
+        return None
+    return {'id': jwt_data['user_id'], 'username': identity}
 
 # endpoint for creating new users
 @auth_blueprint.route('/register', methods=['POST'])
@@ -105,19 +187,26 @@ def login():
         abort(400, description = 'Request must contain username and password in json format')
     
     # throw error if user doesn't exist
-    user = get_user(request_username)
-    if user == None:
+    credentials = get_user_credentials(request_username)
+    if credentials == None:
         abort(400, description = f'User {request_username} does not exist')
     
     # throw error if password given doesn't match hash stored in db
-    user_id = user['id']
-    username = user['username']
-    password_correct = check_password_correct(user_id, request_password)
+    user_id = credentials['id']
+    username = credentials['username']
+    password_hash = credentials['password_hash']
+    password_correct = verify_password(password_hash, request_password)
     if not password_correct:
         abort(401, description = f'Password incorrect for user {username}')
+
+    # password is known to be correct here, so upgrade hashes made with old parameters
+    if password_needs_rehash(password_hash):
+        update_password_hash(user_id, hash_password(request_password))
+    user = {'id': user_id, 'username': username}
     
     # user is authenticated, so make sure their daily problems are assigned for today
-    assign_daily_problems(user_id)
+    with timed('assign_daily_problems'):
+        assign_daily_problems(user_id)
 
     # create tokens that user need to send to access api information
     access_token = create_access_token(identity=user)
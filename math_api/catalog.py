@@ -0,0 +1,65 @@
+import time
+import hashlib
+import threading
+from flask import current_app, request, json
+from .db import get_db_connection
+
+# serialized copy of every problem's user-agnostic info, shared by all anonymous requests in a worker
+# json bytes and strong etags are computed once per snapshot instead of on every request
+class CatalogSnapshot:
+    def __init__(self, problems, version, ttl):
+        self.version = version
+        self.version_checked_at = time.monotonic()
+        self.expires_at = time.monotonic() + ttl
+        self.problems_json = json.dumps(problems).encode()
+        self.etag = hashlib.md5(self.problems_json).hexdigest()
+        self.problem_json_by_id = {}
+        for problem in problems:
+            problem_json = json.dumps(problem).encode()
+            self.problem_json_by_id[problem['id']] = (problem_json, hashlib.md5(problem_json).hexdigest())
+
+_catalog_lock = threading.Lock()
+
+# version of problem_info, bumped by a trigger on every change to it from any process (see problem_catalog_version in util.sql)
+def get_catalog_version():
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT version FROM problem_catalog_version;')
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+# current snapshot, reloaded with load_problems() once problem_info has changed since it was loaded
+# the version is checked at most every CATALOG_VERSION_CHECK_INTERVAL seconds, and snapshots are reloaded
+# after CATALOG_CACHE_TTL seconds regardless
+def get_catalog(load_problems):
+    app = current_app._get_current_object()
+    snapshot = app.extensions.get('catalog')
+    now = time.monotonic()
+    if snapshot is not None and snapshot.expires_at > now and snapshot.version_checked_at + app.config["CATALOG_VERSION_CHECK_INTERVAL"] > now:
+        return snapshot
+    # read before the problems, so a change made while they load at worst causes one more reload
+    version = get_catalog_version()
+    with _catalog_lock:
+        snapshot = app.extensions.get('catalog')
+        if snapshot is None or snapshot.expires_at <= time.monotonic() or snapshot.version != version:
+            snapshot = CatalogSnapshot(load_problems(), version, app.config["CATALOG_CACHE_TTL"])
+            app.extensions['catalog'] = snapshot
+        else:
+            snapshot.version_checked_at = time.monotonic()
+    return snapshot
+
+# json response that clients and proxies can cache and revalidate with If-None-Match (answered with 304)
+def make_catalog_response(body, etag):
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["CATALOG_MAX_AGE"]
+    # same urls return user specific statistics when a token is sent
+    response.vary.add('Authorization')
+    return response.make_conditional(request)
+
+def init_app(app):
+    app.config.setdefault("CATALOG_CACHE_TTL", 300)
+    app.config.setdefault("CATALOG_MAX_AGE", 60)
+    app.config.setdefault("CATALOG_VERSION_CHECK_INTERVAL", 2.0)
@@ -0,0 +1,331 @@
+import os
+import time
+import resource
+import threading
+import multiprocessing
+import multiprocessing.connection
+from flask import current_app, has_app_context
+from .lazy_imports import lazy_import
+from .expression_cache import parse_problem_expression, parse_problem_assumptions, configure_process_cache, get_expression_cache
+from .equivalence import expressions_equivalent, simplify_fully
+from .instrumentation import timed, start_collecting, stop_collecting, merge_stages
+# library for parsing user algebraic inputs and determining symbolic equality
+# imported on first use, see lazy_imports.py
+sympy = lazy_import('sympy')
+
+# possible results of checking an answer
+CORRECT = 'correct'
+INCORRECT = 'incorrect'
+# answer is just the problem typed back in (e.g. the unevaluated derivative)
+MATCHES_PROBLEM = 'matches_problem'
+# sympy couldn't build an expression from the answer
+UNPARSEABLE = 'unparseable'
+
+# thrown when a check runs longer than the configured timeout (or its process dies)
+class CheckTimeout(Exception):
+    pass
+
+# thrown when every checking process stays busy for longer than the configured wait
+class CheckerBusy(Exception):
+    pass
+
+# evaluate problem (if it is a derivative/integral) and simplify it, independent of any user answer
+def canonicalize_problem(problem_expression, problem_type):
+    if problem_type == 'derivative' or problem_type == 'integral':
+        with timed('doit'):
+            problem_expression = problem_expression.doit()
+    return simplify_fully(problem_expression)
+
+# load canonical form stored by precompute-problems, returns None if there is none
+# or it was built with different symbol assumptions than the problem currently has
+def load_canonical_expression(problem_id, canonical_representation, assumptions):
+    if canonical_representation is None:
+        return None
+    # srepr strings carry their own assumptions, so no local dict is needed to parse them
+    canonical_expression = parse_problem_expression(problem_id, canonical_representation)
+    for symbol in canonical_expression.free_symbols:
+        if assumptions.get(symbol.name, sympy.Symbol(symbol.name)) != symbol:
+            return None
+    return canonical_expression
+
+# canonical form of a problem without a stored one, cached like parsed expressions (see expression_cache.py)
+# so only the first check of the problem in a process pays for doit and simplification
+def get_live_canonical_expression(problem_id, problem_type, problem_representation, problem_expression, assumptions):
+    def build():
+        return canonicalize_problem(problem_expression, problem_type)
+    if has_app_context() and not current_app.config["EXPRESSION_CACHE_ENABLED"]:
+        return build()
+    assumption_key = frozenset(assumptions.items()) if assumptions else None
+    key = ('canonical', problem_id, problem_representation, problem_type, assumption_key)
+    return get_expression_cache().get_or_build(key, build)
+
+def compare_problem_to_answer(problem_id, problem_type, problem_representation, answer_expression, assumptions, numeric_points):
+    sympy_problem_string, canonical_problem_string = problem_representation
+    problem_expression = parse_problem_expression(problem_id, sympy_problem_string, assumptions, evaluate=False)
+    if problem_expression == answer_expression:
+        raise RuntimeError('Answer matches problem symbolically. Please answer with simplified version of problem')
+
+    # use precomputed derivative/integral and simplification of problem if available, else compute it now
+    canonical_expression = load_canonical_expression(problem_id, canonical_problem_string, assumptions)
+    if canonical_expression is None:
+        canonical_expression = get_live_canonical_expression(problem_id, problem_type, sympy_problem_string, problem_expression, assumptions)
+
+    # if user submits answer that is mathematically equal to problem, it is correct
+    # see equivalence.py for numeric pre-check done before simplifying
+    return expressions_equivalent(canonical_expression, answer_expression, numeric_points)
+
+def compare_solutions_to_answer(problem_id, solution_representations, answer_expression, assumptions, numeric_points):
+    for solution_string, canonical_solution_string in solution_representations:
+        solution_expression = load_canonical_expression(problem_id, canonical_solution_string, assumptions)
+        if solution_expression is None:
+            solution_expression = parse_problem_expression(problem_id, solution_string, assumptions)
+        if expressions_equivalent(solution_expression, answer_expression, numeric_points):
+            return True
+    return False
+
+# parse user answer and compare it to problem and then to each sample solution
+# only takes plain strings/tuples so it can run in a separate process, returns one of the verdicts above
+def check_answer(problem_id, problem_type, answer, assumption_rows, problem_representation, solution_representations, numeric_points):
+    # load algebraic assumptions about symbols used in problem
+    # e.g. assuming x is real or y is an integer
+    assumptions = parse_problem_assumptions(problem_id, assumption_rows)
+
+    # try to parse user response algebraically
+    try:
+        with timed('parse_answer'):
+            answer_expression = sympy.parse_expr(answer, assumptions)
+    except Exception:
+        return UNPARSEABLE
+
+    def compare():
+        try:
+            if compare_problem_to_answer(problem_id, problem_type, problem_representation, answer_expression, assumptions, numeric_points):
+                return CORRECT
+        except RuntimeError:
+            return MATCHES_PROBLEM
+
+        if compare_solutions_to_answer(problem_id, solution_representations, answer_expression, assumptions, numeric_points):
+            return CORRECT
+        return INCORRECT
+
+    # answers written differently that parse to the same expression (e.g. 'x*2' and '2*x') share a verdict
+    verdict_key = ('verdict', problem_id, sympy.srepr(answer_expression), problem_type, problem_representation, tuple(solution_representations))
+    return get_expression_cache().get_or_build(verdict_key, compare)
+
+# loop run by each checking process: receive check arguments, send back verdict, peak memory use
+# and time spent in each stage of the check (added to the requesting worker's Server-Timing/metrics)
+def _check_process_main(connection, cache_size):
+    configure_process_cache(cache_size)
+    while True:
+        try:
+            check_arguments = connection.recv()
+        except EOFError:
+            return
+        start_collecting()
+        try:
+            result = ('verdict', check_answer(*check_arguments))
+        except Exception as error:
+            result = ('error', repr(error))
+        # ru_maxrss is reported in kilobytes on linux
+        connection.send((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024, stop_collecting()))
+
+# one long-lived checking process and the pipe used to talk to it
+class CheckProcess:
+    def __init__(self, context, cache_size):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_check_process_main, args=(child_connection, cache_size), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.checks = 0
+        self.memory_mb = 0
+
+    def run(self, check_arguments, timeout):
+        self.send(check_arguments)
+        if not self.connection.poll(timeout):
+            raise CheckTimeout(f'Answer could not be checked within {timeout} seconds')
+        return self.receive()
+
+    def send(self, check_arguments):
+        try:
+            self.connection.send(check_arguments)
+        except OSError:
+            raise CheckTimeout('Answer checking process exited before finishing')
+
+    # read result of check sent earlier, once connection has data
+    def receive(self):
+        try:
+            (kind, value), self.memory_mb, stages = self.connection.recv()
+        except (EOFError, OSError):
+            raise CheckTimeout('Answer checking process exited before finishing')
+        self.checks += 1
+        merge_stages(stages)
+        if kind == 'error':
+            raise RuntimeError(f'Answer check failed: {value}')
+        return value
+
+    def stop(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(1)
+
+# bounded set of processes that run sympy checks away from web worker threads
+# a process that times out is killed and replaced, and processes are recycled
+# after max_checks checks or once their memory grows past max_memory_mb
+class CheckPool:
+    def __init__(self, processes, timeout, wait_timeout, max_checks, max_memory_mb, cache_size):
+        self.pid = os.getpid()
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.max_checks = max_checks
+        self.max_memory_mb = max_memory_mb
+        self.cache_size = cache_size
+        # forkserver starts checking processes from a clean process with sympy already imported,
+        # instead of forking a threaded web worker that holds db sockets
+        # sympy and mpmath are listed before the checker so they are imported for real, not lazily
+        self._context = multiprocessing.get_context('forkserver')
+        self._context.set_forkserver_preload(['sympy', 'mpmath', 'math_api.checker'])
+        self._slots = threading.BoundedSemaphore(processes)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._all = []
+
+    # returns None instead of waiting if wait is False and no process is free
+    def _acquire_process(self, wait=True):
+        if not wait and not self._slots.acquire(blocking=False):
+            return None
+        if wait and not self._slots.acquire(timeout=self.wait_timeout):
+            raise CheckerBusy('All answer checking processes are busy, please try again')
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            check_process = CheckProcess(self._context, self.cache_size)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._all.append(check_process)
+        return check_process
+
+    def _release_process(self, check_process, healthy):
+        recycle = not healthy or check_process.checks >= self.max_checks or check_process.memory_mb >= self.max_memory_mb
+        if recycle:
+            check_process.stop()
+        with self._lock:
+            if recycle:
+                self._all.remove(check_process)
+            else:
+                self._idle.append(check_process)
+        self._slots.release()
+
+    def run(self, check_arguments):
+        check_process = self._acquire_process()
+        healthy = False
+        try:
+            verdict = check_process.run(check_arguments, self.timeout)
+            healthy = True
+            return verdict
+        finally:
+            self._release_process(check_process, healthy)
+
+    # run checks at once on every process that is free (waiting for at least one), starting the next check
+    # as soon as a process finishes, so a batch takes about as long as its slowest checks instead of all of them in a row
+    # returns verdict of each check in order, or the CheckTimeout it raised
+    def run_many(self, checks):
+        results = [None] * len(checks)
+        pending = list(enumerate(checks))
+        # connection -> (index of check, process running it, time by which it must finish)
+        running = {}
+        try:
+            while pending or running:
+                while pending:
+                    check_process = self._acquire_process(wait=not running)
+                    if check_process is None:
+                        break
+                    index, check_arguments = pending.pop(0)
+                    try:
+                        check_process.send(check_arguments)
+                    except CheckTimeout as error:
+                        results[index] = error
+                        self._release_process(check_process, False)
+                        continue
+                    running[check_process.connection] = (index, check_process, time.monotonic() + self.timeout)
+                if not running:
+                    continue
+                next_deadline = min(deadline for _, _, deadline in running.values())
+                ready = multiprocessing.connection.wait(list(running), max(next_deadline - time.monotonic(), 0))
+                for connection in ready:
+                    index, check_process, _ = running.pop(connection)
+                    healthy = False
+                    try:
+                        results[index] = check_process.receive()
+                        healthy = True
+                    except CheckTimeout as error:
+                        results[index] = error
+                    finally:
+                        self._release_process(check_process, healthy)
+                now = time.monotonic()
+                for connection, (index, check_process, deadline) in list(running.items()):
+                    if deadline <= now:
+                        del running[connection]
+                        results[index] = CheckTimeout(f'Answer could not be checked within {self.timeout} seconds')
+                        self._release_process(check_process, False)
+            return results
+        finally:
+            # only left running if a check failed outright, their processes are replaced
+            for _, check_process, _ in running.values():
+                self._release_process(check_process, False)
+
+    def close(self):
+        with self._lock:
+            for check_process in self._all:
+                check_process.stop()
+            self._all = []
+            self._idle = []
+
+_pool_lock = threading.Lock()
+
+# pool is created lazily per process so each gunicorn worker owns its checking processes
+def get_check_pool():
+    app = current_app._get_current_object()
+    check_pool = app.extensions.get('check_pool')
+    if check_pool is not None and check_pool.pid == os.getpid():
+        return check_pool
+    with _pool_lock:
+        check_pool = app.extensions.get('check_pool')
+        if check_pool is None or check_pool.pid != os.getpid():
+            check_pool = CheckPool(app.config["ANSWER_CHECK_PROCESSES"], app.config["ANSWER_CHECK_TIMEOUT"],
+                app.config["ANSWER_CHECK_WAIT_TIMEOUT"], app.config["ANSWER_CHECK_MAX_CHECKS"],
+                app.config["ANSWER_CHECK_MAX_MEMORY_MB"], app.config["EXPRESSION_CACHE_SIZE"])
+            app.extensions['check_pool'] = check_pool
+    return check_pool
+
+# check answer in a checking process, or inline in the request thread if no processes are configured
+def run_answer_check(problem_id, answer, problem_type, assumption_rows, problem_representation, solution_representations):
+    check_arguments = (problem_id, problem_type, answer, assumption_rows, problem_representation,
+        solution_representations, current_app.config["NUMERIC_CHECK_POINTS"])
+    # answer_check covers the whole check, including waiting for a free process and talking to it
+    with timed('answer_check'):
+        if current_app.config["ANSWER_CHECK_PROCESSES"] <= 0:
+            return check_answer(*check_arguments)
+        return get_check_pool().run(check_arguments)
+
+# check several answers, in parallel on the checking processes or one after another inline if none are configured
+# each check is (problem_id, answer, problem_type, assumption_rows, problem_representation, solution_representations)
+# returns verdict of each check in order, or the CheckTimeout it raised
+def run_answer_checks(checks):
+    numeric_points = current_app.config["NUMERIC_CHECK_POINTS"]
+    checks_arguments = [(problem_id, problem_type, answer, assumption_rows, problem_representation, solution_representations, numeric_points)
+        for problem_id, answer, problem_type, assumption_rows, problem_representation, solution_representations in checks]
+    with timed('answer_check'):
+        if current_app.config["ANSWER_CHECK_PROCESSES"] <= 0:
+            return [check_answer(*check_arguments) for check_arguments in checks_arguments]
+        return get_check_pool().run_many(checks_arguments)
+
+def init_app(app):
+    app.config.setdefault("ANSWER_CHECK_PROCESSES", 2)
+    app.config.setdefault("ANSWER_CHECK_TIMEOUT", 10.0)
+    app.config.setdefault("ANSWER_CHECK_WAIT_TIMEOUT", 10.0)
+    app.config.setdefault("ANSWER_CHECK_MAX_CHECKS", 500)
+    app.config.setdefault("ANSWER_CHECK_MAX_MEMORY_MB", 512)
@@ -1,27 +1,175 @@
-import psycopg2
+import os
+import threading
+import time
 import click
+from psycopg2 import pool, InterfaceError, OperationalError
 from flask import g, current_app
 from flask.cli import with_appcontext
+from .instrumentation import TimedConnection, add_gauge_source, timed
+
+# thrown when no pooled connection frees up within the configured checkout timeout
+class PoolTimeout(Exception):
+    pass
+
+# process-level pool of postgres connections shared by every request/thread in a worker
+# wraps psycopg2's thread safe pool with a blocking checkout (bounded by a timeout),
+# a health check on checkout, and counters used to monitor pool pressure
+class ConnectionPool:
+    def __init__(self, database_url, sslmode, min_size, max_size, checkout_timeout):
+        # queries of every pooled connection are timed for the request's Server-Timing/metrics, see instrumentation.py
+        connection_args = {'connection_factory': TimedConnection}
+        if sslmode:
+            connection_args['sslmode'] = sslmode
+        self.pid = os.getpid()
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self._pool = pool.ThreadedConnectionPool(min_size, max_size, database_url, **connection_args)
+        # psycopg2 raises immediately when its pool is exhausted, semaphore makes callers wait instead
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._replaced = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+    # borrow a connection, waiting up to checkout_timeout seconds for one to be returned
+    def checkout(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f'No database connection available after {self.checkout_timeout} seconds')
+        waited = time.monotonic() - start
+        try:
+            connection = self._healthy_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_seconds_total += waited
+            self._wait_seconds_max = max(self._wait_seconds_max, waited)
+        return connection
+
+    # give connection back to pool, dropping it if it was closed/broken while in use
+    def release(self, connection):
+        try:
+            self._pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    # make sure connection is usable: open, in autocommit mode and answering queries
+    def _check_connection(self, connection):
+        if connection.closed:
+            raise InterfaceError('connection already closed')
+        # new connections have to be switched to autocommit before any query opens a transaction
+        if not connection.autocommit:
+            connection.set_session(autocommit=True)
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1;')
+        cursor.close()
+
+    # get connection from pool and make sure it is still alive (e.g. not dropped by server or network)
+    # a stale connection is discarded and replaced once, the replacement (another idle or a newly opened connection)
+    # is checked the same way, any connection that fails is closed and handed back so the pool doesn't lose its slot
+    def _healthy_connection(self):
+        connection = self._pool.getconn()
+        try:
+            self._check_connection(connection)
+            return connection
+        except (InterfaceError, OperationalError):
+            self._pool.putconn(connection, close=True)
+            with self._lock:
+                self._replaced += 1
+        except Exception:
+            self._pool.putconn(connection, close=True)
+            raise
+        connection = self._pool.getconn()
+        try:
+            self._check_connection(connection)
+        except Exception:
+            self._pool.putconn(connection, close=True)
+            raise
+        return connection
+
+    # snapshot of pool usage, used for monitoring pool waits and connection exhaustion
+    def statistics(self):
+        with self._lock:
+            return {
+                'pid': self.pid,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'replaced_connections': self._replaced,
+                'wait_seconds_total': self._wait_seconds_total,
+                'wait_seconds_max': self._wait_seconds_max,
+            }
+
+    def close(self):
+        self._pool.closeall()
+
+# pools are created lazily per process so gunicorn workers never share sockets inherited from the master
+_pool_lock = threading.Lock()
+# pools left behind by a fork are kept referenced so garbage collection doesn't close the parent's sockets
+_inherited_pools = []
+
+def get_pool():
+    app = current_app._get_current_object()
+    connection_pool = app.extensions.get('db_pool')
+    if connection_pool is not None and connection_pool.pid == os.getpid():
+        return connection_pool
+    with _pool_lock:
+        connection_pool = app.extensions.get('db_pool')
+        if connection_pool is not None and connection_pool.pid != os.getpid():
+            _inherited_pools.append(connection_pool)
+            connection_pool = None
+        if connection_pool is None:
+            # connect not using ssl in development, using ssl in production
+            sslmode = None if app.config["FLASK_ENV"] == "development" else 'require'
+            connection_pool = ConnectionPool(app.config["DATABASE_URL"], sslmode,
+                app.config["DB_POOL_MIN_SIZE"], app.config["DB_POOL_MAX_SIZE"], app.config["DB_POOL_CHECKOUT_TIMEOUT"])
+            app.extensions['db_pool'] = connection_pool
+    return connection_pool
+
+# close this process's pool once the current app context's connection is returned
+# e.g. in the gunicorn master after reading from the db at startup, so forked workers don't inherit open sockets
+def close_pool():
+    app = current_app._get_current_object()
+    close_db_connection()
+    with _pool_lock:
+        connection_pool = app.extensions.get('db_pool')
+        if connection_pool is not None and connection_pool.pid == os.getpid():
+            connection_pool.close()
+            del app.extensions['db_pool']
 
 # returns connection to postgres db
-# on app startup, create connection and store in global variable
+# connection is borrowed from the pool once per app context and stored in global variable
 def get_db_connection():
     if 'db' not in g:
-        # connect not using ssl in development, using ssl in production
-        if current_app.config["FLASK_ENV"] == "development":
-            connection = psycopg2.connect(current_app.config["DATABASE_URL"])
-        else:
-            connection = psycopg2.connect(current_app.config["DATABASE_URL"], sslmode='require')
-        connection.set_session(autocommit=True)
-        # only creates connection once and saves it globally
-        g.db = connection
+        g.db_pool = get_pool()
+        with timed('db_pool_wait'):
+            g.db = g.db_pool.checkout()
     return g.db
 
-# close db connection when app shut down
+# return db connection to pool when app context is torn down
 def close_db_connection(e=None):
     db = g.pop('db', None)
+    connection_pool = g.pop('db_pool', None)
     if db is not None:
-        db.close()
+        connection_pool.release(db)
+
+# usage statistics of this process's pool, empty if no connection has been requested yet
+def get_pool_statistics():
+    connection_pool = current_app.extensions.get('db_pool')
+    if connection_pool is None or connection_pool.pid != os.getpid():
+        return {}
+    return connection_pool.statistics()
 
 # create db connection on app startup
 def init_db():
@@ -34,8 +182,9 @@ def init_db_command():
     click.echo('Initialized database state.')
 
 def init_app(app):
+    app.config.setdefault("DB_POOL_MIN_SIZE", 1)
+    app.config.setdefault("DB_POOL_MAX_SIZE", 10)
+    app.config.setdefault("DB_POOL_CHECKOUT_TIMEOUT", 5.0)
     app.teardown_appcontext(close_db_connection)
+    add_gauge_source(app, 'db_pool', get_pool_statistics)
     app.cli.add_command(init_db_command)
-
-
-
@@ -0,0 +1,74 @@
+import random
+from .instrumentation import timed
+from .lazy_imports import lazy_import
+# sympy numbers are evaluated with mpmath, which is already installed as a sympy dependency
+# both are imported on first use, see lazy_imports.py
+mpmath = lazy_import('mpmath')
+sympy = lazy_import('sympy')
+
+# relative difference above which two numeric evaluations are considered clearly unequal
+NUMERIC_TOLERANCE = 1e-6
+# how many random values are tried per symbol before giving up on finding one that fits its assumptions
+MAX_SAMPLE_TRIES = 50
+
+# simplify expression repeatedly until sympy can't simplify it any further
+def simplify_fully(expression):
+    with timed('simplify'):
+        expression = expression.simplify()
+        while expression != expression.simplify():
+            expression = expression.simplify()
+    return expression
+
+# random rational/integer value consistent with every assumption on symbol (real, positive, integer, odd, ...)
+# returns None if no consistent value was found
+def sample_value(symbol, generator):
+    assumptions = symbol.assumptions0
+    for attempt in range(MAX_SAMPLE_TRIES):
+        # alternate between integers and fractions so both integer and non-integer symbols find values quickly
+        if attempt % 2 == 0:
+            candidate = sympy.Rational(generator.randint(-30, 30), generator.randint(2, 9))
+        else:
+            candidate = sympy.Integer(generator.randint(-9, 9))
+        if all(getattr(candidate, 'is_' + name) == value for name, value in assumptions.items()):
+            return candidate
+    return None
+
+# evaluate both expressions at random points that respect their symbols' assumptions
+# returns False if they clearly differ at some point, None if the test couldn't decide,
+# and True if they agreed at every point that could be evaluated
+def numerically_equivalent(first, second, points, seed=0):
+    symbols = sorted(first.free_symbols | second.free_symbols, key=lambda symbol: symbol.name)
+    try:
+        evaluate = sympy.lambdify(symbols, [first, second], 'mpmath')
+    except Exception:
+        return None
+
+    generator = random.Random(seed)
+    evaluated_points = 0
+    for _ in range(points):
+        values = [sample_value(symbol, generator) for symbol in symbols]
+        if None in values:
+            return None
+        try:
+            first_value, second_value = evaluate(*[mpmath.mpf(value.p) / value.q for value in values])
+            difference = abs(first_value - second_value)
+            scale = max(1, abs(first_value), abs(second_value))
+        except Exception:
+            # point outside domain of expression (division by zero, unevaluated integral, ...), try another
+            continue
+        if not (mpmath.isfinite(difference) and mpmath.isfinite(scale)):
+            continue
+        evaluated_points += 1
+        if difference > NUMERIC_TOLERANCE * scale:
+            return False
+    return True if evaluated_points > 0 else None
+
+# decide whether two expressions are mathematically equal
+# cheap numeric test rejects clearly unequal expressions first, symbolic simplification confirms the rest
+def expressions_equivalent(first, second, numeric_points=6):
+    if numeric_points > 0:
+        with timed('numeric_check'):
+            numerically_different = numerically_equivalent(first, second, numeric_points) == False
+        if numerically_different:
+            return False
+    return simplify_fully(first - second) == 0
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from .instrumentation import timed, add_gauge_source
+from .lazy_imports import lazy_import
+# library for parsing user algebraic inputs and determining symbolic equality
+# imported on first use, see lazy_imports.py
+sympy = lazy_import('sympy')
+
+# per-process LRU cache of parsed sympy objects built from problem_info_sympy rows
+# the stored representation strings are part of each key, so a row edited in the db misses the cache
+# and the stale entry simply ages out; sympy objects are immutable so entries can be shared across threads
+class ExpressionCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # return cached value for key, building and storing it with build() on a miss
+    def get_or_build(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        # parse outside the lock so one slow parse doesn't block other requests
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def statistics(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+# answer checking processes (see checker.py) run without an app, so they keep one cache per process
+_process_cache = ExpressionCache(4096)
+
+# size process cache of an answer checking process, called once when the process starts
+def configure_process_cache(max_entries):
+    _process_cache.max_entries = max_entries
+
+# cache lives on the app so each app instance (and each forked worker) has its own copy
+def get_expression_cache():
+    if not has_app_context():
+        return _process_cache
+    app = current_app._get_current_object()
+    cache = app.extensions.get('expression_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('expression_cache', ExpressionCache(app.config["EXPRESSION_CACHE_SIZE"]))
+    return cache
+
+# parse sympy representation stored for a problem, reusing the parsed object if it was seen before
+# assumptions dict is keyed by its items: symbols with different assumptions compare unequal in sympy
+def parse_problem_expression(problem_id, representation, assumptions=None, evaluate=True):
+    def build():
+        with timed('parse_problem'):
+            return sympy.parse_expr(representation, assumptions, evaluate=evaluate)
+    if has_app_context() and not current_app.config["EXPRESSION_CACHE_ENABLED"]:
+        return build()
+    assumption_key = frozenset(assumptions.items()) if assumptions else None
+    key = ('expression', problem_id, representation, assumption_key, evaluate)
+    return get_expression_cache().get_or_build(key, build)
+
+# build {symbol name: sympy symbol with assumptions} from (representation, sympy_assumption) rows of a problem
+# rows are keyed as a set since the query that loads them doesn't guarantee an order
+# returned dict is shared between requests and must not be modified by callers
+def parse_problem_assumptions(problem_id, assumption_rows):
+    def build():
+        sympy_assumptions = {}
+        for row in assumption_rows:
+            sympy_assumptions[row[0]] = sympy.parse_expr(row[1])
+        return sympy_assumptions
+    if has_app_context() and not current_app.config["EXPRESSION_CACHE_ENABLED"]:
+        return build()
+    key = ('assumptions', problem_id, frozenset(tuple(row) for row in assumption_rows))
+    return get_expression_cache().get_or_build(key, build)
+
+def init_app(app):
+    app.config.setdefault("EXPRESSION_CACHE_ENABLED", True)
+    app.config.setdefault("EXPRESSION_CACHE_SIZE", 4096)
+    app.config.setdefault("EXPRESSION_CACHE_WARM", False)
+    add_gauge_source(app, 'expression_cache', lambda: get_expression_cache().statistics())
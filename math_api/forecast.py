@@ -0,0 +1,247 @@
+import io
+import json
+import math
+from datetime import timedelta
+import click
+from flask.cli import with_appcontext
+from .db import get_db_connection
+from .lazy_imports import lazy_import
+# only needed to forecast load, imported on first use so the web app never loads it, see lazy_imports.py
+numpy = lazy_import('numpy')
+
+# scheduling rules of util.sql: problems assigned per user per day (assign_daily_questions/assign_all_daily_questions)
+# and longest interval between correct attempts (schedule_next_assignment)
+MAX_QUESTIONS = 10
+MAX_INTERVAL = 365
+# assigned_day of rows not in daily_assignment
+NOT_ASSIGNED = -(2 ** 62)
+
+# position of each item within its run of equal keys, e.g. [5, 5, 7, 9, 9, 9] -> [0, 1, 0, 0, 1, 2]
+def positions_in_runs(sorted_keys):
+    indices = numpy.arange(len(sorted_keys))
+    run_starts = numpy.ones(len(sorted_keys), dtype=bool)
+    run_starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return indices - numpy.maximum.accumulate(numpy.where(run_starts, indices, 0))
+
+# one int64 per item that sorts like its values in columns (first column most significant), since sorting one key
+# is much faster than numpy.lexsort; None if the columns' ranges don't fit in 63 bits together
+def combined_sort_key(columns):
+    minimums = [int(column.min()) for column in columns]
+    spans = [int(column.max()) - minimum + 1 for column, minimum in zip(columns, minimums)]
+    if math.prod(spans) >= 2 ** 63:
+        return None
+    key = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    for column, minimum, span in zip(columns, minimums, spans):
+        key = key * span + (column - minimum)
+    return key
+
+# interval_calculation_info and today's daily_assignment as arrays, one entry per (user, problem) row,
+# with the scheduling rules of util.sql applied to all rows at once
+# days are counted from the day the snapshot was taken (0), last_graduated_interval NULL is stored as 0
+# max_questions and max_interval can be changed to try out scheduling changes
+class SchedulingState:
+    def __init__(self, user_ids, problem_ids, correct_streaks, last_graduated_intervals, due_days, max_questions=MAX_QUESTIONS, max_interval=MAX_INTERVAL):
+        order = numpy.lexsort((problem_ids, user_ids))
+        self.user_ids = numpy.asarray(user_ids, dtype=numpy.int64)[order]
+        self.problem_ids = numpy.asarray(problem_ids, dtype=numpy.int64)[order]
+        self.correct_streaks = numpy.asarray(correct_streaks, dtype=numpy.int64)[order]
+        self.last_graduated_intervals = numpy.asarray(last_graduated_intervals, dtype=numpy.int64)[order]
+        self.due_days = numpy.asarray(due_days, dtype=numpy.int64)[order]
+        self.assigned_day = numpy.full(len(order), NOT_ASSIGNED, dtype=numpy.int64)
+        self.solved = numpy.zeros(len(order), dtype=bool)
+        self.max_questions = max_questions
+        self.max_interval = max_interval
+        # dense user numbers for per-user arrays, and sorted (user, problem) keys for finding rows
+        self.users, self.user_index = numpy.unique(self.user_ids, return_inverse=True)
+        self._key_stride = int(self.problem_ids.max()) + 1 if len(order) else 1
+        self._keys = self.user_ids * self._key_stride + self.problem_ids
+
+    def copy(self):
+        state = object.__new__(SchedulingState)
+        state.__dict__.update({name: value.copy() if isinstance(value, numpy.ndarray) else value for name, value in self.__dict__.items()})
+        return state
+
+    # row of each (user_id, problem_id), -1 if there is none
+    def row_indices(self, user_ids, problem_ids):
+        keys = numpy.asarray(user_ids, dtype=numpy.int64) * self._key_stride + numpy.asarray(problem_ids, dtype=numpy.int64)
+        rows = numpy.minimum(numpy.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        found = (numpy.asarray(problem_ids) < self._key_stride) & (self._keys[rows] == keys) if len(self._keys) else numpy.zeros(len(keys), dtype=bool)
+        return numpy.where(found, rows, -1)
+
+    # record rows assigned on day, e.g. today's daily_assignment rows when loading a snapshot
+    def set_assignments(self, day, rows, solved):
+        self.assigned_day[rows] = day
+        self.solved[rows] = solved
+
+    # assign_all_daily_questions: each user without an assignment for day gets up to max_questions problems due by then,
+    # earliest due first, then lowest streak, then lowest problem id; assignments of earlier days are dropped
+    # returns newly assigned rows
+    def assign(self, day):
+        has_assignment = numpy.zeros(len(self.users), dtype=bool)
+        has_assignment[self.user_index[self.assigned_day == day]] = True
+        candidates = numpy.flatnonzero((self.due_days <= day) & ~has_assignment[self.user_index])
+        if not len(candidates):
+            return candidates
+        columns = [self.user_index[candidates], self.due_days[candidates], self.correct_streaks[candidates], self.problem_ids[candidates]]
+        sort_key = combined_sort_key(columns)
+        candidates = candidates[numpy.argsort(sort_key) if sort_key is not None else numpy.lexsort(columns[::-1])]
+        assigned = candidates[positions_in_runs(self.user_index[candidates]) < self.max_questions]
+        self.set_assignments(day, assigned, False)
+        return assigned
+
+    # schedule_next_assignment for attempts at given rows on day, in the order given
+    # attempts at different rows don't affect each other, so the k-th attempt at every row is applied at once
+    def apply_attempts(self, day, rows, correct):
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        correct = numpy.asarray(correct, dtype=bool)
+        if not len(rows):
+            return
+        order = numpy.argsort(rows, kind='stable')
+        attempt_numbers = numpy.empty(len(rows), dtype=numpy.int64)
+        attempt_numbers[order] = positions_in_runs(rows[order])
+        for attempt_number in range(int(attempt_numbers.max()) + 1):
+            selected = attempt_numbers == attempt_number
+            self._apply_attempt_round(day, rows[selected], correct[selected])
+
+    # attempts at distinct rows, only those assigned today and not solved yet change the schedule
+    def _apply_attempt_round(self, day, rows, correct):
+        scheduled = (self.assigned_day[rows] == day) & ~self.solved[rows]
+        rows, correct = rows[scheduled], correct[scheduled]
+
+        # correct: due 1, 2, 4 days later for streaks of 0, 1, 2, then double the last interval up to max_interval
+        solved_rows = rows[correct]
+        streaks = self.correct_streaks[solved_rows]
+        doubled = numpy.minimum(self.last_graduated_intervals[solved_rows] * 2, self.max_interval)
+        intervals = numpy.select([streaks > 2, streaks == 2, streaks == 1], [doubled, 4, 2], 1)
+        self.due_days[solved_rows] = numpy.maximum(self.due_days[solved_rows], day) + intervals
+        self.last_graduated_intervals[solved_rows] = numpy.select([streaks > 2, streaks == 2], [doubled, 4], 0)
+        self.correct_streaks[solved_rows] = streaks + 1
+        self.solved[solved_rows] = True
+
+        # incorrect: streak starts over and problem is due again right away
+        failed_rows = rows[~correct]
+        self.correct_streaks[failed_rows] = 0
+        self.due_days[failed_rows] = day
+
+# read result of query into an int64 array with one row per result row, using COPY instead of building python tuples
+def copy_query_to_array(cursor, query, columns):
+    rows_file = io.StringIO()
+    cursor.copy_expert(f'COPY ({query}) TO STDOUT;', rows_file)
+    return numpy.fromstring(rows_file.getvalue(), dtype=numpy.int64, sep=' ').reshape(-1, columns)
+
+# snapshot of interval_calculation_info and today's daily_assignment, day 0 being the db's CURRENT_DATE
+def load_scheduling_state(cursor, max_questions=MAX_QUESTIONS, max_interval=MAX_INTERVAL):
+    rows = copy_query_to_array(cursor, 'SELECT user_id, problem_id, correct_streak, COALESCE(last_graduated_interval, 0), '
+        'earliest_calculated_due_date - CURRENT_DATE FROM interval_calculation_info', 5)
+    state = SchedulingState(*rows.T, max_questions=max_questions, max_interval=max_interval)
+    assignments = copy_query_to_array(cursor, 'SELECT user_id, problem_id, solved::int FROM daily_assignment WHERE date = CURRENT_DATE', 3)
+    assigned_rows = state.row_indices(assignments[:, 0], assignments[:, 1])
+    found = assigned_rows >= 0
+    state.set_assignments(0, assigned_rows[found], assignments[found, 2].astype(bool))
+    return state
+
+# how users answer, estimated from recent attempts (see estimate_behaviour) or given to try out scenarios
+# active_probabilities: chance each user of the state (in state.users order) works through their problems on a given day
+# first_correct: chance an assigned problem is answered correctly on the first attempt of the day
+# retry: chance of trying again the same day after an incorrect answer, retry_correct: chance that retry is correct
+class UserBehaviour:
+    def __init__(self, active_probabilities, first_correct, retry, retry_correct, max_attempts):
+        self.active_probabilities = active_probabilities
+        self.first_correct = first_correct
+        self.retry = retry
+        self.retry_correct = retry_correct
+        self.max_attempts = max_attempts
+
+# replay attempts of the last lookback_days days: how often each user shows up, how often first attempts and retries of a
+# problem on a day are correct, and how often an incorrect answer is retried the same day
+def estimate_behaviour(cursor, state, lookback_days):
+    cursor.execute('SELECT user_id, COUNT(DISTINCT attempt_date) FROM user_attempt_log '
+        'WHERE attempt_date >= CURRENT_DATE - %s AND attempt_date < CURRENT_DATE GROUP BY user_id;', (lookback_days,))
+    active_probabilities = numpy.zeros(len(state.users))
+    user_days = numpy.array(cursor.fetchall(), dtype=numpy.int64).reshape(-1, 2)
+    positions = numpy.minimum(numpy.searchsorted(state.users, user_days[:, 0]), max(len(state.users) - 1, 0))
+    known = state.users[positions] == user_days[:, 0] if len(state.users) else numpy.zeros(len(user_days), dtype=bool)
+    active_probabilities[positions[known]] = user_days[known, 1] / lookback_days
+
+    cursor.execute('SELECT AVG(correct::int) FILTER (WHERE attempt_number = 1), AVG(correct::int) FILTER (WHERE attempt_number > 1), '
+        'AVG((attempt_number < attempts_that_day)::int) FILTER (WHERE NOT correct), MAX(attempts_that_day) '
+        'FROM (SELECT correct, row_number() OVER day_attempts AS attempt_number, COUNT(*) OVER (PARTITION BY user_id, problem_id, attempt_date) AS attempts_that_day '
+        'FROM user_attempt_log WHERE attempt_date >= CURRENT_DATE - %s AND attempt_date < CURRENT_DATE '
+        'WINDOW day_attempts AS (PARTITION BY user_id, problem_id, attempt_date ORDER BY id)) AS attempts;', (lookback_days,))
+    first_correct, retry_correct, retry, max_attempts = cursor.fetchone()
+    return UserBehaviour(active_probabilities, float(first_correct or 0), float(retry or 0), float(retry_correct or 0), int(max_attempts or 1))
+
+# one simulated day: assign problems, then each active user answers their unsolved problems (retrying some wrong answers)
+# returns counts for the day
+def simulate_day(state, day, behaviour, generator):
+    assigned = state.assign(day)
+    active_users = generator.random(len(state.users)) < behaviour.active_probabilities
+    open_rows = numpy.flatnonzero((state.assigned_day == day) & ~state.solved)
+    rows = open_rows[active_users[state.user_index[open_rows]]]
+    attempts = 0
+    correct_attempts = 0
+    correct_probability = behaviour.first_correct
+    for _ in range(behaviour.max_attempts):
+        if not len(rows):
+            break
+        correct = generator.random(len(rows)) < correct_probability
+        state.apply_attempts(day, rows, correct)
+        attempts += len(rows)
+        correct_attempts += int(correct.sum())
+        rows = rows[~correct]
+        rows = rows[generator.random(len(rows)) < behaviour.retry]
+        correct_probability = behaviour.retry_correct
+    return {
+        'active_users': int(active_users.sum()),
+        'assigned': len(assigned),
+        'attempts': attempts,
+        'correct': correct_attempts,
+        # problems due that didn't fit in the day's assignments
+        'backlog': int(((state.due_days <= day) & (state.assigned_day != day)).sum()),
+    }
+
+# average daily counts over runs simulations of days days after the snapshot (the rest of the snapshot's day is simulated first)
+def forecast_load(state, behaviour, days, runs=1, seed=0):
+    generator = numpy.random.default_rng(seed)
+    totals = [dict.fromkeys(('active_users', 'assigned', 'attempts', 'correct', 'backlog'), 0) for _ in range(days)]
+    for _ in range(runs):
+        run_state = state.copy()
+        simulate_day(run_state, 0, behaviour, generator)
+        for day in range(1, days + 1):
+            for name, count in simulate_day(run_state, day, behaviour, generator).items():
+                totals[day - 1][name] += count
+    return [{name: count / runs for name, count in day_totals.items()} for day_totals in totals]
+
+@click.command('forecast-load')
+@click.option('--days', default=30, show_default=True, help='days to forecast, starting tomorrow')
+@click.option('--runs', default=5, show_default=True, help='simulations averaged')
+@click.option('--lookback', default=28, show_default=True, help='days of attempt history user behaviour is estimated from')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--max-questions', default=MAX_QUESTIONS, show_default=True, help='problems assigned per user per day')
+@click.option('--max-interval', default=MAX_INTERVAL, show_default=True, help='longest interval in days between correct attempts')
+@click.option('--active-rate', type=float, help='chance every user shows up on a given day, instead of each user\'s estimate')
+@click.option('--correct-rate', type=float, help='chance a first attempt is correct, instead of the estimate')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='also write forecast as json')
+@with_appcontext
+def forecast_load_command(days, runs, lookback, seed, max_questions, max_interval, active_rate, correct_rate, output):
+    cursor = get_db_connection().cursor()
+    cursor.execute('SELECT CURRENT_DATE;')
+    snapshot_date = cursor.fetchone()[0]
+    state = load_scheduling_state(cursor, max_questions, max_interval)
+    behaviour = estimate_behaviour(cursor, state, lookback)
+    cursor.close()
+    if active_rate is not None:
+        behaviour.active_probabilities = numpy.full(len(state.users), active_rate)
+    if correct_rate is not None:
+        behaviour.first_correct = correct_rate
+    click.echo(f'{len(state.user_ids)} scheduled problems for {len(state.users)} users, expected {behaviour.active_probabilities.sum():.0f} active users a day, '
+        f'{behaviour.first_correct:.0%} of first attempts correct, {behaviour.retry:.0%} of wrong answers retried')
+
+    forecast = forecast_load(state, behaviour, days, runs, seed)
+    click.echo(f'{"date":<12}{"logins":>10}{"assigned":>10}{"checks":>10}{"correct":>10}{"backlog":>10}')
+    for day, counts in enumerate(forecast, 1):
+        forecast_date = snapshot_date + timedelta(days=day)
+        click.echo(f'{forecast_date.isoformat():<12}{counts["active_users"]:>10.0f}{counts["assigned"]:>10.0f}{counts["attempts"]:>10.0f}{counts["correct"]:>10.0f}{counts["backlog"]:>10.0f}')
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump([dict(counts, date=(snapshot_date + timedelta(days=day)).isoformat()) for day, counts in enumerate(forecast, 1)], output_file, indent=2)
@@ -0,0 +1,278 @@
+import io
+import os
+import csv
+import json
+import time
+import multiprocessing
+import click
+# composes statements with identifiers (constraint names) that can't be passed as parameters
+from psycopg2 import sql
+from flask.cli import with_appcontext
+from .db import get_db_connection
+from .lazy_imports import lazy_import
+# library for parsing user algebraic inputs and determining symbolic equality
+# imported on first use, see lazy_imports.py
+sympy = lazy_import('sympy')
+
+# problem_info columns read from every problem
+PROBLEM_COLUMNS = ('problem_latex', 'sample_solution_latex', 'assumptions_latex', 'expression_type')
+PROBLEM_SYMPY_COLUMNS = ('problem_id', 'info_type', 'representation', 'sympy_assumption')
+
+# schedule every existing user's first attempt at each new problem, introducing per_day new problems a day starting tomorrow
+# (in file order), the same way initialize_interval_calculation_table spreads all problems out for a new user, see util.sql
+# rows are inserted in (user_id, problem_id) order, the order of every index on the table
+BACKFILL_INTERVALS_SELECT = ('INSERT INTO interval_calculation_info(problem_id, user_id, correct_streak, earliest_calculated_due_date) '
+    'SELECT new_problem.id, user_info.id, 0, CURRENT_DATE + 1 + (new_problem.position - 1)::int / %(per_day)s '
+    'FROM unnest(%(problem_ids)s::int[]) WITH ORDINALITY AS new_problem(id, position) CROSS JOIN user_info ')
+BACKFILL_INTERVALS = BACKFILL_INTERVALS_SELECT + 'ORDER BY user_info.id, new_problem.id;'
+# same for users that didn't get the new problems yet, i.e. were created while they were being backfilled
+BACKFILL_MISSED_INTERVALS = (BACKFILL_INTERVALS_SELECT + 'WHERE NOT EXISTS (SELECT 1 FROM interval_calculation_info '
+    'WHERE interval_calculation_info.user_id = user_info.id AND interval_calculation_info.problem_id = (%(problem_ids)s::int[])[1]) '
+    'ORDER BY user_info.id, new_problem.id ON CONFLICT DO NOTHING;')
+
+# thrown when problems file can't be read at all
+class IngestError(Exception):
+    pass
+
+# read problems one at a time, yields (line number, problem, error reading it)
+# jsonl: one object per line in the shape of benchmarks/corpus.py, i.e. problem_info columns plus representation,
+# solutions (list of sympy strings) and assumptions (list of [symbol name, sympy assumption] pairs)
+# csv: header with the same names, solutions and assumptions columns hold those lists as json
+def read_problems(path, file_format=None):
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in ('jsonl', 'csv'):
+        raise IngestError(f'Unknown problems file format {file_format!r}, expected jsonl or csv')
+    with open(path, newline='') as problems_file:
+        if file_format == 'jsonl':
+            for line_number, line in enumerate(problems_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line), None
+                except ValueError as error:
+                    yield line_number, None, f'invalid json: {error}'
+        else:
+            reader = csv.DictReader(problems_file)
+            for row in reader:
+                try:
+                    row['solutions'] = json.loads(row.get('solutions') or '[]')
+                    row['assumptions'] = json.loads(row.get('assumptions') or '[]')
+                except ValueError as error:
+                    yield reader.line_num, None, f'solutions and assumptions must be json lists: {error}'
+                    continue
+                # csv can't tell an empty string from a missing value
+                row['assumptions_latex'] = row.get('assumptions_latex') or None
+                yield reader.line_num, row, None
+
+# list of everything wrong with problem, empty if it can be loaded
+# representations are parsed the same way answer checking parses them, see expression_cache.py
+# runs in validation processes, so it only takes and returns plain values
+def validate_problem(problem):
+    if not isinstance(problem, dict):
+        return ['problem must be an object']
+    errors = [f'{field} is required' for field in ('problem_latex', 'sample_solution_latex', 'expression_type', 'representation')
+        if not isinstance(problem.get(field), str) or not problem[field].strip()]
+    if not isinstance(problem.get('assumptions_latex'), (str, type(None))):
+        errors.append('assumptions_latex must be a string')
+    solutions = problem.get('solutions')
+    if not isinstance(solutions, list) or not solutions or not all(isinstance(solution, str) for solution in solutions):
+        errors.append('solutions must be a non-empty list of strings')
+    assumptions = problem.get('assumptions', [])
+    if not isinstance(assumptions, list) or not all(isinstance(row, (list, tuple)) and len(row) == 2 and all(isinstance(value, str) for value in row) for row in assumptions):
+        errors.append('assumptions must be a list of [symbol name, sympy assumption] pairs')
+    if errors:
+        return errors
+
+    local_dict = {}
+    for name, assumption in assumptions:
+        try:
+            symbol = sympy.parse_expr(assumption)
+        except Exception as error:
+            errors.append(f'assumption for {name} could not be parsed: {error!r}')
+            continue
+        if not isinstance(symbol, sympy.Symbol) or symbol.name != name:
+            errors.append(f'assumption for {name} must be a Symbol named {name}')
+        local_dict[name] = symbol
+    try:
+        sympy.parse_expr(problem['representation'], local_dict, evaluate=False)
+    except Exception as error:
+        errors.append(f'representation could not be parsed: {error!r}')
+    for solution in solutions:
+        try:
+            sympy.parse_expr(solution, local_dict)
+        except Exception as error:
+            errors.append(f'solution {solution!r} could not be parsed: {error!r}')
+    return errors
+
+# value in postgres COPY text format
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_rows(cursor, table, columns, rows):
+    rows_file = io.StringIO()
+    for row in rows:
+        rows_file.write('\t'.join(copy_value(value) for value in row) + '\n')
+    rows_file.seek(0)
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN;', rows_file)
+
+# COPY problems and their sympy rows into db, returns the new problem ids in the same order
+# ids are taken from problem_info's sequence up front so problem_info_sympy rows can reference them
+def load_problems(cursor, problems):
+    cursor.execute("SELECT nextval(pg_get_serial_sequence('problem_info', 'id')) FROM generate_series(1, %s);", (len(problems),))
+    problem_ids = [row[0] for row in cursor.fetchall()]
+    copy_rows(cursor, 'problem_info', ('id',) + PROBLEM_COLUMNS,
+        [(problem_id,) + tuple(problem.get(column) for column in PROBLEM_COLUMNS) for problem_id, problem in zip(problem_ids, problems)])
+    sympy_rows = []
+    for problem_id, problem in zip(problem_ids, problems):
+        sympy_rows.append((problem_id, 'problem', problem['representation'], None))
+        sympy_rows += [(problem_id, 'sample_solution', solution, None) for solution in problem['solutions']]
+        sympy_rows += [(problem_id, 'assumption', name, assumption) for name, assumption in problem.get('assumptions', [])]
+    copy_rows(cursor, 'problem_info_sympy', PROBLEM_SYMPY_COLUMNS, sympy_rows)
+    return problem_ids
+
+# (name, definition) of each validated foreign key of interval_calculation_info
+def get_interval_foreign_keys(cursor):
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = 'interval_calculation_info'::regclass AND contype = 'f' AND convalidated;")
+    return cursor.fetchall()
+
+# add interval_calculation_info rows for new problems for every existing user in one statement, returns rows added
+# foreign keys are checked by a trigger per inserted row, which takes most of the time of a backfill with millions of rows,
+# so with offline set they are dropped for the insert and re-added and validated with one join each afterwards
+# (inside the caller's transaction, so they can never be seen missing, but interval_calculation_info, which every login
+# and solve reads, can't be used until commit, and user creation waits too)
+# without offline, users created meanwhile are caught up by backfill_missed_intervals after commit
+def backfill_intervals(cursor, problem_ids, per_day, offline=False):
+    foreign_keys = []
+    if offline:
+        # users created while backfilling would miss the new problems (their trigger can't see them before commit),
+        # so user creation waits until this transaction commits
+        cursor.execute('LOCK TABLE user_info IN SHARE MODE;')
+        foreign_keys = get_interval_foreign_keys(cursor)
+    for name, _ in foreign_keys:
+        cursor.execute(sql.SQL('ALTER TABLE interval_calculation_info DROP CONSTRAINT {};').format(sql.Identifier(name)))
+    cursor.execute(BACKFILL_INTERVALS, {'problem_ids': problem_ids, 'per_day': per_day})
+    interval_count = cursor.rowcount
+    for name, definition in foreign_keys:
+        cursor.execute(sql.SQL('ALTER TABLE interval_calculation_info ADD CONSTRAINT {} {} NOT VALID;').format(sql.Identifier(name), sql.SQL(definition)))
+        cursor.execute(sql.SQL('ALTER TABLE interval_calculation_info VALIDATE CONSTRAINT {};').format(sql.Identifier(name)))
+    return interval_count
+
+# schedule new problems, once committed, for users created while backfill_intervals ran, returns rows added
+# user creation waits for this short transaction, so every user is either caught up here or created after the
+# problems are visible to initialize_interval_calculation_table, see util.sql
+# cursor must belong to a connection in autocommit mode, like the pooled ones (see db.py)
+def backfill_missed_intervals(cursor, problem_ids, per_day):
+    cursor.execute('BEGIN;')
+    try:
+        cursor.execute('LOCK TABLE user_info IN SHARE MODE;')
+        cursor.execute(BACKFILL_MISSED_INTERVALS, {'problem_ids': problem_ids, 'per_day': per_day})
+        interval_count = cursor.rowcount
+        cursor.execute('COMMIT;')
+    except BaseException:
+        cursor.execute('ROLLBACK;')
+        raise
+    return interval_count
+
+# yield lists of up to size items from iterable
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# validate problems from file in a pool of processes and load the valid ones, all in one transaction:
+# problems are read, validated and copied in batches (the next batch is validated while the last one is copied),
+# then every existing user gets interval_calculation_info rows for the new problems in one statement
+# nothing is loaded with dry_run, or with strict if any problem is invalid
+# returns (new problem ids, (line number, errors) of each invalid problem, interval rows added, seconds spent per step)
+def ingest_problems(path, file_format=None, processes=None, batch_size=1000, per_day=10, dry_run=False, strict=False, offline=False):
+    cursor = get_db_connection().cursor()
+    processes = processes or os.cpu_count()
+    problem_ids = []
+    invalid = []
+    seconds = {'validate': 0.0, 'copy': 0.0, 'backfill': 0.0}
+    # forkserver starts validation processes from a clean process with sympy already imported
+    # instead of forking this one, which holds a db connection
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['sympy', 'mpmath', 'math_api.ingest'])
+
+    def finish_batch(readable, validation):
+        start = time.perf_counter()
+        results = validation.get()
+        seconds['validate'] += time.perf_counter() - start
+        valid = []
+        for (line_number, problem), errors in zip(readable, results):
+            if errors:
+                invalid.append((line_number, errors))
+            else:
+                valid.append(problem)
+        if valid and not dry_run:
+            start = time.perf_counter()
+            problem_ids.extend(load_problems(cursor, valid))
+            seconds['copy'] += time.perf_counter() - start
+
+    cursor.execute('BEGIN;')
+    try:
+        with context.Pool(processes) as validation_pool:
+            chunk_size = max(1, batch_size // (4 * processes))
+            pending = None
+            for batch in batched(read_problems(path, file_format), batch_size):
+                invalid += [(line_number, [error]) for line_number, _, error in batch if error is not None]
+                readable = [(line_number, problem) for line_number, problem, error in batch if error is None]
+                validation = validation_pool.map_async(validate_problem, [problem for _, problem in readable], chunk_size)
+                if pending:
+                    finish_batch(*pending)
+                pending = (readable, validation)
+            if pending:
+                finish_batch(*pending)
+
+        if dry_run or (strict and invalid) or not problem_ids:
+            cursor.execute('ROLLBACK;')
+            return [], invalid, 0, seconds
+
+        start = time.perf_counter()
+        interval_count = backfill_intervals(cursor, problem_ids, per_day, offline)
+        cursor.execute('COMMIT;')
+    except BaseException:
+        cursor.execute('ROLLBACK;')
+        raise
+    if not offline:
+        interval_count += backfill_missed_intervals(cursor, problem_ids, per_day)
+    seconds['backfill'] = time.perf_counter() - start
+    # planner statistics are stale after a bulk load
+    cursor.execute('ANALYZE problem_info, problem_info_sympy, interval_calculation_info;')
+    return problem_ids, invalid, interval_count, seconds
+
+@click.command('ingest-problems')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['jsonl', 'csv']), help='format of problems file (default: its extension)')
+@click.option('--processes', type=int, help='validation processes (default: one per cpu)')
+@click.option('--batch-size', default=1000, show_default=True, help='problems validated and copied at a time')
+@click.option('--per-day', type=click.IntRange(min=1), default=10, show_default=True, help='new problems introduced to existing users each day')
+@click.option('--strict', is_flag=True, help='load nothing if any problem is invalid')
+@click.option('--dry-run', is_flag=True, help='only validate the problems')
+@click.option('--offline', is_flag=True, help='drop foreign keys during the backfill, several times faster but locks interval_calculation_info '
+    '(logins and solves) and user creation until it finishes')
+@with_appcontext
+def ingest_problems_command(path, file_format, processes, batch_size, per_day, strict, dry_run, offline):
+    try:
+        problem_ids, invalid, interval_count, seconds = ingest_problems(path, file_format, processes, batch_size, per_day, dry_run, strict, offline)
+    except IngestError as error:
+        raise click.ClickException(str(error))
+    for line_number, errors in sorted(invalid):
+        click.echo(f'line {line_number}: {"; ".join(errors)}', err=True)
+    click.echo(f'Validated in {seconds["validate"]:.1f}s, copied in {seconds["copy"]:.1f}s, backfilled in {seconds["backfill"]:.1f}s.')
+    if invalid and (strict or dry_run):
+        raise click.ClickException(f'{len(invalid)} invalid problems, nothing was loaded')
+    if dry_run:
+        click.echo('All problems are valid, nothing was loaded (dry run).')
+        return
+    click.echo(f'Loaded {len(problem_ids)} problems ({len(invalid)} invalid skipped) and scheduled them with {interval_count} interval rows.')
+    if problem_ids:
+        click.echo('Run `flask precompute-problems` to store their canonical forms.')
@@ -0,0 +1,332 @@
+import os
+import sys
+import hmac
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from flask import Blueprint, Response, current_app, request
+from psycopg2.extensions import connection as PostgresConnection, cursor as PostgresCursor
+
+# initalize blueprint to load metrics route handler onto
+metrics_blueprint = Blueprint('metrics', __name__)
+
+# upper bounds (in seconds) of histogram buckets, from a single cached parse up to a check close to its timeout
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# stage timings of the request (or answer check) running in this thread, {stage: [seconds, calls]}
+# None outside of requests, so cli commands and background threads don't collect anything
+_local = threading.local()
+
+def start_collecting():
+    _local.stages = {}
+
+def stop_collecting():
+    stages = getattr(_local, 'stages', None)
+    _local.stages = None
+    return stages or {}
+
+# add time spent in a stage to the current request's breakdown
+def record_stage(stage, seconds, calls=1):
+    stages = getattr(_local, 'stages', None)
+    if stages is not None:
+        totals = stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+
+# add stage timings collected somewhere else, e.g. in an answer checking process
+def merge_stages(stages):
+    for stage, (seconds, calls) in stages.items():
+        record_stage(stage, seconds, calls)
+
+# time block of code as a stage of the current request, e.g. with timed('simplify'): ...
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+# cursor mixin timing every statement as the 'db' stage
+class TimedCursorMixin:
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_stage('db', time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_stage('db', time.perf_counter() - start)
+
+    def callproc(self, procname, parameters=None):
+        start = time.perf_counter()
+        try:
+            return super().callproc(procname, parameters)
+        finally:
+            record_stage('db', time.perf_counter() - start)
+
+_timed_cursor_classes = {}
+
+# timed subclass of given cursor class (plain cursor, RealDictCursor, ...), built once per class
+def timed_cursor_class(cursor_class):
+    timed_class = _timed_cursor_classes.get(cursor_class)
+    if timed_class is None:
+        timed_class = _timed_cursor_classes.setdefault(cursor_class, type('Timed' + cursor_class.__name__, (TimedCursorMixin, cursor_class), {}))
+    return timed_class
+
+# postgres connection whose cursors time their queries, whatever cursor_factory callers ask for
+class TimedConnection(PostgresConnection):
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = timed_cursor_class(kwargs.get('cursor_factory') or self.cursor_factory or PostgresCursor)
+        return super().cursor(*args, **kwargs)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+# monotonically increasing count per label combination
+class MetricCounter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+
+    def increment(self, label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+# cumulative histogram of observed durations per label combination
+class MetricHistogram:
+    def __init__(self, name, help_text, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, label_values, value):
+        bucket_counts, total = self._values.get(label_values, (None, None))
+        if bucket_counts is None:
+            bucket_counts = [0] * (len(self.buckets) + 1)
+            total = 0.0
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket_counts[index] += 1
+                break
+        else:
+            bucket_counts[-1] += 1
+        self._values[label_values] = (bucket_counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for label_values, (bucket_counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), bucket_counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, label_values, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, label_values)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, label_values)} {cumulative}')
+        return lines
+
+# request/stage metrics of this worker process, rendered in prometheus text format by /metrics
+# each gunicorn worker keeps its own metrics, so every worker has to be scraped (or run with one worker)
+class RequestMetrics:
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self.requests = MetricCounter('math_api_requests_total', 'Requests handled, by endpoint, method and status code.', ('endpoint', 'method', 'status'))
+        self.request_seconds = MetricHistogram('math_api_request_duration_seconds', 'Time spent handling requests.', ('endpoint',))
+        self.stage_seconds = MetricHistogram('math_api_stage_duration_seconds', 'Time a request spent in each stage (db queries, sympy parsing/simplifying, password hashing, ...).', ('endpoint', 'stage'))
+        self.stage_calls = MetricCounter('math_api_stage_calls_total', 'Number of times each stage ran, e.g. db queries per endpoint.', ('endpoint', 'stage'))
+        self.slow_requests = MetricCounter('math_api_slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS.', ('endpoint',))
+
+    def observe_request(self, endpoint, method, status, seconds, stages, slow):
+        with self._lock:
+            self.requests.increment((endpoint, method, str(status)))
+            self.request_seconds.observe((endpoint,), seconds)
+            for stage, (stage_seconds, calls) in stages.items():
+                self.stage_seconds.observe((endpoint, stage), stage_seconds)
+                self.stage_calls.increment((endpoint, stage), calls)
+            if slow:
+                self.slow_requests.increment((endpoint,))
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.request_seconds, self.stage_seconds, self.stage_calls, self.slow_requests):
+                lines += metric.render()
+            return lines
+
+# periodically records the stack of every request in flight, so slow requests can be logged with where they spent their time
+# sampling happens from a separate thread, requests themselves only register/unregister
+class StackSampler:
+    def __init__(self, interval):
+        self.pid = os.getpid()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = {}
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def register(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def unregister(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None) or Counter()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self._fold(frame)] += 1
+
+    # stack as 'module:function;module:function;...' from outermost to innermost frame
+    @staticmethod
+    def _fold(frame):
+        stack = []
+        while frame is not None:
+            stack.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+_state_lock = threading.Lock()
+
+# metrics and sampler are created lazily per process, counters and threads don't carry over a gunicorn fork
+def get_request_metrics():
+    app = current_app._get_current_object()
+    metrics = app.extensions.get('request_metrics')
+    if metrics is not None and metrics.pid == os.getpid():
+        return metrics
+    with _state_lock:
+        metrics = app.extensions.get('request_metrics')
+        if metrics is None or metrics.pid != os.getpid():
+            metrics = RequestMetrics()
+            app.extensions['request_metrics'] = metrics
+    return metrics
+
+def get_stack_sampler():
+    app = current_app._get_current_object()
+    sampler = app.extensions.get('stack_sampler')
+    if sampler is not None and sampler.pid == os.getpid():
+        return sampler
+    with _state_lock:
+        sampler = app.extensions.get('stack_sampler')
+        if sampler is None or sampler.pid != os.getpid():
+            sampler = StackSampler(app.config["SLOW_REQUEST_SAMPLE_INTERVAL"])
+            app.extensions['stack_sampler'] = sampler
+    return sampler
+
+# register function returning {name: number} (e.g. pool or cache statistics) to be exported as gauges named math_api_<prefix>_<name>
+def add_gauge_source(app, prefix, get_statistics):
+    app.extensions.setdefault('gauge_sources', []).append((prefix, get_statistics))
+
+def start_request_timing():
+    if not current_app.config["INSTRUMENTATION_ENABLED"]:
+        return
+    _local.request_start = time.perf_counter()
+    start_collecting()
+    if current_app.config["SLOW_REQUEST_SECONDS"] > 0:
+        get_stack_sampler().register()
+
+# attach stage breakdown to response as Server-Timing header and record request in metrics
+def finish_request_timing(response):
+    if not current_app.config["INSTRUMENTATION_ENABLED"] or getattr(_local, 'stages', None) is None:
+        return response
+    seconds = time.perf_counter() - _local.request_start
+    stages = stop_collecting()
+    if current_app.config["SERVER_TIMING_ENABLED"]:
+        timings = [f'{stage};dur={stage_seconds * 1000:.1f}' for stage, (stage_seconds, calls) in stages.items()]
+        response.headers.add('Server-Timing', ', '.join(timings + [f'total;dur={seconds * 1000:.1f}']))
+
+    # urls without a route are labelled together so 404s can't create a metric per path
+    endpoint = request.endpoint or 'unmatched'
+    threshold = current_app.config["SLOW_REQUEST_SECONDS"]
+    slow = threshold > 0 and seconds >= threshold
+    if threshold > 0:
+        samples = get_stack_sampler().unregister()
+        if slow:
+            log_slow_request(endpoint, seconds, stages, samples)
+    get_request_metrics().observe_request(endpoint, request.method, response.status_code, seconds, stages, slow)
+    return response
+
+# make sure nothing is left over for the next request handled by this thread, e.g. after an unhandled error
+def reset_request_timing(e=None):
+    if getattr(_local, 'stages', None) is not None:
+        stop_collecting()
+        if current_app.config["SLOW_REQUEST_SECONDS"] > 0:
+            get_stack_sampler().unregister()
+
+# log where slow request spent its time: stage breakdown and its most frequently sampled stacks
+def log_slow_request(endpoint, seconds, stages, samples):
+    breakdown = ', '.join(f'{stage} {stage_seconds * 1000:.1f}ms/{calls}' for stage, (stage_seconds, calls) in stages.items())
+    total_samples = sum(samples.values())
+    hottest = '\n'.join(f'  {count}/{total_samples} {stack}' for stack, count in samples.most_common(current_app.config["SLOW_REQUEST_STACKS"]))
+    current_app.logger.warning('Slow request %s %s (%s) took %.3fs: %s\n%s', request.method, request.path, endpoint, seconds, breakdown, hottest)
+
+# address of client, behind METRICS_TRUSTED_PROXIES proxies (e.g. 1 for the heroku router) it is the address
+# the outermost of them appended to X-Forwarded-For, anything before that was sent by the client and can't be trusted
+def client_address():
+    trusted_proxies = current_app.config["METRICS_TRUSTED_PROXIES"]
+    if trusted_proxies <= 0:
+        return request.remote_addr
+    forwarded_for = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',') if address.strip()]
+    return forwarded_for[-trusted_proxies] if len(forwarded_for) >= trusted_proxies else None
+
+# scrapers either send METRICS_TOKEN as a bearer token or connect from one of METRICS_ALLOWED_ADDRESSES
+def metrics_allowed():
+    token = current_app.config["METRICS_TOKEN"]
+    if token:
+        authorization = request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer ') and hmac.compare_digest(authorization[len('Bearer '):].encode(), token.encode()):
+            return True
+    return client_address() in current_app.config["METRICS_ALLOWED_ADDRESSES"]
+
+# this worker's metrics in prometheus text format, only served to allowed scrapers, see metrics_allowed
+# everyone else gets a bare 404, returned directly since the app's 404 handler would send the frontend instead
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    if not current_app.config["INSTRUMENTATION_ENABLED"] or not metrics_allowed():
+        return Response('', 404)
+    lines = get_request_metrics().render()
+    for prefix, get_statistics in current_app.extensions.get('gauge_sources', []):
+        for name, value in get_statistics().items():
+            if name != 'pid' and isinstance(value, (int, float)):
+                lines += [f'# TYPE math_api_{prefix}_{name} gauge', f'math_api_{prefix}_{name} {value}']
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    app.config.setdefault("INSTRUMENTATION_ENABLED", True)
+    app.config.setdefault("SERVER_TIMING_ENABLED", True)
+    app.config.setdefault("METRICS_ALLOWED_ADDRESSES", ['127.0.0.1', '::1'])
+    app.config.setdefault("METRICS_TOKEN", None)
+    app.config.setdefault("METRICS_TRUSTED_PROXIES", 0)
+    app.config.setdefault("SLOW_REQUEST_SECONDS", 0.0)
+    app.config.setdefault("SLOW_REQUEST_SAMPLE_INTERVAL", 0.005)
+    app.config.setdefault("SLOW_REQUEST_STACKS", 5)
+    app.before_request(start_request_timing)
+    app.after_request(finish_request_timing)
+    app.teardown_request(reset_request_timing)
+    app.register_blueprint(metrics_blueprint)
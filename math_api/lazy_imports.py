@@ -0,0 +1,24 @@
+import sys
+import importlib.util
+
+# module object whose real import only runs when one of its attributes is first used
+# sympy and mpmath take most of a cold start, but web workers only need them to check answers inline
+# (answers are normally checked in separate processes, see checker.py) or for cli commands that parse problems
+# raises ModuleNotFoundError right away if the module isn't installed, instead of failing on first use
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# run deferred imports of given modules now, e.g. in the gunicorn master so forked workers share the loaded modules
+def load_now(*names):
+    for name in names:
+        getattr(lazy_import(name), '__doc__')
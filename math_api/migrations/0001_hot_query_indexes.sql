@@ -0,0 +1,37 @@
+-- indexes matched to the predicates of the queries run on every login, daily listing and solve
+-- `flask check-query-plans` verifies the hot queries use them
+
+-- today's problems for a user (get_problems_assigned_today), "already assigned today?" check in assign_daily_questions,
+-- and the unsolved-assignment lookup in schedule_next_assignment all filter on user_id and date, the latter also on problem_id
+-- solved is included so those checks are answered from the index alone
+-- one full index instead of a partial one on unsolved rows, since the assignment check has to see solved rows too
+CREATE INDEX IF NOT EXISTS daily_assignment_user_date_idx ON daily_assignment (user_id, date, problem_id) INCLUDE (solved);
+
+-- due problems for a user in the order they are assigned (assign_daily_questions, assign_all_daily_questions)
+-- WHERE user_id = ? AND earliest_calculated_due_date <= CURRENT_DATE ORDER BY earliest_calculated_due_date, correct_streak, problem_id
+-- becomes a range scan that stops after the first rows, without a sort
+CREATE INDEX IF NOT EXISTS interval_calculation_info_due_idx ON interval_calculation_info (user_id, earliest_calculated_due_date, correct_streak, problem_id);
+
+-- interval updates after every attempt (schedule_next_assignment) and a user's problem listing look up (user_id, problem_id)
+-- only created if the table doesn't already have an index (e.g. its primary key) starting with those two columns
+DO $$
+begin
+  if NOT EXISTS (
+    SELECT 1 FROM pg_index
+    INNER JOIN pg_attribute first_column ON first_column.attrelid = pg_index.indrelid AND first_column.attnum = pg_index.indkey[0]
+    INNER JOIN pg_attribute second_column ON second_column.attrelid = pg_index.indrelid AND second_column.attnum = pg_index.indkey[1]
+    WHERE pg_index.indrelid = 'interval_calculation_info'::regclass
+    AND ARRAY[first_column.attname::text, second_column.attname::text] <@ ARRAY['user_id', 'problem_id']
+    AND ARRAY[first_column.attname::text, second_column.attname::text] @> ARRAY['user_id', 'problem_id']
+  ) then
+    CREATE INDEX interval_calculation_info_user_problem_idx ON interval_calculation_info (user_id, problem_id);
+  end if;
+end;
+$$;
+
+-- a user's attempts at one problem (reset_problem_statistics groups them by attempt_date and counts correct ones),
+-- and all of a user's attempts (delete_user, reset_user)
+CREATE INDEX IF NOT EXISTS user_attempt_log_user_problem_idx ON user_attempt_log (user_id, problem_id, attempt_date) INCLUDE (correct);
+
+-- sympy rows of the problems being checked (get_problems_for_checking) and of one problem (seed-verdicts, precompute-problems)
+CREATE INDEX IF NOT EXISTS problem_info_sympy_problem_idx ON problem_info_sympy (problem_id, info_type);
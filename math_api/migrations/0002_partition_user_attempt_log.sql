@@ -0,0 +1,42 @@
+-- range partition user_attempt_log by month of attempt_date (create_attempt_log_partitions in util.sql), so months
+-- past the retention period are detached and archived whole by `flask archive-attempt-log` instead of deleted row by row,
+-- and the table's indexes and vacuuming stay bounded by the retention period instead of growing with all history
+-- postgres can't partition an existing table, so attempts are copied into a new partitioned table that takes its name
+-- the old table is locked until the copy commits, so run it when few answers are being submitted
+DO $$
+declare
+  id_sequence text := pg_get_serial_sequence('user_attempt_log', 'id');
+  first_attempt date;
+begin
+  if EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'user_attempt_log'::regclass) then
+    return;
+  end if;
+  ALTER TABLE user_attempt_log RENAME TO user_attempt_log_unpartitioned;
+  -- same columns, types and defaults (the id sequence), primary key has to include the partition key
+  CREATE TABLE user_attempt_log (LIKE user_attempt_log_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (attempt_date);
+  -- catches attempts of months whose partition hasn't been created yet, instead of failing the insert
+  CREATE TABLE user_attempt_log_default PARTITION OF user_attempt_log DEFAULT;
+  SELECT MIN(attempt_date) INTO first_attempt FROM user_attempt_log_unpartitioned;
+  call create_attempt_log_partitions(COALESCE(first_attempt, CURRENT_DATE), 2);
+
+  -- copied before triggers exist, statistics rollups already count these attempts
+  INSERT INTO user_attempt_log SELECT * FROM user_attempt_log_unpartitioned;
+  if id_sequence IS NOT NULL then
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY user_attempt_log.id', id_sequence);
+  end if;
+  DROP TABLE user_attempt_log_unpartitioned;
+
+  -- constraints and indexes are created on every partition, after the copy since building them once is faster
+  ALTER TABLE user_attempt_log ADD PRIMARY KEY (id, attempt_date);
+  ALTER TABLE user_attempt_log ADD FOREIGN KEY (user_id) REFERENCES user_info(id);
+  ALTER TABLE user_attempt_log ADD FOREIGN KEY (problem_id) REFERENCES problem_info(id);
+  CREATE INDEX user_attempt_log_user_problem_idx ON user_attempt_log (user_id, problem_id, attempt_date) INCLUDE (correct);
+
+  -- same triggers as util.sql, they apply to every partition
+  CREATE TRIGGER calculate_intervals AFTER INSERT ON user_attempt_log FOR EACH ROW EXECUTE FUNCTION schedule_next_assignment();
+  CREATE TRIGGER maintain_attempt_statistics AFTER INSERT ON user_attempt_log FOR EACH ROW EXECUTE FUNCTION update_attempt_statistics();
+end;
+$$;
+
+-- autovacuum never analyzes partitioned parents, plans of queries over all partitions need their statistics
+ANALYZE user_attempt_log;
@@ -0,0 +1,3 @@
+-- shared verdicts used to be keyed on answers with all whitespace removed, which merged answers sympy parses differently
+-- ('sin x' doesn't parse, 'sinx' is a symbol), they are only a cache, so drop them all, `flask seed-verdicts` refills them
+TRUNCATE answer_verdict;
@@ -0,0 +1,15 @@
+-- the statistics and problem endpoints only read the user_daily_statistics and user_problem_statistics rollups, which the
+-- update_attempt_statistics trigger (util.sql) keeps up to date from the first attempt after it's created, so count the
+-- attempts logged before that, same as rebuild_attempt_statistics (which commits, so it can't be called from a migration)
+-- attempts are held off until this commits, so each one is counted exactly once, by this or by the trigger
+LOCK TABLE user_attempt_log IN SHARE MODE;
+TRUNCATE user_daily_statistics, user_problem_statistics;
+
+CREATE TEMPORARY TABLE attempt_counts ON COMMIT DROP AS
+  SELECT user_id, problem_id, attempt_date, COUNT(*) filter (where correct) AS solved, COUNT(*) AS attempts FROM user_attempt_log GROUP BY user_id, problem_id, attempt_date
+  UNION ALL
+  SELECT user_id, problem_id, attempt_date, solved, attempts FROM archived_attempt_statistics;
+INSERT INTO user_daily_statistics(user_id, attempt_date, solved, attempts)
+  SELECT user_id, attempt_date, SUM(solved), SUM(attempts) FROM attempt_counts GROUP BY user_id, attempt_date;
+INSERT INTO user_problem_statistics(user_id, problem_id, solved, attempts, most_recent_attempt)
+  SELECT user_id, problem_id, SUM(solved), SUM(attempts), MAX(attempt_date) FROM attempt_counts GROUP BY user_id, problem_id;
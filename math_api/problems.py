@@ -1,16 +1,50 @@
-from flask import Blueprint, jsonify, abort, request
+import click
+from datetime import date
+from urllib.parse import urlencode
+from flask import Blueprint, jsonify, abort, request, current_app, json, stream_with_context
+from flask.cli import with_appcontext
 # allows cursor to return data in dict format instead of tuple
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 # library for restricting endpoints to authenticated users and auto parsing/authenticating tokens
 from flask_jwt_extended import jwt_required, current_user
 from .db import get_db_connection
+from .expression_cache import parse_problem_expression, parse_problem_assumptions
+from .equivalence import simplify_fully
+from .checker import run_answer_check, run_answer_checks, canonicalize_problem, CheckTimeout, CORRECT, MATCHES_PROBLEM, UNPARSEABLE
+from .verdicts import problem_signature, get_cached_verdict, store_verdict, seed_verdicts
+from .catalog import get_catalog, make_catalog_response
+from .attempt_log import queue_attempt, INSERT_ATTEMPTS, ATTEMPT_TEMPLATE
+from .attempt_archive import create_upcoming_partitions
+from .lazy_imports import lazy_import
 from json import loads
 # library for parsing user algebraic inputs and determining symbolic equality
-from sympy import parse_expr
+# imported on first use, see lazy_imports.py
+sympy = lazy_import('sympy')
 
 # initalize blueprint to load problem handling route handlers onto
 problems_blueprint = Blueprint('problems', __name__, url_prefix='/api/problems')
 
+# fields problem listings can be projected to, mapped to the columns they are read from
+PROBLEM_FIELDS = {
+    'id': 'problem_info.id',
+    'problem_latex': 'problem_info.problem_latex',
+    'sample_solution_latex': 'problem_info.sample_solution_latex',
+    'assumptions_latex': 'problem_info.assumptions_latex',
+    'expression_type': 'problem_info.expression_type',
+}
+# extra fields available to logged in users
+STATISTICS_FIELDS = {
+    'correct_streak': 'interval_calculation_info.correct_streak',
+    'earliest_calculated_due_date': 'interval_calculation_info.earliest_calculated_due_date',
+}
+
+# messages sent back for answers that can't be judged correct or incorrect
+CHECK_TIMEOUT_MESSAGE = 'Answer took too long to check. Please resubmit a simpler form'
+VERDICT_ERROR_MESSAGES = {
+    UNPARSEABLE: 'Answer did not follow correct format and could not be parsed. Please resubmit',
+    MATCHES_PROBLEM: 'Answer matches problem symbolically. Please answer with simplified version of problem',
+}
+
 # procedure that determines which questions user should answer today and tracks them
 # should be called during startup/login
 def assign_daily_problems(user_id):
@@ -19,6 +53,22 @@ def assign_daily_problems(user_id):
     cursor.execute('call assign_daily_questions(%s);', (user_id,))
     cursor.close()
 
+# procedure that rolls over every user's daily problems for the new day in one pass
+# meant to be run by a scheduler shortly after midnight, so logins only need to confirm today's problems exist
+def assign_all_daily_problems():
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    cursor.execute('call assign_all_daily_questions();')
+    # attempt log partitions for the coming months, so attempts don't pile up in its default partition
+    create_upcoming_partitions(cursor)
+    cursor.close()
+
+@click.command('assign-daily-problems')
+@with_appcontext
+def assign_daily_problems_command():
+    assign_all_daily_problems()
+    click.echo('Assigned daily problems for all users.')
+
 # determine all problems that are assigned today and haven't been solved yet for given user
 def get_problems_assigned_today(user_id):
     db_connection = get_db_connection()
@@ -39,13 +89,31 @@ def get_problems():
     cursor.close()
     return problems
 
-# get problem info mixed with user's statistics for each problem
-def get_problems_with_statistics(user_id):
+# get one page of problems with id greater than after_id, in id order, using the primary key instead of an offset
+# fields must come from PROBLEM_FIELDS (or STATISTICS_FIELDS when a user_id is given), problems can be filtered
+# by expression type and, for a user, by due date; a user_id restricts the page to problems scheduled for that user
+def get_problem_page(user_id, fields, after_id, limit, expression_types=None, due_before=None):
+    available_fields = dict(PROBLEM_FIELDS, **STATISTICS_FIELDS) if user_id != None else PROBLEM_FIELDS
+    columns = ', '.join(f'{available_fields[field]} AS {field}' for field in fields)
+    query = f'SELECT {columns} FROM problem_info '
+    parameters = []
+    if user_id != None:
+        query += 'INNER JOIN interval_calculation_info ON problem_info.id = interval_calculation_info.problem_id AND interval_calculation_info.user_id=%s '
+        parameters.append(user_id)
+    query += 'WHERE problem_info.id > %s '
+    parameters.append(after_id)
+    if expression_types:
+        query += 'AND problem_info.expression_type = ANY(%s) '
+        parameters.append(list(expression_types))
+    if due_before != None:
+        query += 'AND interval_calculation_info.earliest_calculated_due_date <= %s '
+        parameters.append(due_before)
+    query += 'ORDER BY problem_info.id LIMIT %s;'
+    parameters.append(limit)
+
     db_connection = get_db_connection()
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT problem_info.id, problem_info.problem_latex, problem_info.sample_solution_latex, problem_info.assumptions_latex, problem_info.expression_type, '
-    'interval_calculation_info.correct_streak, interval_calculation_info.earliest_calculated_due_date '
-    'FROM problem_info INNER JOIN interval_calculation_info ON problem_info.id = interval_calculation_info.problem_id AND interval_calculation_info.user_id=%s ORDER BY problem_info.id;', (user_id,))
+    cursor.execute(query, parameters)
     problems = cursor.fetchall()
     cursor.close()
     return problems
@@ -63,68 +131,113 @@ def get_problem(problem_id):
 def get_problem_with_statistics(user_id, problem_id):
     db_connection = get_db_connection()
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    # statistics come from rollup kept up to date by update_attempt_statistics trigger, see util.sql
     cursor.execute('SELECT problem_info.id, problem_info.problem_latex, problem_info.sample_solution_latex, problem_info.assumptions_latex, problem_info.expression_type, '
-    'COUNT(user_attempt_log.correct) filter(where user_attempt_log.correct) AS solved, '
-    'COUNT(user_attempt_log.response) AS attempts, '
-    'MAX(user_attempt_log.attempt_date) AS most_recent_solved '
-    'FROM problem_info LEFT JOIN user_attempt_log ON problem_info.id = user_attempt_log.problem_id AND user_attempt_log.user_id=%s WHERE problem_info.id = %s '
-    'GROUP BY problem_info.id, problem_info.problem_latex, problem_info.sample_solution_latex, problem_info.assumptions_latex, problem_info.expression_type;', (user_id, problem_id))
+    'COALESCE(user_problem_statistics.solved, 0) AS solved, '
+    'COALESCE(user_problem_statistics.attempts, 0) AS attempts, '
+    'user_problem_statistics.most_recent_attempt AS most_recent_solved '
+    'FROM problem_info LEFT JOIN user_problem_statistics ON problem_info.id = user_problem_statistics.problem_id AND user_problem_statistics.user_id=%s WHERE problem_info.id = %s;', (user_id, problem_id))
     problem = cursor.fetchone()
     cursor.close()
     return problem
 
-# get all assumptions 
-def get_problem_assumptions(problem_id):
+# get problem info for each given id along with everything needed to check answers to it, in a single query
+# sympy rows (with precomputed canonical forms, see precompute-problems) are aggregated into one json array per problem
+# returns dict of problem id -> problem info, with problem['check_info'] holding
+# (expression type, (symbol name, sympy assumption) rows, problem representation, sample solution representations)
+def get_problems_for_checking(problem_ids):
     db_connection = get_db_connection()
-    cursor = db_connection.cursor()
-    cursor.execute('SELECT representation, sympy_assumption FROM problem_info_sympy WHERE problem_id=%s AND sympy_assumption IS NOT NULL;', (problem_id,))
-    assumptions = cursor.fetchall()
+    cursor = db_connection.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT problem_info.id, problem_info.problem_latex, problem_info.sample_solution_latex, problem_info.assumptions_latex, problem_info.expression_type, "
+    "COALESCE(json_agg(json_build_array(problem_info_sympy.info_type, problem_info_sympy.representation, problem_info_sympy.sympy_assumption, problem_info_canonical.canonical_representation)) "
+    "FILTER (WHERE problem_info_sympy.problem_id IS NOT NULL), '[]') AS sympy_rows "
+    "FROM problem_info LEFT JOIN problem_info_sympy ON problem_info_sympy.problem_id = problem_info.id "
+    "LEFT JOIN problem_info_canonical ON problem_info_canonical.problem_id = problem_info_sympy.problem_id "
+    "AND problem_info_canonical.info_type = problem_info_sympy.info_type AND problem_info_canonical.representation = problem_info_sympy.representation "
+    "WHERE problem_info.id = ANY(%s) GROUP BY problem_info.id;", (list(problem_ids),))
+    problems = cursor.fetchall()
     cursor.close()
 
-    sympy_assumptions = {}
-    for row in assumptions:
-        sympy_assumptions[row[0]] = parse_expr(row[1])
-    return sympy_assumptions
+    problems_by_id = {}
+    for problem in problems:
+        sympy_rows = problem.pop('sympy_rows')
+        # canonical form is only joined if it was computed from the representation currently stored (None otherwise)
+        assumption_rows = [(row[1], row[2]) for row in sympy_rows if row[2] is not None]
+        problem_representation = next((row[1], row[3]) for row in sympy_rows if row[0] == 'problem')
+        solution_representations = [(row[1], row[3]) for row in sympy_rows if row[0] == 'sample_solution']
+        problem['check_info'] = (problem['expression_type'], assumption_rows, problem_representation, solution_representations)
+        problems_by_id[problem['id']] = problem
+    return problems_by_id
 
-def compare_problem_to_answer(problem_id, answer_expression, assumptions):
+# get problem info and checking info for a single problem, None if it doesn't exist
+def get_problem_for_checking(problem_id):
+    return get_problems_for_checking([problem_id]).get(problem_id)
+
+# evaluate and simplify every problem and sample solution once and store the result as srepr strings
+# so answer checking only has to simplify the part that depends on the user's answer
+def precompute_canonical_forms():
     db_connection = get_db_connection()
     cursor = db_connection.cursor()
-    cursor.execute("SELECT representation FROM problem_info_sympy WHERE problem_id=%s AND info_type='problem'; ", (problem_id,))
-    sympy_problem_string = cursor.fetchone()[0]
-    cursor.execute("SELECT expression_type FROM problem_info WHERE id=%s;", (problem_id,))
-    problem_type = cursor.fetchone()[0]
+    cursor.execute('SELECT problem_info_sympy.problem_id, problem_info_sympy.info_type, problem_info_sympy.representation, problem_info_sympy.sympy_assumption, problem_info.expression_type '
+    'FROM problem_info_sympy INNER JOIN problem_info ON problem_info.id = problem_info_sympy.problem_id ORDER BY problem_info_sympy.problem_id;')
+    rows = cursor.fetchall()
+
+    rows_by_problem = {}
+    for row in rows:
+        rows_by_problem.setdefault(row[0], []).append(row)
+    for problem_id, problem_rows in rows_by_problem.items():
+        assumptions = parse_problem_assumptions(problem_id, [(row[2], row[3]) for row in problem_rows if row[3] is not None])
+        canonical_rows = []
+        for _, info_type, representation, _, problem_type in problem_rows:
+            if info_type == 'problem':
+                problem_expression = parse_problem_expression(problem_id, representation, assumptions, evaluate=False)
+                canonical_rows.append((problem_id, info_type, representation, sympy.srepr(canonicalize_problem(problem_expression, problem_type))))
+            elif info_type == 'sample_solution':
+                solution_expression = parse_problem_expression(problem_id, representation, assumptions)
+                canonical_rows.append((problem_id, info_type, representation, sympy.srepr(simplify_fully(solution_expression))))
+        # replace all canonical forms of problem at once so stale representations don't linger
+        cursor.execute('DELETE FROM problem_info_canonical WHERE problem_id=%s;', (problem_id,))
+        for canonical_row in canonical_rows:
+            cursor.execute('INSERT INTO problem_info_canonical(problem_id, info_type, representation, canonical_representation) VALUES (%s, %s, %s, %s);', canonical_row)
     cursor.close()
+    return len(rows_by_problem)
 
-    problem_expression = parse_expr(sympy_problem_string, assumptions, evaluate=False)
-    if problem_expression == answer_expression:
-        raise RuntimeError('Answer matches problem symbolically. Please answer with simplified version of problem')
-    
-    # if problem is derivative/integral, execute operation
-    if problem_type == 'derivative' or problem_type == 'integral':
-        problem_expression = problem_expression.doit()
-
-    # simplify both problem and user response as much as possible
-    sympy_user_comparison = (problem_expression - answer_expression).simplify()
-    while sympy_user_comparison != sympy_user_comparison.simplify():
-        sympy_user_comparison = sympy_user_comparison.simplify()
-    # if user submits answer that is mathematically equal to problem, log it as correct and inform user that it is correct
-    return sympy_user_comparison == 0
-
-def compare_solutions_to_answer(problem_id, answer_expression, assumptions):
+@click.command('precompute-problems')
+@with_appcontext
+def precompute_problems_command():
+    problem_count = precompute_canonical_forms()
+    click.echo(f'Precomputed canonical forms for {problem_count} problems.')
+
+# everything needed to check an answer to problem: its type, assumption rows and sympy representations
+def get_problem_check_info(problem_id):
+    return get_problem_for_checking(problem_id)['check_info']
+
+@click.command('seed-verdicts')
+@with_appcontext
+def seed_verdicts_command():
+    problem_count = seed_verdicts(get_problem_check_info)
+    click.echo(f'Seeded answer verdicts for {problem_count} problems from attempt history.')
+
+# parse every stored problem representation, assumption and sample solution ahead of time
+# so the first attempt at each problem in this process doesn't pay the parsing cost
+def warm_expression_cache():
     db_connection = get_db_connection()
     cursor = db_connection.cursor()
-    cursor.execute("SELECT representation FROM problem_info_sympy WHERE problem_id=%s AND info_type='sample_solution'; ", (problem_id,))
-    sympy_solution_strings = cursor.fetchall()
-    solution_expressions = list(map(lambda r: parse_expr(r[0], assumptions), sympy_solution_strings))
+    cursor.execute('SELECT problem_id, info_type, representation, sympy_assumption FROM problem_info_sympy ORDER BY problem_id;')
+    rows = cursor.fetchall()
     cursor.close()
 
-    for solution_expression in solution_expressions:
-        sympy_user_comparison = (solution_expression - answer_expression).simplify()
-        while sympy_user_comparison != sympy_user_comparison.simplify():
-            sympy_user_comparison = sympy_user_comparison.simplify()
-        if sympy_user_comparison == 0:
-            return True
-    return False
+    rows_by_problem = {}
+    for row in rows:
+        rows_by_problem.setdefault(row[0], []).append(row)
+    for problem_id, problem_rows in rows_by_problem.items():
+        assumptions = parse_problem_assumptions(problem_id, [(row[2], row[3]) for row in problem_rows if row[3] is not None])
+        for row in problem_rows:
+            if row[1] == 'problem':
+                parse_problem_expression(problem_id, row[2], assumptions, evaluate=False)
+            elif row[1] == 'sample_solution':
+                parse_problem_expression(problem_id, row[2], assumptions)
+    return len(rows_by_problem)
 
 # erase all attempts for given problem and user from history
 def reset_problem(user_id, problem_id):
@@ -137,12 +250,27 @@ def reset_problem(user_id, problem_id):
 
 # insert problem attempt into db
 # next daily attempt will be scheduled based on schedule_next_assignment trigger, see util.sql for definition
+# in write-behind mode attempt is inserted later by a background thread, see attempt_log.py
 def log_response(user_id, problem_id, correct, response):
+    if queue_attempt(user_id, problem_id, correct, response):
+        return
     db_connection = get_db_connection()
     cursor = db_connection.cursor()
     cursor.execute('INSERT INTO user_attempt_log(user_id, problem_id, response, correct, attempt_date) VALUES (%s, %s, %s, %s, CURRENT_DATE);', (user_id, problem_id, response, correct))
     cursor.close()
 
+# insert several (problem_id, correct, response) attempts into db with one multi-row insert
+# schedule_next_assignment runs once per row in the order given, so the outcome is the same as logging them one at a time
+def log_responses(user_id, attempts):
+    rows = [(user_id, problem_id, response, correct) for problem_id, correct, response in attempts
+        if not queue_attempt(user_id, problem_id, correct, response)]
+    if not rows:
+        return
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    execute_values(cursor, INSERT_ATTEMPTS, rows, template=ATTEMPT_TEMPLATE, page_size=len(rows))
+    cursor.close()
+
 # endpoint to process a user attempt to solve a problem
 @problems_blueprint.route('/solve/<int:problem_id>', methods=['POST'])
 @jwt_required()
@@ -153,46 +281,117 @@ def solve_problem(problem_id):
 
     # send error if problem id doesn't exist
     # (frontend handles error page)
-    problem = get_problem(problem_id)
+    # problem info, algebraic assumptions about symbols used in problem (e.g. assuming x is real or y is an integer)
+    # and sympy representations of problem and sample solutions are all loaded in one query
+    problem = get_problem_for_checking(problem_id)
     if problem == None:
         abort(404, f'Problem with id {problem_id} does not exist')
+    check_info = problem['check_info']
 
-    # load algebraic assumptions about symbols used in problem
-    # e.g. assuming x is real or y is an integer
-    sympy_assumptions = get_problem_assumptions(problem_id)
-    
-    # try to parse user response algebraically, throw error if sympy cannot create valid expression
-    try:
-        answer_expression = parse_expr(answer, sympy_assumptions)
-    except Exception:
-        abort(400, f'Answer did not follow correct format and could not be parsed. Please resubmit')
+    # answers are cached and checked as strings, like in parse_batch_submissions
+    if not isinstance(answer, str):
+        abort(400, 'Answer must be a string')
 
-    try:
-        correct_check_one = compare_problem_to_answer(problem_id, answer_expression, sympy_assumptions)
-        if correct_check_one:
-            log_response(user_id, problem_id, True, answer)
-            return {'sample_solution': problem['sample_solution_latex'], 'correct': True}
-    except RuntimeError as error:
-        abort(400, str(error))
-
-    correct_check_two = compare_solutions_to_answer(problem_id, answer_expression, sympy_assumptions)
-    if correct_check_two:
-        # logging the response will trigger another function that will calculate when to next assign this problem
-        # see schedule_next_assignment in util.sql
-        log_response(user_id, problem_id, True, answer)
-        return {'sample_solution': problem['sample_solution_latex'], 'correct': True}
-
-    # process 3: if response is not equal to solved problem or solution, the user is informed that it is incorrect and given a sample solution
-    # response is logged
-    log_response(user_id, problem_id, False, answer)
-    return {'sample_solution': problem['sample_solution_latex'], 'correct': False}
+    # reuse verdict if this answer was already checked against current version of problem, see verdicts.py
+    signature = problem_signature(*check_info)
+    verdict = get_cached_verdict(problem_id, signature, answer)
+
+    # parse response and compare it to the problem and its sample solutions
+    # runs in a separate process with a time limit so pathological answers can't tie up this worker, see checker.py
+    if verdict is None:
+        try:
+            verdict = run_answer_check(problem_id, answer, *check_info)
+        except CheckTimeout:
+            abort(400, CHECK_TIMEOUT_MESSAGE)
+        store_verdict(problem_id, signature, answer, verdict)
+
+    # throw error if sympy cannot create valid expression or answer is just the problem
+    if verdict in VERDICT_ERROR_MESSAGES:
+        abort(400, VERDICT_ERROR_MESSAGES[verdict])
+
+    # if response is equal to solved problem or a sample solution, it is correct, otherwise the user is informed that it is incorrect
+    # either way the user is given a sample solution and the response is logged
+    # logging the response will trigger another function that will calculate when to next assign this problem
+    # see schedule_next_assignment in util.sql
+    correct = verdict == CORRECT
+    log_response(user_id, problem_id, correct, answer)
+    return {'sample_solution': problem['sample_solution_latex'], 'correct': correct}
+
+# read (problem_id, answer) pairs of a batch submission, sending error if the batch is malformed
+def parse_batch_submissions():
+    payload = request.get_json(silent=True)
+    submissions = payload.get('answers') if isinstance(payload, dict) else None
+    if not isinstance(submissions, list) or not submissions:
+        abort(400, 'Answers must be sent as a non-empty list under "answers"')
+    max_batch_size = current_app.config["PROBLEM_SOLVE_BATCH_MAX_SIZE"]
+    if len(submissions) > max_batch_size:
+        abort(400, f'At most {max_batch_size} answers can be sent at once')
+    parsed_submissions = []
+    for submission in submissions:
+        # json true/false arrive as bools, which python also counts as ints
+        if not isinstance(submission, dict) or type(submission.get('problem_id')) is not int or not isinstance(submission.get('answer'), str):
+            abort(400, 'Each answer must have an integer problem_id and a string answer')
+        parsed_submissions.append((submission['problem_id'], submission['answer']))
+    return parsed_submissions
+
+# endpoint to process many attempts at once, e.g. a whole day's problems
+# takes {"answers": [{"problem_id": 1, "answer": "2*x"}, ...]} and returns a list with one result per answer, in the same order:
+# {"problem_id", "correct", "sample_solution"} like /solve/<problem_id>, or {"problem_id", "status", "error"} with the
+# error /solve/<problem_id> would have sent, in which case the attempt isn't logged
+@problems_blueprint.route('/solve/batch', methods=['POST'])
+@jwt_required()
+def solve_problems():
+    user_id = current_user['id']
+    submissions = parse_batch_submissions()
+
+    # every problem in the batch is loaded in one query, see get_problems_for_checking
+    problems = get_problems_for_checking({problem_id for problem_id, _ in submissions})
+
+    # reuse cached verdicts, see verdicts.py, and check the remaining answers in parallel in the checking processes
+    # an answer sent twice for the same problem is only checked once
+    signatures = {problem_id: problem_signature(*problem['check_info']) for problem_id, problem in problems.items()}
+    verdicts = {}
+    unchecked = []
+    for problem_id, answer in submissions:
+        if problem_id in problems and (problem_id, answer) not in verdicts:
+            verdicts[(problem_id, answer)] = get_cached_verdict(problem_id, signatures[problem_id], answer)
+            if verdicts[(problem_id, answer)] is None:
+                unchecked.append((problem_id, answer))
+    check_results = run_answer_checks([(problem_id, answer, *problems[problem_id]['check_info']) for problem_id, answer in unchecked])
+    for (problem_id, answer), verdict in zip(unchecked, check_results):
+        if not isinstance(verdict, CheckTimeout):
+            store_verdict(problem_id, signatures[problem_id], answer, verdict)
+        verdicts[(problem_id, answer)] = verdict
+
+    results = []
+    attempts = []
+    for problem_id, answer in submissions:
+        verdict = verdicts.get((problem_id, answer))
+        if problem_id not in problems:
+            results.append({'problem_id': problem_id, 'status': 404, 'error': f'Problem with id {problem_id} does not exist'})
+        elif isinstance(verdict, CheckTimeout):
+            results.append({'problem_id': problem_id, 'status': 400, 'error': CHECK_TIMEOUT_MESSAGE})
+        elif verdict in VERDICT_ERROR_MESSAGES:
+            results.append({'problem_id': problem_id, 'status': 400, 'error': VERDICT_ERROR_MESSAGES[verdict]})
+        else:
+            correct = verdict == CORRECT
+            attempts.append((problem_id, correct, answer))
+            results.append({'problem_id': problem_id, 'sample_solution': problems[problem_id]['sample_solution_latex'], 'correct': correct})
+
+    # all attempts are logged in one insert, in submission order, see log_responses
+    log_responses(user_id, attempts)
+    return jsonify(results)
 
 # endpoint to return a given problem's info
 @problems_blueprint.route('/<int:problem_id>', methods=['GET'])
 @jwt_required(optional=True)
 def get_problem_by_id(problem_id):
-    # if no token sent, just send the math info about the problem
+    # if no token sent, just send the math info about the problem from cached catalog, see catalog.py
     if current_user == None:
+        catalog_entry = get_catalog(get_problems).problem_json_by_id.get(problem_id)
+        if catalog_entry != None:
+            return make_catalog_response(*catalog_entry)
+        # problem may have been added since catalog was loaded
         problem = get_problem(problem_id)
         # send error if problem doesn't exist
         if problem == None:
@@ -242,17 +441,81 @@ def get_daily_problems():
     daily_problems = get_problems_assigned_today(user_id)
     return jsonify(daily_problems)
 
+# read listing options from query string, sending error if any is invalid
+# fields: comma separated fields to return (id is always included), defaults to every field
+# expression_type: only problems of these types (comma separated or repeated)
+# due_before: only problems due on or before this date (yyyy-mm-dd), logged in users only
+# after/limit: return at most limit problems with id greater than after, see get_problem_page
+def parse_listing_arguments(logged_in):
+    available_fields = dict(PROBLEM_FIELDS, **STATISTICS_FIELDS) if logged_in else PROBLEM_FIELDS
+    fields = list(available_fields)
+    if 'fields' in request.args:
+        requested_fields = [field for field in request.args['fields'].split(',') if field]
+        unknown_fields = [field for field in requested_fields if field not in available_fields]
+        if unknown_fields:
+            abort(400, f'Unknown fields {", ".join(unknown_fields)}. Available fields are {", ".join(available_fields)}')
+        fields = ['id'] + [field for field in dict.fromkeys(requested_fields) if field != 'id']
+
+    expression_types = [expression_type for value in request.args.getlist('expression_type') for expression_type in value.split(',') if expression_type]
+
+    due_before = None
+    if 'due_before' in request.args:
+        if not logged_in:
+            abort(400, 'Filtering by due date requires logging in')
+        try:
+            due_before = date.fromisoformat(request.args['due_before'])
+        except ValueError:
+            abort(400, 'due_before must be a date in yyyy-mm-dd format')
+
+    try:
+        after_id = int(request.args.get('after', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        abort(400, 'after and limit must be integers')
+    max_page_size = current_app.config["PROBLEM_PAGE_MAX_SIZE"]
+    if limit != None and not 0 < limit <= max_page_size:
+        abort(400, f'limit must be between 1 and {max_page_size}')
+    return fields, after_id, limit, expression_types, due_before
+
+# json array of every matching problem, read and serialized one batch at a time so the whole list is never held in memory
+# keeps its db connection (and app context) until the last batch has been sent
+def stream_problems(user_id, fields, after_id, expression_types, due_before):
+    batch_size = current_app.config["PROBLEM_STREAM_BATCH_SIZE"]
+    def generate():
+        separator = '['
+        last_id = after_id
+        while True:
+            problems = get_problem_page(user_id, fields, last_id, batch_size, expression_types, due_before)
+            for problem in problems:
+                yield separator + json.dumps(problem)
+                separator = ','
+            if len(problems) < batch_size:
+                break
+            last_id = problems[-1]['id']
+        yield ']' if separator == ',' else '[]'
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/json')
+
 # endpoint that returns all problem info
+# optional query parameters project, filter and paginate the listing, see parse_listing_arguments
 @problems_blueprint.route('/', methods=['GET'])
 @jwt_required(optional=True)
 def get_all_problems():
-    # if no/invalid token sent, simply send the math info for all problems
-    if current_user == None:
-        problems = get_problems()
-        return jsonify(problems)
+    user_id = current_user['id'] if current_user != None else None
+    # if no/invalid token sent and nothing but the full listing is asked for, simply send the math info for all problems from cached catalog, see catalog.py
+    if user_id == None and not request.args:
+        catalog = get_catalog(get_problems)
+        return make_catalog_response(catalog.problems_json, catalog.etag)
     # if valid token sent, send the user statistics for each problem along with the math info
-    else:
-        user_id = current_user['id']
-        problems = get_problems_with_statistics(user_id)
-        return jsonify(problems)
+    fields, after_id, limit, expression_types, due_before = parse_listing_arguments(user_id != None)
+    if limit == None:
+        return stream_problems(user_id, fields, after_id, expression_types, due_before)
+
+    # one extra problem is read to know whether there is a next page, which is linked in the Link header
+    problems = get_problem_page(user_id, fields, after_id, limit + 1, expression_types, due_before)
+    response = jsonify(problems[:limit])
+    if len(problems) > limit:
+        next_arguments = request.args.to_dict(flat=False)
+        next_arguments['after'] = [problems[limit - 1]['id']]
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(next_arguments, doseq=True)}>; rel="next"'
+    return response
 
@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import hashlib
+import click
+from flask.cli import with_appcontext
+from .db import get_db_connection
+
+# versioned sql files named <version>_<description>.sql, applied in version order and recorded in schema_migration
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d+)_(\w+)\.sql$')
+# key of the advisory lock held while migrating, so two deploys can't apply the same migration at once
+MIGRATION_LOCK_KEY = 72350214
+
+# thrown when migrations can't be listed or applied
+class MigrationError(Exception):
+    pass
+
+# queries run on every login, daily listing and solve, with the tables that must be read through an index
+# queries inside procedures/triggers are copied from util.sql, the rest from problems.py
+HOT_QUERIES = [
+    ('daily problems', 'SELECT problem_info.id, problem_info.problem_latex, problem_info.sample_solution_latex, problem_info.assumptions_latex, problem_info.expression_type '
+        'FROM daily_assignment INNER JOIN problem_info ON daily_assignment.problem_id = problem_info.id '
+        'WHERE date=CURRENT_DATE AND user_id=%(user_id)s AND solved=false ORDER BY problem_info.id;', ['daily_assignment']),
+    ('daily assignment check', 'SELECT 1 FROM daily_assignment WHERE user_id=%(user_id)s AND date=CURRENT_DATE;', ['daily_assignment']),
+    ('due problems', 'SELECT problem_id, user_id, CURRENT_DATE, false FROM interval_calculation_info WHERE earliest_calculated_due_date <= CURRENT_DATE AND user_id = %(user_id)s '
+        'ORDER BY earliest_calculated_due_date, correct_streak, problem_id LIMIT 10;', ['interval_calculation_info']),
+    ('unsolved assignment lookup', 'SELECT 1 FROM daily_assignment WHERE date=CURRENT_DATE AND problem_id=%(problem_id)s AND user_id=%(user_id)s AND solved=false;', ['daily_assignment']),
+    ('interval update', 'SELECT correct_streak FROM interval_calculation_info WHERE problem_id=%(problem_id)s AND user_id=%(user_id)s;', ['interval_calculation_info']),
+    ('problem listing page', 'SELECT problem_info.id, interval_calculation_info.correct_streak, interval_calculation_info.earliest_calculated_due_date FROM problem_info '
+        'INNER JOIN interval_calculation_info ON problem_info.id = interval_calculation_info.problem_id AND interval_calculation_info.user_id=%(user_id)s '
+        'WHERE problem_info.id > 0 ORDER BY problem_info.id LIMIT 100;', ['interval_calculation_info']),
+    ('problems for checking', 'SELECT problem_info.id, problem_info_sympy.info_type, problem_info_sympy.representation FROM problem_info '
+        'LEFT JOIN problem_info_sympy ON problem_info_sympy.problem_id = problem_info.id WHERE problem_info.id = ANY(%(problem_ids)s);', ['problem_info_sympy']),
+    ('problem attempts by day', 'SELECT attempt_date, COUNT(*) filter (where correct) AS solved, COUNT(*) AS attempts FROM user_attempt_log '
+        'WHERE user_id=%(user_id)s AND problem_id=%(problem_id)s GROUP BY attempt_date;', ['user_attempt_log']),
+]
+
+# (version, name, path) of every migration file, in the order they are applied
+def list_migrations():
+    migrations = []
+    for file_name in sorted(os.listdir(MIGRATIONS_DIRECTORY)):
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIRECTORY, file_name)))
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise MigrationError('Two migration files have the same version')
+    return sorted(migrations)
+
+def read_migration(path):
+    with open(path) as migration_file:
+        sql = migration_file.read()
+    return sql, hashlib.md5(sql.encode()).hexdigest()
+
+# {version: checksum} of migrations already applied to db
+def get_applied_migrations(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_migration (version int PRIMARY KEY, name text NOT NULL, checksum text NOT NULL, applied_at timestamptz NOT NULL DEFAULT now());')
+    cursor.execute('SELECT version, checksum FROM schema_migration;')
+    return dict(cursor.fetchall())
+
+# apply every migration not applied yet (up to target_version if given), each in its own transaction
+# cursor must belong to a connection in autocommit mode, like the pooled ones (see db.py)
+# returns (version, name) of each migration applied
+def apply_migrations(cursor, target_version=None):
+    cursor.execute('SELECT pg_advisory_lock(%s);', (MIGRATION_LOCK_KEY,))
+    try:
+        applied_migrations = get_applied_migrations(cursor)
+        applied = []
+        for version, name, path in list_migrations():
+            if version in applied_migrations or (target_version is not None and version > target_version):
+                continue
+            sql, checksum = read_migration(path)
+            cursor.execute('BEGIN;')
+            try:
+                cursor.execute(sql)
+                cursor.execute('INSERT INTO schema_migration(version, name, checksum) VALUES (%s, %s, %s);', (version, name, checksum))
+                cursor.execute('COMMIT;')
+            except Exception as error:
+                cursor.execute('ROLLBACK;')
+                raise MigrationError(f'Migration {version} ({name}) failed: {error}')
+            applied.append((version, name))
+        return applied
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s);', (MIGRATION_LOCK_KEY,))
+
+# (version, name, state) of every migration file, state being applied, pending or changed (edited after it was applied)
+def get_migration_status(cursor):
+    applied_migrations = get_applied_migrations(cursor)
+    status = []
+    for version, name, path in list_migrations():
+        if version not in applied_migrations:
+            state = 'pending'
+        elif applied_migrations[version] != read_migration(path)[1]:
+            state = 'changed'
+        else:
+            state = 'applied'
+        status.append((version, name, state))
+    return status
+
+# names of indexes used by plan node and the nodes below it
+def plan_indexes(plan):
+    indexes = [plan['Index Name']] if 'Index Name' in plan else []
+    for child in plan.get('Plans', []):
+        indexes += plan_indexes(child)
+    return indexes
+
+# every (relation, node type, index) read by plan, walking nested plan nodes
+# a bitmap heap scan reads its table through the bitmap index scans below it
+def plan_scans(plan):
+    scans = []
+    if 'Relation Name' in plan:
+        index = plan.get('Index Name')
+        if plan['Node Type'] == 'Bitmap Heap Scan':
+            index = ' & '.join(plan_indexes(plan)) or None
+        scans.append((plan['Relation Name'], plan['Node Type'], index))
+    for child in plan.get('Plans', []):
+        scans += plan_scans(child)
+    return scans
+
+# {partition: partitioned table} of every partition in db, plans name the partitions they read instead of their table
+def get_partition_parents(cursor):
+    cursor.execute('SELECT child.relname, parent.relname FROM pg_inherits INNER JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'INNER JOIN pg_class parent ON parent.oid = pg_inherits.inhparent WHERE parent.relkind = %s;', ('p',))
+    return dict(cursor.fetchall())
+
+# EXPLAIN each hot query with a user/problem from the db, returns (name, scans, tables read without an index) per query
+# plans depend on table statistics, so run it on realistic data volumes (see benchmarks/query_plans.py) after ANALYZE
+def check_query_plans(cursor):
+    cursor.execute('SELECT user_id, problem_id FROM interval_calculation_info ORDER BY user_id, problem_id LIMIT 1;')
+    row = cursor.fetchone()
+    if row is None:
+        raise MigrationError('Query plans can only be checked on a db with users and problems')
+    parameters = {'user_id': row[0], 'problem_id': row[1], 'problem_ids': [row[1]]}
+    partition_parents = get_partition_parents(cursor)
+    results = []
+    for name, query, indexed_tables in HOT_QUERIES:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query, parameters)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans = [(partition_parents.get(relation, relation), node_type, index) for relation, node_type, index in plan_scans(plan[0]['Plan'])]
+        unindexed = [table for table in indexed_tables if not any(relation == table and index is not None for relation, _, index in scans)]
+        results.append((name, scans, unindexed))
+    return results
+
+@click.command('migrate-db')
+@click.option('--to', 'target_version', type=int, help='only apply migrations up to this version')
+@with_appcontext
+def migrate_db_command(target_version):
+    try:
+        applied = apply_migrations(get_db_connection().cursor(), target_version)
+    except MigrationError as error:
+        raise click.ClickException(str(error))
+    for version, name in applied:
+        click.echo(f'Applied migration {version} ({name}).')
+    if not applied:
+        click.echo('No migrations to apply.')
+
+@click.command('migration-status')
+@with_appcontext
+def migration_status_command():
+    for version, name, state in get_migration_status(get_db_connection().cursor()):
+        click.echo(f'{version:04d} {name}: {state}')
+
+@click.command('check-query-plans')
+@click.option('--analyze', is_flag=True, help='refresh table statistics before explaining')
+@with_appcontext
+def check_query_plans_command(analyze):
+    cursor = get_db_connection().cursor()
+    if analyze:
+        cursor.execute('ANALYZE daily_assignment, interval_calculation_info, user_attempt_log, problem_info, problem_info_sympy;')
+    try:
+        results = check_query_plans(cursor)
+    except MigrationError as error:
+        raise click.ClickException(str(error))
+    for name, scans, unindexed in results:
+        reads = ', '.join(f'{relation} ({index or node_type})' for relation, node_type, index in scans)
+        click.echo(f'{"FAIL" if unindexed else "ok  "} {name}: {reads}')
+    failed = [name for name, _, unindexed in results if unindexed]
+    if failed:
+        # postgres rightly reads small tables sequentially, so failures only mean something at realistic data volumes
+        raise click.ClickException(f'Hot queries read tables without an index: {", ".join(failed)} '
+            '(expected on small tables, check at realistic volumes with python -m benchmarks.query_plans)')
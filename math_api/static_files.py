@@ -0,0 +1,171 @@
+import os
+import re
+import gzip
+import json
+import mimetypes
+import threading
+import click
+from flask import Blueprint, current_app, request, send_file, abort
+from flask.cli import with_appcontext
+from werkzeug.routing import PathConverter
+try:
+    # optional, brotli variants are only built (and so only served) when it is installed
+    # requirements.txt installs it so deploys serve brotli, setups without it serve gzip only
+    import brotli
+except ImportError:
+    brotli = None
+
+# initalize blueprint to load frontend file route handlers onto
+frontend_blueprint = Blueprint('frontend', __name__)
+
+# frontend build next to the package, see FRONTEND_BUILD_DIRECTORY
+DEFAULT_BUILD_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build')
+
+# path of frontend file, never one under api/, so unknown api urls and api urls called with the wrong method
+# get a 404/405 from routing instead of being looked up in the frontend build
+class FrontendPathConverter(PathConverter):
+    regex = '(?!api/)[^/].*?'
+
+# create-react-app puts a content hash in the name of everything under static/ (e.g. static/js/main.85d15145.chunk.js),
+# so those files never change and can be cached for good
+HASHED_FILE_PATTERN = re.compile(r'^static/.+\.[0-9a-f]{8}\.')
+# text formats worth compressing, woff/woff2 fonts and png images are already compressed
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.css', '.json', '.map', '.txt', '.svg', '.ttf', '.ico', '.xml'}
+# precompressed variants in order of preference, as (content encoding, file suffix)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+# files smaller than this aren't worth a compressed copy
+MIN_COMPRESSED_SIZE = 1024
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # fixed mtime so builds of the same file are byte for byte identical
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+# relative paths of every compressible file in build: everything listed in asset-manifest.json
+# plus the rest of the build (fonts used by katex css aren't in the manifest)
+def compressible_files(build_directory):
+    relative_paths = set()
+    manifest_path = os.path.join(build_directory, 'asset-manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        relative_paths.update(path.lstrip('/') for path in manifest.get('files', {}).values())
+        relative_paths.update(manifest.get('entrypoints', []))
+    for directory, _, file_names in os.walk(build_directory):
+        for file_name in file_names:
+            relative_paths.add(os.path.relpath(os.path.join(directory, file_name), build_directory).replace(os.sep, '/'))
+    return sorted(path for path in relative_paths
+        if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS and os.path.isfile(os.path.join(build_directory, path)))
+
+# write .br/.gz copies next to each compressible file of frontend build, run at deploy time
+# copies that don't save at least 5% are removed instead, so they are never served
+# returns (relative path, size, {encoding: compressed size}) for each file
+def compress_frontend(build_directory):
+    encodings = [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != 'br' or brotli is not None]
+    results = []
+    for relative_path in compressible_files(build_directory):
+        path = os.path.join(build_directory, relative_path)
+        with open(path, 'rb') as original_file:
+            data = original_file.read()
+        compressed_sizes = {}
+        for encoding, suffix in encodings:
+            compressed = compress(data, encoding) if len(data) >= MIN_COMPRESSED_SIZE else None
+            if compressed is not None and len(compressed) < 0.95 * len(data):
+                with open(path + suffix, 'wb') as compressed_file:
+                    compressed_file.write(compressed)
+                compressed_sizes[encoding] = len(compressed)
+            elif os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        results.append((relative_path, len(data), compressed_sizes))
+    return results
+
+# index of frontend build: relative path -> {content encoding: path of precompressed copy}
+# copies older than their original (left over from a previous build) are ignored
+class FrontendFiles:
+    def __init__(self, build_directory):
+        self.build_directory = build_directory
+        self.files = {}
+        suffixes = tuple(suffix for _, suffix in ENCODINGS)
+        for directory, _, file_names in os.walk(build_directory):
+            for file_name in file_names:
+                if file_name.endswith(suffixes):
+                    continue
+                path = os.path.join(directory, file_name)
+                variants = {}
+                for encoding, suffix in ENCODINGS:
+                    if os.path.exists(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                        variants[encoding] = path + suffix
+                self.files[os.path.relpath(path, build_directory).replace(os.sep, '/')] = variants
+
+_index_lock = threading.Lock()
+
+# build directory is indexed once per app (before the fork with gunicorn's preload_app)
+# and on every request in development, where the frontend may be rebuilt while the app runs
+def get_frontend_files():
+    app = current_app._get_current_object()
+    if app.config["FLASK_ENV"] == "development":
+        return FrontendFiles(app.config["FRONTEND_BUILD_DIRECTORY"])
+    frontend_files = app.extensions.get('frontend_files')
+    if frontend_files is None:
+        with _index_lock:
+            frontend_files = app.extensions.setdefault('frontend_files', FrontendFiles(app.config["FRONTEND_BUILD_DIRECTORY"]))
+    return frontend_files
+
+# send file from frontend build, precompressed with the best encoding client accepts
+# content hashed files are cached by browsers for FRONTEND_IMMUTABLE_MAX_AGE seconds without revalidating,
+# everything else (index.html, manifest.json, ...) is revalidated with its etag on every use so new deploys show up right away
+# send_file is given the file's path, opens it and passes it to the server's wsgi.file_wrapper, so gunicorn sends it with sendfile()
+def send_frontend_file(relative_path):
+    frontend_files = get_frontend_files()
+    variants = frontend_files.files.get(relative_path)
+    if variants is None:
+        abort(404)
+    path = os.path.join(frontend_files.build_directory, relative_path)
+    encoding = next((encoding for encoding, _ in ENCODINGS if encoding in variants and request.accept_encodings[encoding] > 0), None)
+    mimetype = mimetypes.guess_type(relative_path)[0] or 'application/octet-stream'
+    immutable = HASHED_FILE_PATTERN.match(relative_path) is not None
+    # each variant is a separate file, so it gets its own etag
+    # send_file marks responses without a max age as no-cache
+    response = send_file(variants[encoding] if encoding else path, mimetype=mimetype, conditional=True,
+        max_age=current_app.config["FRONTEND_IMMUTABLE_MAX_AGE"] if immutable else None)
+    response.cache_control.immutable = immutable or None
+    if encoding:
+        response.content_encoding = encoding
+    if variants:
+        response.vary.add('Accept-Encoding')
+    return response
+
+# point base url to frontend homepage
+@frontend_blueprint.route('/', methods=['GET'])
+def index():
+    return send_frontend_file('index.html')
+
+# any other file of frontend build, e.g. /static/js/main.85d15145.chunk.js
+@frontend_blueprint.route('/<frontend_path:relative_path>', methods=['GET'])
+def frontend_file(relative_path):
+    return send_frontend_file(relative_path)
+
+# compress build and report how much was saved, needs no app so bin/post_compile can run it at build time,
+# when the app's config (SECRET, DATABASE_URL, ...) isn't available
+def compress_frontend_build(build_directory=DEFAULT_BUILD_DIRECTORY, echo=print):
+    total_size = 0
+    total_compressed_size = 0
+    for relative_path, size, compressed_sizes in compress_frontend(build_directory):
+        total_size += size
+        total_compressed_size += min(compressed_sizes.values(), default=size)
+    if brotli is None:
+        echo('brotli is not installed, only gzip copies were written.')
+    echo(f'Compressed frontend build from {total_size // 1024} KiB to {total_compressed_size // 1024} KiB.')
+
+@click.command('compress-frontend')
+@with_appcontext
+def compress_frontend_command():
+    compress_frontend_build(current_app.config["FRONTEND_BUILD_DIRECTORY"], click.echo)
+
+def init_app(app):
+    app.config.setdefault("FRONTEND_BUILD_DIRECTORY", DEFAULT_BUILD_DIRECTORY)
+    app.config.setdefault("FRONTEND_IMMUTABLE_MAX_AGE", 31536000)
+    app.url_map.converters['frontend_path'] = FrontendPathConverter
+    app.register_blueprint(frontend_blueprint)
+    app.cli.add_command(compress_frontend_command)
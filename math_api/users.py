@@ -1,9 +1,12 @@
+import click
 from flask import Blueprint, abort, jsonify, request
+from flask.cli import with_appcontext
 # allows cursor to return data in dict format instead of tuple
 from psycopg2.extras import RealDictCursor
 # library for creating auth tokens, restricting endpoints to authenticated users
 from flask_jwt_extended import jwt_required, current_user
 from .db import get_db_connection
+from .auth import forget_user
 
 user_info_blueprint = Blueprint('users', __name__, url_prefix='/api/users')
 
@@ -24,6 +27,8 @@ def remove_user(user_id):
     # see delete_user in util.sql for more info
     cursor.execute('call delete_user(%s);', (user_id,))
     cursor.close()
+    # tokens for user stop working in this worker right away, other workers notice within USER_CHECK_TTL seconds
+    forget_user(user_id)
 
 # remove all evidence of problem attempts by user
 def reset_user(user_id):
@@ -38,12 +43,26 @@ def reset_user(user_id):
 def get_user_statistics(user_id):
     db_connection = get_db_connection()
     cursor = db_connection.cursor(cursor_factory=RealDictCursor)
-    cursor.execute('SELECT attempt_date, COUNT(*) filter (where "correct") AS solved, COUNT(*) AS attempts FROM user_attempt_log WHERE user_id=%s '
-    'GROUP BY attempt_date ORDER BY attempt_date', (user_id,))
+    # read from rollup kept up to date by update_attempt_statistics trigger, see util.sql
+    cursor.execute('SELECT attempt_date, solved, attempts FROM user_daily_statistics WHERE user_id=%s ORDER BY attempt_date', (user_id,))
     statistics = cursor.fetchall()
     cursor.close()
     return statistics
 
+# recompute statistics rollups from full attempt log, if they are ever suspected to have drifted from user_attempt_log
+# (migration 0004 fills them once when they are introduced)
+def rebuild_statistics():
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    cursor.execute('call rebuild_attempt_statistics();')
+    cursor.close()
+
+@click.command('rebuild-statistics')
+@with_appcontext
+def rebuild_statistics_command():
+    rebuild_statistics()
+    click.echo('Rebuilt user statistics from attempt log.')
+
 # get day-by-day problems solved and attempted for this user
 @user_info_blueprint.route('/<int:user_id>', methods=['GET'])
 @jwt_required()
@@ -1,9 +1,68 @@
+CREATE TABLE IF NOT EXISTS problem_info_canonical (
+  problem_id int NOT NULL REFERENCES problem_info(id),
+  info_type text NOT NULL,
+  representation text NOT NULL,
+  canonical_representation text NOT NULL,
+  PRIMARY KEY (problem_id, info_type, representation)
+);
+
+CREATE TABLE IF NOT EXISTS answer_verdict (
+  problem_id int NOT NULL REFERENCES problem_info(id),
+  signature text NOT NULL,
+  answer text NOT NULL,
+  verdict text NOT NULL,
+  PRIMARY KEY (problem_id, signature, answer)
+);
+
+CREATE TABLE IF NOT EXISTS user_daily_statistics (
+  user_id int NOT NULL,
+  attempt_date date NOT NULL,
+  solved int NOT NULL DEFAULT 0,
+  attempts int NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, attempt_date)
+);
+
+CREATE TABLE IF NOT EXISTS user_problem_statistics (
+  user_id int NOT NULL,
+  problem_id int NOT NULL,
+  solved int NOT NULL DEFAULT 0,
+  attempts int NOT NULL DEFAULT 0,
+  most_recent_attempt date,
+  PRIMARY KEY (user_id, problem_id)
+);
+
+-- single row counting changes to problem_info, bumped by the problem_catalog_changed trigger below
+-- web workers compare it to the version of their problem catalog snapshot (see catalog.py), so problems added
+-- or edited by any process, e.g. `flask ingest-problems`, show up without waiting for the snapshot to expire
+CREATE TABLE IF NOT EXISTS problem_catalog_version (
+  id boolean PRIMARY KEY DEFAULT true CHECK (id),
+  version bigint NOT NULL DEFAULT 0
+);
+
+INSERT INTO problem_catalog_version(id, version) VALUES (true, 0) ON CONFLICT DO NOTHING;
+
+-- per user, problem and day attempt counts of user_attempt_log partitions that were archived (see attempt_archive.py),
+-- so statistics rollups can still be rebuilt and problems reset after the attempts themselves are gone
+CREATE TABLE IF NOT EXISTS archived_attempt_statistics (
+  user_id int NOT NULL,
+  problem_id int NOT NULL,
+  attempt_date date NOT NULL,
+  solved int NOT NULL,
+  attempts int NOT NULL,
+  PRIMARY KEY (user_id, problem_id, attempt_date)
+);
+
 create or replace procedure delete_user(user_id_param int) 
 language plpgsql
 as 
 $$
 begin
+  -- not bounded by attempt_date from the statistics rollups, attempts logged before the rollups existed have no rows there,
+  -- the (user_id, problem_id, attempt_date) index makes the lookup in every partition cheap anyway
   DELETE FROM user_attempt_log WHERE user_id = user_id_param;
+  DELETE FROM archived_attempt_statistics WHERE user_id = user_id_param;
+  DELETE FROM user_daily_statistics WHERE user_id = user_id_param;
+  DELETE FROM user_problem_statistics WHERE user_id = user_id_param;
   DELETE FROM daily_assignment WHERE user_id = user_id_param;
   DELETE FROM interval_calculation_info WHERE user_id = user_id_param;
   DELETE FROM user_info WHERE id = user_id_param;
@@ -19,6 +78,9 @@ declare
   max_questions constant int := 10;
 begin
   DELETE FROM user_attempt_log WHERE user_id = user_id_param;
+  DELETE FROM archived_attempt_statistics WHERE user_id = user_id_param;
+  DELETE FROM user_daily_statistics WHERE user_id = user_id_param;
+  DELETE FROM user_problem_statistics WHERE user_id = user_id_param;
   DELETE FROM daily_assignment WHERE user_id = user_id_param;
   UPDATE interval_calculation_info SET correct_streak = 0, last_graduated_interval = NULL, earliest_calculated_due_date = CURRENT_DATE + 1 + ((problem_id - 1) / max_questions) WHERE user_id = user_id_param;
   commit;
@@ -45,8 +107,9 @@ $$
 declare
   max_questions constant numeric := 10;
 begin
-  DELETE FROM daily_assignment WHERE daily_assignment.date!=CURRENT_DATE;
-  if NOT EXISTS (SELECT 1 FROM daily_assignment WHERE user_id=user_id_param) then
+  -- usually a no-op, assign_all_daily_questions has already rolled over every user for the day
+  if NOT EXISTS (SELECT 1 FROM daily_assignment WHERE user_id=user_id_param AND date=CURRENT_DATE) then
+    DELETE FROM daily_assignment WHERE user_id=user_id_param AND date!=CURRENT_DATE;
     INSERT INTO daily_assignment (problem_id, user_id, date, solved) 
     SELECT problem_id, user_id, CURRENT_DATE, false FROM interval_calculation_info WHERE earliest_calculated_due_date <= CURRENT_DATE AND user_id = user_id_param 
     ORDER BY earliest_calculated_due_date, correct_streak, problem_id LIMIT max_questions;
@@ -55,6 +118,24 @@ begin
 end;
 $$;
 
+create or replace procedure assign_all_daily_questions()
+language plpgsql
+as 
+$$
+declare
+  max_questions constant int := 10;
+begin
+  DELETE FROM daily_assignment WHERE date < CURRENT_DATE;
+  INSERT INTO daily_assignment (problem_id, user_id, date, solved)
+  SELECT problem_id, user_id, CURRENT_DATE, false FROM (
+    SELECT problem_id, user_id, row_number() OVER (PARTITION BY user_id ORDER BY earliest_calculated_due_date, correct_streak, problem_id) AS position
+    FROM interval_calculation_info WHERE earliest_calculated_due_date <= CURRENT_DATE 
+    AND NOT EXISTS (SELECT 1 FROM daily_assignment WHERE daily_assignment.user_id = interval_calculation_info.user_id AND daily_assignment.date = CURRENT_DATE)
+  ) AS due_problems WHERE position <= max_questions;
+  commit;
+end;
+$$;
+
 create or replace function schedule_next_assignment() 
 returns trigger 
 language plpgsql
@@ -85,16 +166,111 @@ language plpgsql
 as 
 $$
 begin
+  UPDATE user_daily_statistics SET solved = user_daily_statistics.solved - removed.solved, attempts = user_daily_statistics.attempts - removed.attempts
+    FROM (SELECT attempt_date, SUM(solved) AS solved, SUM(attempts) AS attempts FROM (
+            SELECT attempt_date, COUNT(*) filter (where correct) AS solved, COUNT(*) AS attempts FROM user_attempt_log 
+            WHERE user_id=user_id_param AND problem_id=problem_id_param GROUP BY attempt_date
+            UNION ALL
+            SELECT attempt_date, solved, attempts FROM archived_attempt_statistics WHERE user_id=user_id_param AND problem_id=problem_id_param
+          ) AS attempts GROUP BY attempt_date) AS removed
+    WHERE user_daily_statistics.user_id=user_id_param AND user_daily_statistics.attempt_date=removed.attempt_date;
+  DELETE FROM user_daily_statistics WHERE user_id=user_id_param AND attempts <= 0;
+  DELETE FROM user_problem_statistics WHERE user_id=user_id_param AND problem_id=problem_id_param;
   DELETE FROM user_attempt_log WHERE user_id=user_id_param AND problem_id=problem_id_param;
+  DELETE FROM archived_attempt_statistics WHERE user_id=user_id_param AND problem_id=problem_id_param;
   UPDATE interval_calculation_info SET correct_streak=0, last_graduated_interval=NULL, earliest_calculated_due_date=CURRENT_DATE + 1 WHERE user_id=user_id_param AND problem_id=problem_id_param;
   commit;
 end;
 $$;
 
+create or replace function update_attempt_statistics()
+returns trigger
+language plpgsql
+as
+$$
+begin
+  INSERT INTO user_daily_statistics(user_id, attempt_date, solved, attempts) VALUES (NEW.user_id, NEW.attempt_date, CASE WHEN NEW.correct THEN 1 ELSE 0 END, 1)
+    ON CONFLICT (user_id, attempt_date) DO UPDATE SET solved = user_daily_statistics.solved + EXCLUDED.solved, attempts = user_daily_statistics.attempts + 1;
+  INSERT INTO user_problem_statistics(user_id, problem_id, solved, attempts, most_recent_attempt) VALUES (NEW.user_id, NEW.problem_id, CASE WHEN NEW.correct THEN 1 ELSE 0 END, 1, NEW.attempt_date)
+    ON CONFLICT (user_id, problem_id) DO UPDATE SET solved = user_problem_statistics.solved + EXCLUDED.solved, attempts = user_problem_statistics.attempts + 1,
+    most_recent_attempt = GREATEST(user_problem_statistics.most_recent_attempt, EXCLUDED.most_recent_attempt);
+  RETURN NEW;
+end;
+$$;
+
+create or replace procedure rebuild_attempt_statistics()
+language plpgsql
+as
+$$
+begin
+  TRUNCATE user_daily_statistics, user_problem_statistics;
+  -- attempts of archived partitions are only left as counts in archived_attempt_statistics
+  CREATE TEMPORARY TABLE attempt_counts ON COMMIT DROP AS
+    SELECT user_id, problem_id, attempt_date, COUNT(*) filter (where correct) AS solved, COUNT(*) AS attempts FROM user_attempt_log GROUP BY user_id, problem_id, attempt_date
+    UNION ALL
+    SELECT user_id, problem_id, attempt_date, solved, attempts FROM archived_attempt_statistics;
+  INSERT INTO user_daily_statistics(user_id, attempt_date, solved, attempts) 
+    SELECT user_id, attempt_date, SUM(solved), SUM(attempts) FROM attempt_counts GROUP BY user_id, attempt_date;
+  INSERT INTO user_problem_statistics(user_id, problem_id, solved, attempts, most_recent_attempt) 
+    SELECT user_id, problem_id, SUM(solved), SUM(attempts), MAX(attempt_date) FROM attempt_counts GROUP BY user_id, problem_id;
+  commit;
+end;
+$$;
+
+-- monthly partitions of user_attempt_log (see migrations/0002_partition_user_attempt_log.sql) from the month of from_date
+-- to months_ahead months after the current one, named user_attempt_log_<yyyy>_<mm>; months that already have one are skipped
+-- attempts of a month without a partition land in user_attempt_log_default, they are moved into the month's new partition
+-- doesn't commit, so it can run inside the migration's transaction, and does nothing before that migration
+create or replace procedure create_attempt_log_partitions(from_date date, months_ahead int)
+language plpgsql
+as
+$$
+declare
+  month_start date := date_trunc('month', from_date)::date;
+  last_month date := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::date;
+  month_end date;
+  partition_name text;
+begin
+  if NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('user_attempt_log')) then
+    return;
+  end if;
+  while month_start <= last_month loop
+    month_end := (month_start + interval '1 month')::date;
+    partition_name := 'user_attempt_log_' || to_char(month_start, 'YYYY_MM');
+    if to_regclass(partition_name) IS NULL then
+      EXECUTE format('CREATE TABLE %I (LIKE user_attempt_log INCLUDING DEFAULTS)', partition_name);
+      EXECUTE format('WITH moved AS (DELETE FROM user_attempt_log_default WHERE attempt_date >= %L AND attempt_date < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+        month_start, month_end, partition_name);
+      EXECUTE format('ALTER TABLE user_attempt_log ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, month_start, month_end);
+    end if;
+    month_start := month_end;
+  end loop;
+end;
+$$;
+
+create or replace function bump_problem_catalog_version()
+returns trigger
+language plpgsql
+as
+$$
+begin
+  UPDATE problem_catalog_version SET version = version + 1;
+  RETURN NULL;
+end;
+$$;
+
 DROP TRIGGER IF EXISTS initialize_problem_assignments on public.user_info;
 
 CREATE TRIGGER initialize_problem_assignments AFTER INSERT ON user_info FOR EACH ROW EXECUTE PROCEDURE initialize_interval_calculation_table();
 
 DROP TRIGGER IF EXISTS calculate_intervals on public.user_attempt_log;
 
-CREATE TRIGGER calculate_intervals AFTER INSERT ON user_attempt_log FOR EACH ROW EXECUTE FUNCTION schedule_next_assignment();
\ No newline at end of file
+CREATE TRIGGER calculate_intervals AFTER INSERT ON user_attempt_log FOR EACH ROW EXECUTE FUNCTION schedule_next_assignment();
+
+DROP TRIGGER IF EXISTS maintain_attempt_statistics on public.user_attempt_log;
+
+CREATE TRIGGER maintain_attempt_statistics AFTER INSERT ON user_attempt_log FOR EACH ROW EXECUTE FUNCTION update_attempt_statistics();
+
+DROP TRIGGER IF EXISTS problem_catalog_changed on public.problem_info;
+
+CREATE TRIGGER problem_catalog_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON problem_info FOR EACH STATEMENT EXECUTE FUNCTION bump_problem_catalog_version();
\ No newline at end of file
@@ -0,0 +1,114 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import current_app
+from .db import get_db_connection
+
+# per-process LRU cache of answer verdicts, entries expire after ttl seconds
+class VerdictCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, verdict):
+        with self._lock:
+            self._entries[key] = (verdict, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def statistics(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+def get_verdict_cache():
+    app = current_app._get_current_object()
+    cache = app.extensions.get('verdict_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('verdict_cache', VerdictCache(app.config["VERDICT_CACHE_SIZE"], app.config["VERDICT_CACHE_TTL"]))
+    return cache
+
+# answers that only differ in leading/trailing whitespace get the same verdict
+# whitespace inside an answer changes how sympy parses it ('sin x' doesn't parse, 'sinx' is a symbol), so it's kept
+# seed_verdicts trims logged responses of the same characters with ANSWER_TRIM_SQL
+def normalize_answer(answer):
+    return answer.strip(' \t\n\r\f\v')
+
+ANSWER_TRIM_SQL = "btrim(response, E' \\t\\n\\r\\f\\v')"
+
+# stable fingerprint of everything a verdict depends on, so editing a problem invalidates its cached verdicts
+def problem_signature(problem_type, assumption_rows, problem_representation, solution_representations):
+    signature_source = repr((problem_type, sorted(tuple(row) for row in assumption_rows), problem_representation[0],
+        sorted(solution[0] for solution in solution_representations)))
+    return hashlib.md5(signature_source.encode()).hexdigest()
+
+# verdict previously computed for this answer, checking shared answer_verdict table if enabled
+# returns None if answer hasn't been seen before
+def get_cached_verdict(problem_id, signature, answer):
+    if not current_app.config["VERDICT_CACHE_ENABLED"]:
+        return None
+    key = (problem_id, signature, normalize_answer(answer))
+    verdict = get_verdict_cache().get(key)
+    if verdict is None and current_app.config["VERDICT_CACHE_SHARED"]:
+        db_connection = get_db_connection()
+        cursor = db_connection.cursor()
+        cursor.execute('SELECT verdict FROM answer_verdict WHERE problem_id=%s AND signature=%s AND answer=%s;', key)
+        row = cursor.fetchone()
+        cursor.close()
+        if row is not None:
+            verdict = row[0]
+            get_verdict_cache().set(key, verdict)
+    return verdict
+
+# remember verdict for answer in this process and, if enabled, in the shared answer_verdict table
+def store_verdict(problem_id, signature, answer, verdict):
+    if not current_app.config["VERDICT_CACHE_ENABLED"]:
+        return
+    key = (problem_id, signature, normalize_answer(answer))
+    get_verdict_cache().set(key, verdict)
+    if current_app.config["VERDICT_CACHE_SHARED"]:
+        db_connection = get_db_connection()
+        cursor = db_connection.cursor()
+        cursor.execute('INSERT INTO answer_verdict(problem_id, signature, answer, verdict) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING;', key + (verdict,))
+        cursor.close()
+
+# fill answer_verdict table from verdicts already recorded in user_attempt_log
+# assumes problems haven't been edited since those attempts were logged
+def seed_verdicts(get_problem_check_info):
+    db_connection = get_db_connection()
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT DISTINCT problem_id FROM user_attempt_log;')
+    problem_ids = [row[0] for row in cursor.fetchall()]
+    for problem_id in problem_ids:
+        signature = problem_signature(*get_problem_check_info(problem_id))
+        cursor.execute(f"INSERT INTO answer_verdict(problem_id, signature, answer, verdict) "
+        f"SELECT DISTINCT ON ({ANSWER_TRIM_SQL}) problem_id, %s, {ANSWER_TRIM_SQL}, CASE WHEN correct THEN 'correct' ELSE 'incorrect' END "
+        f"FROM user_attempt_log WHERE problem_id=%s ORDER BY {ANSWER_TRIM_SQL}, attempt_date DESC ON CONFLICT DO NOTHING;", (signature, problem_id))
+    cursor.close()
+    return len(problem_ids)
+
+def init_app(app):
+    app.config.setdefault("VERDICT_CACHE_ENABLED", True)
+    app.config.setdefault("VERDICT_CACHE_SIZE", 100000)
+    app.config.setdefault("VERDICT_CACHE_TTL", 86400)
+    app.config.setdefault("VERDICT_CACHE_SHARED", False)